@@ -2,7 +2,7 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
 from itertools import islice
-from math import ceil, floor, sqrt
+from math import ceil, sqrt
 from urlparse import urljoin
 
 # project
@@ -11,6 +11,13 @@ from utils.containers import hash_mutable
 
 # 3p
 import requests
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Rows of a pairwise latency matrix computed at once, bounding the memory used for large datacenters
+LATENCY_BLOCK_ROWS = 256
 
 
 # More information in https://www.consul.io/docs/internals/coordinates.html,
@@ -32,15 +39,74 @@ def distance(a, b):
     return rtt * 1000.0
 
 
+def coordinates(nodes):
+    """
+    Vectors, heights and adjustments of the coordinates of the nodes, as numpy arrays
+    """
+    return (np.array([node['Coord']['Vec'] for node in nodes], dtype=float),
+            np.array([node['Coord']['Height'] for node in nodes], dtype=float),
+            np.array([node['Coord']['Adjustment'] for node in nodes], dtype=float))
+
+
+def distances(a, b):
+    """
+    `distance` between all the nodes of the coordinates `a` and `b`, as a len(a) x len(b) matrix
+    """
+    a_vecs, a_heights, a_adjustments = a
+    b_vecs, b_heights, b_adjustments = b
+    total = np.zeros((len(a_vecs), len(b_vecs)))
+    # Summed in the same order as `distance`, for the same results
+    for i in xrange(a_vecs.shape[1]):
+        diff = a_vecs[:, i, None] - b_vecs[None, :, i]
+        total += diff * diff
+    rtt = np.sqrt(total) + a_heights[:, None] + b_heights[None, :]
+
+    adjusted = rtt + a_adjustments[:, None] + b_adjustments[None, :]
+    return np.where(adjusted > 0.0, adjusted, rtt) * 1000.0
+
+
 def ceili(v):
     return int(ceil(v))
 
 
+def latency_stats(latency_at, n):
+    """
+    Statistics of n sorted latencies, with `latency_at(i)` the i-th smallest one. It can be a
+    column of a matrix of sorted rows, to get the statistics of all the rows at once.
+    """
+    half_n = n // 2
+    if n % 2:
+        median = latency_at(half_n)
+    else:
+        median = (latency_at(half_n - 1) + latency_at(half_n)) / 2
+    return [
+        ('min', latency_at(0)),
+        ('p25', latency_at(ceili(n * 0.25) - 1)),
+        ('median', median),
+        ('p75', latency_at(ceili(n * 0.75) - 1)),
+        ('p90', latency_at(ceili(n * 0.90) - 1)),
+        ('p95', latency_at(ceili(n * 0.95) - 1)),
+        ('p99', latency_at(ceili(n * 0.99) - 1)),
+        ('max', latency_at(n - 1)),
+    ]
+
+
 class ConsulCheckInstanceState(object):
     def __init__(self):
         self.local_config = None
         self.last_config_fetch_time = None
         self.last_known_leader = None
+        # Keep-alive HTTP session to the Consul agent
+        self.session = None
+        # {endpoint: (X-Consul-Index, response)} of the endpoints supporting blocking queries
+        self.query_results = {}
+        # Service checks and service instances computed from the health state, and its index
+        self.health_state_index = None
+        self.health_service_checks = None
+        self.health_service_instances = None
+        # Latency statistics of the nodes, and the index of the coordinates they were computed from
+        self.coordinate_index = None
+        self.node_latencies = None
 
 
 class ConsulCheck(AgentCheck):
@@ -53,6 +119,8 @@ class ConsulCheck(AgentCheck):
 
     MAX_CONFIG_TTL = 300 # seconds
     MAX_SERVICES = 50 # cap on distinct Consul ServiceIDs to interrogate
+    # Blocking queries return at once when nothing changed, the check runs on its own schedule
+    BLOCKING_QUERY_WAIT = '1ms'
 
     STATUS_SC = {
         'up': AgentCheck.OK,
@@ -73,33 +141,62 @@ class ConsulCheck(AgentCheck):
 
         self._instance_states = defaultdict(lambda: ConsulCheckInstanceState())
 
-    def consul_request(self, instance, endpoint):
-        url = urljoin(instance.get('url'), endpoint)
-        try:
-
+    def _get_session(self, instance, instance_state):
+        if instance_state.session is None:
             clientcertfile = instance.get('client_cert_file', self.init_config.get('client_cert_file', False))
             privatekeyfile = instance.get('private_key_file', self.init_config.get('private_key_file', False))
             cabundlefile = instance.get('ca_bundle_file', self.init_config.get('ca_bundle_file', True))
             acl_token = instance.get('acl_token', None)
 
-            headers = {}
+            session = requests.Session()
+            session.verify = cabundlefile
             if acl_token:
-                headers['X-Consul-Token'] = acl_token
+                session.headers['X-Consul-Token'] = acl_token
 
             if clientcertfile:
                 if privatekeyfile:
-                    resp = requests.get(url, cert=(clientcertfile,privatekeyfile), verify=cabundlefile, headers=headers)
+                    session.cert = (clientcertfile, privatekeyfile)
                 else:
-                    resp = requests.get(url, cert=clientcertfile, verify=cabundlefile, headers=headers)
-            else:
-                resp = requests.get(url, verify=cabundlefile, headers=headers)
+                    session.cert = clientcertfile
+
+            instance_state.session = session
 
+        return instance_state.session
+
+    def consul_request(self, instance, endpoint):
+        """
+        Endpoints answering with an X-Consul-Index are queried with it at the next runs:
+        when it didn't change, the previous response is returned without decoding it again.
+        """
+        url = urljoin(instance.get('url'), endpoint)
+        instance_state = self._instance_states[hash_mutable(instance)]
+        last_index, last_result = instance_state.query_results.get(endpoint, (None, None))
+        params = {}
+        if last_index is not None:
+            params = {'index': last_index, 'wait': self.BLOCKING_QUERY_WAIT}
+
+        try:
+            resp = self._get_session(instance, instance_state).get(url, params=params)
         except requests.exceptions.Timeout:
             self.log.exception('Consul request to {0} timed out'.format(url))
             raise
 
         resp.raise_for_status()
-        return resp.json()
+        index = resp.headers.get('X-Consul-Index')
+        if index is not None and index == last_index:
+            return last_result
+
+        result = resp.json()
+        if index is not None:
+            instance_state.query_results[endpoint] = (index, result)
+        return result
+
+    def _get_query_index(self, instance, endpoint):
+        """
+        X-Consul-Index of the last response of the endpoint, None if it has none
+        """
+        instance_state = self._instance_states[hash_mutable(instance)]
+        return instance_state.query_results.get(endpoint, (None, None))[0]
 
     ### Consul Config Accessors
     def _get_local_config(self, instance, instance_state):
@@ -204,6 +301,37 @@ class ConsulCheck(AgentCheck):
 
         return self.consul_request(instance, consul_request_url)
 
+    def _get_service_instances(self, health_state):
+        """
+        Rebuild the `/v1/health/service/<service>` responses of all the services that have checks
+        from the health state of the cluster: {service: [{"Node": {"Node": node}, "Checks": [...]}, ...]}
+        The checks of a service instance are the checks of its node and its own ones.
+        """
+        node_checks = defaultdict(list)
+        for check in health_state:
+            if not check.get('ServiceID'):
+                node_checks[check['Node']].append(check)
+
+        # {service: {(node, service_id): service instance}}
+        service_instances = defaultdict(dict)
+        for check in health_state:
+            service_id = check.get('ServiceID')
+            service = check.get('ServiceName')
+            if not service_id or not service:
+                continue
+            instances = service_instances[service]
+            key = (check['Node'], service_id)
+            if key not in instances:
+                instances[key] = {'Node': {'Node': check['Node']}, 'Checks': list(node_checks[check['Node']])}
+            instances[key]['Checks'].append(check)
+
+        # Checks are sorted by ID, like Consul does
+        for instances in service_instances.itervalues():
+            for service_instance in instances.itervalues():
+                service_instance['Checks'].sort(key=lambda c: c['CheckID'])
+
+        return dict((service, instances.values()) for service, instances in service_instances.iteritems())
+
     def _cull_services_list(self, services, service_whitelist, max_services=MAX_SERVICES):
 
         if service_whitelist:
@@ -253,31 +381,41 @@ class ConsulCheck(AgentCheck):
         try:
             # Make service checks from health checks for all services in catalog
             health_state = self.consul_request(instance, '/v1/health/state/any')
-
-            sc = {}
-            # compute the highest status level (OK < WARNING < CRITICAL) a a check among all the nodes is running on.
-            for check in health_state:
-                sc_id = '{0}/{1}/{2}'.format(check['CheckID'], check.get('ServiceID', ''), check.get('ServiceName', ''))
-                status = self.STATUS_SC.get(check['Status'])
-                if status is None:
-                    status = AgentCheck.UNKNOWN
-
-                if sc_id not in sc:
-                    tags = ["check:{0}".format(check["CheckID"])]
-                    if check["ServiceName"]:
-                        tags.append("service:{0}".format(check["ServiceName"]))
-                    if check["ServiceID"]:
-                        tags.append("consul_service_id:{0}".format(check["ServiceID"]))
-                    sc[sc_id] = {'status': status, 'tags': tags}
-
-                elif self.STATUS_SEVERITY[status] > self.STATUS_SEVERITY[sc[sc_id]['status']]:
-                    sc[sc_id]['status'] = status
-
+            health_state_index = self._get_query_index(instance, '/v1/health/state/any')
+
+            # The health state of the whole cluster only has to be processed again when it changed
+            if health_state_index is None or health_state_index != instance_state.health_state_index:
+                sc = {}
+                # compute the highest status level (OK < WARNING < CRITICAL) a a check among all the nodes is running on.
+                for check in health_state:
+                    sc_id = '{0}/{1}/{2}'.format(check['CheckID'], check.get('ServiceID', ''), check.get('ServiceName', ''))
+                    status = self.STATUS_SC.get(check['Status'])
+                    if status is None:
+                        status = AgentCheck.UNKNOWN
+
+                    if sc_id not in sc:
+                        tags = ["check:{0}".format(check["CheckID"])]
+                        if check["ServiceName"]:
+                            tags.append("service:{0}".format(check["ServiceName"]))
+                        if check["ServiceID"]:
+                            tags.append("consul_service_id:{0}".format(check["ServiceID"]))
+                        sc[sc_id] = {'status': status, 'tags': tags}
+
+                    elif self.STATUS_SEVERITY[status] > self.STATUS_SEVERITY[sc[sc_id]['status']]:
+                        sc[sc_id]['status'] = status
+
+                instance_state.health_service_checks = sc
+                instance_state.health_service_instances = self._get_service_instances(health_state)
+                instance_state.health_state_index = health_state_index
+
+            sc = instance_state.health_service_checks
+            service_instances = instance_state.health_service_instances
             for s in sc.values():
                 self.service_check(self.HEALTH_CHECK, s['status'], tags=main_tags+s['tags'])
 
         except Exception as e:
             self.log.error(e)
+            service_instances = {}
             self.service_check(self.CONSUL_CHECK, AgentCheck.CRITICAL,
                                tags=service_check_tags)
         else:
@@ -308,7 +446,10 @@ class ConsulCheck(AgentCheck):
 
                 service_tags = ['consul_service_id:{0}'.format(service)]
 
-                nodes_with_service = self.get_nodes_with_service(instance, service)
+                # Only the services without any check are missing from the health state
+                nodes_with_service = service_instances.get(service)
+                if nodes_with_service is None:
+                    nodes_with_service = self.get_nodes_with_service(instance, service)
 
                 # {'up': 0, 'passing': 0, 'warning': 0, 'critical': 0}
                 node_status = defaultdict(int)
@@ -403,7 +544,56 @@ class ConsulCheck(AgentCheck):
     def _get_coord_nodes(self, instance):
         return self.consul_request(instance, 'v1/coordinate/nodes')
 
+    def _get_dc_latencies(self, datacenter, other):
+        """
+        Sorted latencies between the nodes of two datacenters
+        """
+        if np is not None:
+            latencies = distances(coordinates(datacenter['Coordinates']), coordinates(other['Coordinates']))
+            return np.sort(latencies, axis=None)
+
+        latencies = []
+        for node_a in datacenter['Coordinates']:
+            for node_b in other['Coordinates']:
+                latencies.append(distance(node_a, node_b))
+        latencies.sort()
+        return latencies
+
+    def _get_node_latencies(self, nodes):
+        """
+        Latency statistics of every node to the other ones: [(node, [(statistic, value), ...]), ...]
+        """
+        n = len(nodes) - 1
+        if np is None:
+            node_latencies = []
+            for node in nodes:
+                node_name = node['Node']
+                latencies = []
+                for other in nodes:
+                    other_name = other['Node']
+                    if node_name == other_name:
+                        continue
+                    latencies.append(distance(node, other))
+                latencies.sort()
+                node_latencies.append((node_name, latency_stats(latencies.__getitem__, n)))
+            return node_latencies
+
+        node_coordinates = coordinates(nodes)
+        blocks = []
+        for start in xrange(0, len(nodes), LATENCY_BLOCK_ROWS):
+            end = min(start + LATENCY_BLOCK_ROWS, len(nodes))
+            block = distances([c[start:end] for c in node_coordinates], node_coordinates)
+            # Leave the latency of the nodes to themselves out, as the largest one of their row
+            block[np.arange(end - start), np.arange(start, end)] = np.inf
+            block.sort(axis=1)
+            blocks.append(latency_stats(lambda i: block[:, i], n))
+
+        names = [name for name, _ in blocks[0]]
+        stats = zip(*[np.concatenate([block_stats[j][1] for block_stats in blocks]) for j in xrange(len(names))])
+        return [(node['Node'], zip(names, node_stats)) for node, node_stats in zip(nodes, stats)]
+
     def check_network_latency(self, instance, agent_dc, main_tags):
+        instance_state = self._instance_states[hash_mutable(instance)]
 
         datacenters = self._get_coord_datacenters(instance)
         for datacenter in datacenters:
@@ -415,50 +605,28 @@ class ConsulCheck(AgentCheck):
                     if name == other_name:
                         # Ignore ourself
                         continue
-                    latencies = []
-                    for node_a in datacenter['Coordinates']:
-                        for node_b in other['Coordinates']:
-                            latencies.append(distance(node_a, node_b))
-                    latencies.sort()
+                    latencies = self._get_dc_latencies(datacenter, other)
                     tags = main_tags + ['source_datacenter:{}'.format(name),
                                         'dest_datacenter:{}'.format(other_name)]
-                    n = len(latencies)
-                    half_n = int(floor(n / 2))
-                    if n % 2:
-                        median = latencies[half_n]
-                    else:
-                        median = (latencies[half_n - 1] + latencies[half_n]) / 2
-                    self.gauge('consul.net.dc.latency.min', latencies[0], hostname='', tags=tags)
-                    self.gauge('consul.net.dc.latency.median', median, hostname='', tags=tags)
-                    self.gauge('consul.net.dc.latency.max', latencies[-1], hostname='', tags=tags)
+                    stats = dict(latency_stats(latencies.__getitem__, len(latencies)))
+                    self.gauge('consul.net.dc.latency.min', stats['min'], hostname='', tags=tags)
+                    self.gauge('consul.net.dc.latency.median', stats['median'], hostname='', tags=tags)
+                    self.gauge('consul.net.dc.latency.max', stats['max'], hostname='', tags=tags)
                 # We've found ourself, we can move on
                 break
 
         # Intra-datacenter
         nodes = self._get_coord_nodes(instance)
-        if len(nodes) == 1:
+        if len(nodes) <= 1:
             self.log.debug("Only 1 node in cluster, skipping network latency metrics.")
-        else:
-            for node in nodes:
-                node_name = node['Node']
-                latencies = []
-                for other in nodes:
-                    other_name = other['Node']
-                    if node_name == other_name:
-                        continue
-                    latencies.append(distance(node, other))
-                latencies.sort()
-                n = len(latencies)
-                half_n = int(floor(n / 2))
-                if n % 2:
-                    median = latencies[half_n]
-                else:
-                    median = (latencies[half_n - 1] + latencies[half_n]) / 2
-                self.gauge('consul.net.node.latency.min', latencies[0], hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.p25', latencies[ceili(n * 0.25) - 1], hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.median', median, hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.p75', latencies[ceili(n * 0.75) - 1], hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.p90', latencies[ceili(n * 0.90) - 1], hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.p95', latencies[ceili(n * 0.95) - 1], hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.p99', latencies[ceili(n * 0.99) - 1], hostname=node_name, tags=main_tags)
-                self.gauge('consul.net.node.latency.max', latencies[-1], hostname=node_name, tags=main_tags)
+            return
+
+        # Quadratic in the number of nodes, only computed again when their coordinates changed
+        coordinate_index = self._get_query_index(instance, 'v1/coordinate/nodes')
+        if coordinate_index is None or coordinate_index != instance_state.coordinate_index:
+            instance_state.node_latencies = self._get_node_latencies(nodes)
+            instance_state.coordinate_index = coordinate_index
+
+        for node_name, stats in instance_state.node_latencies:
+            for stat, value in stats:
+                self.gauge('consul.net.node.latency.{0}'.format(stat), value, hostname=node_name, tags=main_tags)
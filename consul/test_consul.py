@@ -5,6 +5,7 @@
 import random
 
 # 3p
+import mock
 from nose.plugins.attrib import attr
 from requests import HTTPError
 
@@ -667,6 +668,99 @@ class TestCheckConsul(AgentCheckTest):
         self.assertEquals(16, len(node))
         self.assertEquals(0.26577747932995816, node[0][2])
 
+    def mock_get_health_state(self, instance, endpoint):
+        if endpoint != '/v1/health/state/any':
+            raise Exception('Unexpected request to {0}'.format(endpoint))
+        health_state = []
+        for node, statuses in [('node-1', ['passing', 'warning']), ('node-2', ['passing', 'critical'])]:
+            health_state.append({"Node": node, "CheckID": "serfHealth", "Status": "passing",
+                                 "ServiceID": "", "ServiceName": ""})
+            for i, status in enumerate(statuses):
+                service = "service-{0}".format(i + 1)
+                health_state.append({"Node": node, "CheckID": "service:{0}".format(service), "Status": status,
+                                     "ServiceID": service, "ServiceName": service})
+        return health_state
+
+    def test_catalog_from_health_state(self):
+        """
+        Services with checks come from the health state, the other ones are still queried one by one
+        """
+        mocks = self._get_consul_mocks()
+        mocks['consul_request'] = self.mock_get_health_state
+        mocks['get_nodes_with_service'] = mock.MagicMock(side_effect=self.mock_get_nodes_with_service)
+
+        self.run_check(MOCK_CONFIG, mocks=mocks)
+        self.assertEqual(sorted(c[0][1] for c in mocks['get_nodes_with_service'].call_args_list),
+                         ['service-3', 'service-4', 'service-5', 'service-6'])
+
+        service_1 = ['consul_datacenter:dc1', 'consul_service_id:service-1']
+        self.assertMetric('consul.catalog.nodes_up', value=2, tags=service_1)
+        self.assertMetric('consul.catalog.nodes_passing', value=2, tags=service_1)
+        service_2 = ['consul_datacenter:dc1', 'consul_service_id:service-2']
+        self.assertMetric('consul.catalog.nodes_up', value=2, tags=service_2)
+        self.assertMetric('consul.catalog.nodes_warning', value=1, tags=service_2)
+        self.assertMetric('consul.catalog.nodes_critical', value=1, tags=service_2)
+        node_2 = ['consul_datacenter:dc1', 'consul_node_id:node-2']
+        self.assertMetric('consul.catalog.services_passing', value=1, tags=node_2)
+        self.assertMetric('consul.catalog.services_critical', value=1, tags=node_2)
+
+    def test_blocking_query_index(self):
+        """
+        Responses are only decoded and processed again when their X-Consul-Index changed
+        """
+        instance = MOCK_CONFIG['instances'][0]
+        self.check = load_check(self.CHECK_NAME, MOCK_CONFIG, self.DEFAULT_AGENT_CONFIG)
+        session = mock.MagicMock()
+        responses = []
+
+        def get(url, params=None):
+            resp = mock.MagicMock()
+            resp.headers = {'X-Consul-Index': responses[-1][0]}
+            resp.json.return_value = responses[-1][1]
+            return resp
+        session.get.side_effect = get
+
+        with mock.patch.object(self.check, '_get_session', return_value=session):
+            responses.append(('10', self.mock_get_health_state(instance, '/v1/health/state/any')))
+            self.check.consul_request(instance, '/v1/health/state/any')
+            first = session.get.call_args
+
+            responses.append(('10', None))
+            health_state = self.check.consul_request(instance, '/v1/health/state/any')
+            self.assertEqual(health_state, responses[0][1])
+            self.assertEqual(session.get.call_args[1]['params'], {'index': '10', 'wait': '1ms'})
+            self.assertEqual(first[1]['params'], {})
+
+            responses.append(('11', []))
+            self.assertEqual(self.check.consul_request(instance, '/v1/health/state/any'), [])
+            self.assertEqual(self.check._get_query_index(instance, '/v1/health/state/any'), '11')
+
+    def test_network_latency_vectorized(self):
+        """
+        Vectorized latencies are the same as the ones computed node by node
+        """
+        self.check = load_check(self.CHECK_NAME, MOCK_CONFIG_NETWORK_LATENCY_CHECKS, self.DEFAULT_AGENT_CONFIG)
+        nodes = [{
+            "Node": "node-{0}".format(i),
+            "Coord": {
+                "Vec": [random.uniform(-0.05, 0.05) for _ in range(8)],
+                "Error": 0.2,
+                "Adjustment": random.uniform(-0.001, 0.001),
+                "Height": random.uniform(0, 0.0001),
+            }
+        } for i in range(11)]
+        datacenters = [{"Datacenter": "dc1", "Coordinates": nodes[:4]},
+                       {"Datacenter": "dc2", "Coordinates": nodes[4:]}]
+
+        with mock.patch('_consul.LATENCY_BLOCK_ROWS', 3):
+            node_latencies = self.check._get_node_latencies(nodes)
+            dc_latencies = self.check._get_dc_latencies(*datacenters)
+        with mock.patch('_consul.np', None):
+            self.assertEqual(node_latencies, self.check._get_node_latencies(nodes))
+            self.assertEqual(list(dc_latencies), self.check._get_dc_latencies(*datacenters))
+        self.assertEqual(len(node_latencies), 11)
+        self.assertEqual(len(dc_latencies), 28)
+
 @attr(requires='consul')
 class TestIntegrationConsul(AgentCheckTest):
     """Basic Test for consul integration."""
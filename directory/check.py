@@ -1,15 +1,179 @@
 # stdlib
-from fnmatch import fnmatch
-from os import stat
-from os.path import abspath, exists, join, relpath
+from fnmatch import translate
+from os import sep, stat
+from os.path import abspath, exists, join, normcase
+import math
+import re
 import time
 
 # 3p
-from scandir import walk
+from scandir import scandir
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 # project
 from checks import AgentCheck
 from config import _is_affirmative
+from utils.persistable_store import PersistableStore
+
+# Directories modified this recently are rescanned at the next run: files added within
+# the same mtime tick as our scan wouldn't change their mtime again
+RACY_MTIME_DELAY = 2
+# In incremental mode, full scans refresh the files modified in place, which doesn't
+# change the mtime of their directory
+DEFAULT_FULL_SCAN_INTERVAL = 600
+
+# Directory index entries: [mtime, subdirectories, files, bytes, scan time, [file sketches]]
+MTIME, SUBDIRS, FILES, BYTES, SCANNED, SKETCHES = range(6)
+
+# Distributions of the files of a directory, sketched in this order
+FILE_METRICS = [
+    "system.disk.directory.file.bytes",
+    "system.disk.directory.file.modified_sec_ago",
+    "system.disk.directory.file.created_sec_ago",
+]
+# Relative accuracy of the quantiles reported for the file distributions
+SKETCH_RELATIVE_ACCURACY = 0.01
+# Same defaults as the aggregates of the agent histograms
+DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
+DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch, in the style of DDSketch: values are counted in logarithmic
+    buckets, so its quantiles are within `relative_accuracy` of the exact ones, and its size
+    depends on the range of the values instead of their number.
+    Values <= 0 share a single bucket, reported as 0. The count, sum, min and max are exact.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _add_to_bins(self, value, count):
+        if value > 0:
+            key = int(math.ceil(math.log(value) / self._log_gamma))
+            self.bins[key] = self.bins.get(key, 0) + count
+        else:
+            self.zeros += count
+
+    def _bin_value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        self._add_to_bins(value, count)
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other, offset=0):
+        """
+        Add the values of another sketch, shifted by `offset`
+        """
+        if not other.count:
+            return
+        if offset:
+            # Shifting moves values across buckets, re-add them: their relative error is then
+            # at most twice the accuracy for positive offsets
+            for key, count in other.bins.iteritems():
+                self._add_to_bins(other._bin_value(key) + offset, count)
+            if other.zeros:
+                self._add_to_bins(offset, other.zeros)
+        else:
+            for key, count in other.bins.iteritems():
+                self.bins[key] = self.bins.get(key, 0) + count
+            self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum + offset * other.count
+        if self.min is None or other.min + offset < self.min:
+            self.min = other.min + offset
+        if self.max is None or other.max + offset > self.max:
+            self.max = other.max + offset
+
+    def quantile(self, q):
+        """
+        Value of the given quantile, picked with the same rank as the agent histograms
+        """
+        if not self.count:
+            return None
+        rank = max(int(round(q * self.count - 1)), 0)
+        if rank < self.zeros:
+            value = 0
+        else:
+            seen = self.zeros
+            for key in sorted(self.bins):
+                seen += self.bins[key]
+                if seen > rank:
+                    break
+            value = self._bin_value(key)
+        return min(max(value, self.min), self.max)
+
+    def to_list(self):
+        return [self.count, self.sum, self.min, self.max, self.zeros, self.bins.items()]
+
+    @classmethod
+    def from_list(cls, serialized, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        sketch = cls(relative_accuracy)
+        sketch.count, sketch.sum, sketch.min, sketch.max, sketch.zeros, bins = serialized
+        sketch.bins = dict((int(key), count) for key, count in bins)
+        return sketch
+
+
+class DirectoryWatcher(object):
+    """
+    Keep track of the directories changed since the last run with inotify, so incremental
+    scans don't even need to stat the unchanged directories.
+    """
+    MASK = 0
+
+    if pyinotify is not None:
+        MASK = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE_SELF)
+
+    def __init__(self, directory, recursive):
+        self.directory = directory
+        self.changed = set()
+        # Everything is unknown until the first scan
+        self.overflowed = True
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(self._wm, self._process_event)
+        self._notifier.daemon = True
+        self._notifier.start()
+        watches = self._wm.add_watch(directory, self.MASK, rec=recursive, auto_add=recursive, quiet=True)
+        if any(wd < 0 for wd in watches.itervalues()):
+            self.stop()
+            raise Exception("could not watch all the directories of %s, check fs.inotify.max_user_watches" % directory)
+
+    def _process_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.overflowed = True
+        else:
+            self.changed.add(event.path)
+
+    def pop_changes(self):
+        """
+        Return the directories changed since the last call, None if they're unknown
+        """
+        changed, self.changed = self.changed, set()
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return changed
+
+    def stop(self):
+        self._notifier.stop()
 
 
 class DirectoryCheck(AgentCheck):
@@ -25,9 +189,30 @@ class DirectoryCheck(AgentCheck):
         "filegauges" - boolean, when true stats will be an individual gauge per file (max. 20 files!) and not a histogram of the whole directory. default False
         "pattern" - string, the `fnmatch` pattern to use when reading the "directory"'s files. default "*"
         "recursive" - boolean, when true the stats will recurse into directories. default False
+        "incremental" - boolean, when true only the directories changed since the previous run are scanned again. default False
+        "full_scan_interval" - number of seconds between the full scans of incremental mode. default 600
+        "watch" - boolean, when true incremental mode learns about the changed directories from inotify (requires pyinotify). default False
     """
 
     SOURCE_TYPE_NAME = 'system'
+    PERSISTENCE_CHECK_NAME = 'directory'
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        # pattern -> compiled regex
+        self._patterns = {}
+        # instance key -> [directory index, time of the last full scan, persistable store]
+        self._indexes = {}
+        # instance key -> DirectoryWatcher
+        self._watchers = {}
+        # File distributions are sketched locally and reported like agent histograms
+        self._histogram_aggregates = agentConfig.get('histogram_aggregates') or DEFAULT_HISTOGRAM_AGGREGATES
+        self._histogram_percentiles = agentConfig.get('histogram_percentiles') or DEFAULT_HISTOGRAM_PERCENTILES
+
+    def stop(self):
+        for watcher in self._watchers.itervalues():
+            watcher.stop()
+        self._watchers = {}
 
     def check(self, instance):
         if "directory" not in instance:
@@ -42,60 +227,265 @@ class DirectoryCheck(AgentCheck):
         filetagname = instance.get("filetagname", "filename")
         filegauges = _is_affirmative(instance.get("filegauges", False))
         countonly = _is_affirmative(instance.get("countonly", False))
+        # Per file gauges are for small directories, they're always scanned fully
+        incremental = _is_affirmative(instance.get("incremental", False)) and not filegauges
+        full_scan_interval = float(instance.get("full_scan_interval", DEFAULT_FULL_SCAN_INTERVAL))
+        watch = _is_affirmative(instance.get("watch", False))
 
         if not exists(abs_directory):
             raise Exception("DirectoryCheck: the directory (%s) does not exist" % abs_directory)
 
-        self._get_stats(abs_directory, name, dirtagname, filetagname, filegauges, pattern, recursive, countonly)
+        if incremental:
+            self._get_stats_incremental(abs_directory, name, dirtagname, pattern, recursive, countonly,
+                                        full_scan_interval, watch)
+        else:
+            self._get_stats(abs_directory, name, dirtagname, filetagname, filegauges, pattern, recursive, countonly)
+
+    def _get_pattern(self, pattern):
+        """
+        Compile an `fnmatch` pattern once, return None when it matches all the files
+        """
+        if pattern not in self._patterns:
+            self._patterns[pattern] = None if pattern == "*" else re.compile(translate(normcase(pattern)))
+        return self._patterns[pattern]
+
+    def _scan(self, path, rel_path, pattern, countonly):
+        """
+        Scan the files of a single directory.
+        Return its subdirectories and the (filename, size, mtime, ctime) of its files matching
+        the pattern, only their filename if `countonly`.
+        """
+        subdirs = []
+        files = []
+        for entry in scandir(path):
+            # Like os.walk, symlinks to directories are neither files nor followed
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+                continue
+
+            filename = entry.path
+            # Check if the path of the file relative to the directory
+            # matches the pattern. Also check if the absolute path of the
+            # filename matches the pattern, for compatibility with previous
+            # agent verions.
+            if pattern is not None and not (pattern.match(normcase(filename)) or
+                                            pattern.match(normcase(rel_path + entry.name))):
+                continue
+
+            # We're just looking to count the files, don't stat it as well
+            if countonly:
+                files.append((filename, None, None, None))
+                continue
+
+            try:
+                file_stat = entry.stat()
+            except OSError as ose:
+                self.warning("DirectoryCheck: could not stat file %s - %s" % (filename, ose))
+            else:
+                files.append((filename, file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime))
+        return subdirs, files
+
+    def _submit_sketches(self, sketches, tags):
+        """
+        Submit the aggregates of the file distributions the agent would flush for histograms
+        """
+        for metric, sketch in zip(FILE_METRICS, sketches):
+            if not sketch.count:
+                continue
+            for aggregate in self._histogram_aggregates:
+                if aggregate == 'max':
+                    value = sketch.max
+                elif aggregate == 'min':
+                    value = sketch.min
+                elif aggregate == 'avg':
+                    value = sketch.sum / sketch.count
+                elif aggregate == 'median':
+                    value = sketch.quantile(0.5)
+                elif aggregate == 'count':
+                    value = sketch.count
+                else:
+                    continue
+                self.gauge("%s.%s" % (metric, aggregate), value, tags=tags)
+            for percentile in self._histogram_percentiles:
+                self.gauge("%s.%spercentile" % (metric, int(percentile * 100)),
+                           sketch.quantile(percentile), tags=tags)
 
     def _get_stats(self, directory, name, dirtagname, filetagname, filegauges, pattern, recursive, countonly):
         dirtags = [dirtagname + ":%s" % name]
+        pattern = self._get_pattern(pattern)
         directory_bytes = 0
         directory_files = 0
-        for root, dirs, files in walk(directory):
-            for filename in files:
-                filename = join(root, filename)
-                rel_filename = relpath(filename, directory)
-                # Check if the path of the file relative to the directory
-                # matches the pattern. Also check if the absolute path of the
-                # filename matches the pattern, for compatibility with previous
-                # agent verions.
-                if not (fnmatch(filename, pattern) or fnmatch(rel_filename, pattern)):
-                    continue
+        sizes, modified, created = sketches = [QuantileSketch() for _ in FILE_METRICS]
+        # A single timestamp for the ages of all the files
+        now = time.time()
 
+        # Same top-down order as os.walk
+        to_scan = [(directory, '')]
+        while to_scan:
+            path, rel_path = to_scan.pop()
+            try:
+                subdirs, files = self._scan(path, rel_path, pattern, countonly)
+            except OSError as ose:
+                # Like os.walk, skip the directories we can't list
+                self.log.debug("DirectoryCheck: could not scan directory %s - %s", path, ose)
+                continue
+            for filename, size, mtime, ctime in files:
                 directory_files += 1
-
-                # We're just looking to count the files, don't stat it as well
                 if countonly:
                     continue
 
+                # file specific metrics
+                directory_bytes += size
+                if filegauges and directory_files <= 20:
+                    filetags = list(dirtags)
+                    filetags.append(filetagname + ":%s" % filename)
+                    self.gauge("system.disk.directory.file.bytes", size, tags=filetags)
+                    self.gauge("system.disk.directory.file.modified_sec_ago", now - mtime, tags=filetags)
+                    self.gauge("system.disk.directory.file.created_sec_ago", now - ctime, tags=filetags)
+                elif not filegauges:
+                    sizes.add(size)
+                    modified.add(now - mtime)
+                    created.add(now - ctime)
+
+            # if we do not want to do this recursively and just want
+            # the top level directory we gave it, then stop
+            if recursive:
+                for subdir in reversed(subdirs):
+                    to_scan.append((join(path, subdir), rel_path + subdir + sep))
+
+        self._submit_sketches(sketches, dirtags)
+        # number of files
+        self.gauge("system.disk.directory.files", directory_files, tags=dirtags)
+        # total file size
+        if not countonly:
+            self.gauge("system.disk.directory.bytes", directory_bytes, tags=dirtags)
+
+    def _get_directory_index(self, instance_key):
+        if instance_key not in self._indexes:
+            store = PersistableStore(self.PERSISTENCE_CHECK_NAME, instance_key)
+            index = store['index'] or {}
+            for entry in index.itervalues():
+                entry[SKETCHES] = [QuantileSketch.from_list(sketch) for sketch in entry[SKETCHES]]
+            self._indexes[instance_key] = [index, store['last_full_scan'] or 0, store]
+        return self._indexes[instance_key]
+
+    def _persist_directory_index(self, store, index, last_full_scan):
+        serialized = {}
+        for path, entry in index.iteritems():
+            entry = list(entry)
+            entry[SKETCHES] = [sketch.to_list() for sketch in entry[SKETCHES]]
+            serialized[path] = entry
+        store['index'] = serialized
+        store['last_full_scan'] = last_full_scan
+        store.commit_status()
+
+    def _get_changed_directories(self, instance_key, directory, recursive, watch):
+        """
+        Directories changed since the last run according to inotify, None if they're unknown
+        """
+        if not watch:
+            return None
+        if pyinotify is None:
+            self.warning("DirectoryCheck: `watch` requires pyinotify, using directory modification times")
+            return None
+        if instance_key not in self._watchers:
+            try:
+                self._watchers[instance_key] = DirectoryWatcher(directory, recursive)
+            except Exception as e:
+                self.warning("DirectoryCheck: unable to watch %s, using directory modification times - %s"
+                             % (directory, e))
+                return None
+        return self._watchers[instance_key].pop_changes()
+
+    def _get_stats_incremental(self, directory, name, dirtagname, pattern, recursive, countonly,
+                               full_scan_interval, watch):
+        """
+        Same metrics as `_get_stats`, but the files of the directories that didn't change since
+        the previous run, according to their mtime or inotify, are taken from an index of the
+        previous scans instead of being scanned again. The index is persisted across agent restarts.
+        """
+        dirtags = [dirtagname + ":%s" % name]
+        instance_key = "%s:%s:%s:%s" % (directory, pattern, recursive, countonly)
+        index, last_full_scan, store = self._get_directory_index(instance_key)
+        changed = self._get_changed_directories(instance_key, directory, recursive, watch)
+        compiled_pattern = self._get_pattern(pattern)
+
+        scan_start = time.time()
+        full_scan = scan_start - last_full_scan >= full_scan_interval
+        new_index = {}
+        rescanned = 0
+
+        to_scan = [(directory, '')]
+        while to_scan:
+            path, rel_path = to_scan.pop()
+            entry = index.get(path)
+            if watch and changed is not None:
+                # Changes made while we scanned a directory are reported at the next run
+                unchanged = entry is not None and path not in changed
+                mtime = entry[MTIME] if unchanged else None
+            else:
                 try:
-                    file_stat = stat(filename)
+                    mtime = stat(path).st_mtime
+                except OSError as ose:
+                    # Removed since its parent was scanned
+                    self.log.debug("DirectoryCheck: could not stat directory %s - %s", path, ose)
+                    continue
+                unchanged = entry is not None and entry[MTIME] == mtime
 
+            if full_scan or not unchanged:
+                try:
+                    subdirs, files = self._scan(path, rel_path, compiled_pattern, countonly)
                 except OSError as ose:
-                    self.warning("DirectoryCheck: could not stat file %s - %s" % (filename, ose))
-                else:
-                    # file specific metrics
-                    directory_bytes += file_stat.st_size
-                    if filegauges and directory_files <= 20:
-                        filetags = list(dirtags)
-                        filetags.append(filetagname + ":%s" % filename)
-                        self.gauge("system.disk.directory.file.bytes", file_stat.st_size, tags=filetags)
-                        self.gauge("system.disk.directory.file.modified_sec_ago", time.time() - file_stat.st_mtime, tags=filetags)
-                        self.gauge("system.disk.directory.file.created_sec_ago", time.time() - file_stat.st_ctime, tags=filetags)
-                    elif not filegauges:
-                        self.histogram("system.disk.directory.file.bytes", file_stat.st_size, tags=dirtags)
-                        self.histogram("system.disk.directory.file.modified_sec_ago", time.time() - file_stat.st_mtime, tags=dirtags)
-                        self.histogram("system.disk.directory.file.created_sec_ago", time.time() - file_stat.st_ctime, tags=dirtags)
-
-            # os.walk gives us all sub-directories and their files
-            # if we do not want to do this recursively and just want
-            # the top level directory we gave it, then break
-            if not recursive:
-                break
+                    self.log.debug("DirectoryCheck: could not scan directory %s - %s", path, ose)
+                    continue
+                rescanned += 1
+                if mtime is None:
+                    try:
+                        mtime = stat(path).st_mtime
+                    except OSError:
+                        pass
+                if mtime is not None and mtime > scan_start - RACY_MTIME_DELAY:
+                    mtime = None
+                entry = [mtime, subdirs, len(files), 0, scan_start, []]
+                if not countonly:
+                    # The ages of the files are sketched at the time of the scan, and shifted later
+                    sizes, modified, created = entry[SKETCHES] = [QuantileSketch() for _ in FILE_METRICS]
+                    for _, size, file_mtime, ctime in files:
+                        entry[BYTES] += size
+                        sizes.add(size)
+                        modified.add(scan_start - file_mtime)
+                        created.add(scan_start - ctime)
+            new_index[path] = entry
+
+            if recursive:
+                for subdir in reversed(entry[SUBDIRS]):
+                    to_scan.append((join(path, subdir), rel_path + subdir + sep))
 
+        self.log.debug("DirectoryCheck: scanned %s directories out of %s in %s", rescanned, len(new_index), directory)
+
+        directory_files = 0
+        directory_bytes = 0
+        sizes, modified, created = sketches = [QuantileSketch() for _ in FILE_METRICS]
+        for entry in new_index.itervalues():
+            directory_files += entry[FILES]
+            if countonly:
+                continue
+            directory_bytes += entry[BYTES]
+            entry_sizes, entry_modified, entry_created = entry[SKETCHES]
+            sizes.merge(entry_sizes)
+            modified.merge(entry_modified, offset=scan_start - entry[SCANNED])
+            created.merge(entry_created, offset=scan_start - entry[SCANNED])
+
+        self._submit_sketches(sketches, dirtags)
         # number of files
         self.gauge("system.disk.directory.files", directory_files, tags=dirtags)
         # total file size
         if not countonly:
             self.gauge("system.disk.directory.bytes", directory_bytes, tags=dirtags)
+
+        if full_scan:
+            last_full_scan = scan_start
+        self._indexes[instance_key] = [new_index, last_full_scan, store]
+        if rescanned or len(new_index) != len(index):
+            self._persist_directory_index(store, new_index, last_full_scan)
@@ -5,14 +5,20 @@
 # stdlib
 from itertools import product
 import os
+import random
 import shutil
 import tempfile
+import time
 
 # 3p
+import mock
 from nose.plugins.attrib import attr
+from scandir import scandir
 
 # project
-from tests.checks.common import AgentCheckTest
+from tests.checks.common import AgentCheckTest, load_class
+
+QuantileSketch = load_class('directory', 'QuantileSketch')
 
 @attr(requires="directory")
 class DirectoryTestCase(AgentCheckTest):
@@ -188,3 +194,121 @@ class DirectoryTestCase(AgentCheckTest):
 
         # Raises when coverage < 100%
         self.coverage_report()
+
+    def test_quantile_sketch(self):
+        """
+        Sketched quantiles are within the relative accuracy of the exact ones, merged or not
+        """
+        values = [0] * 10 + [random.expovariate(1e-4) for _ in xrange(5000)]
+        exact = sorted(values)
+        sketch = QuantileSketch()
+        halves = QuantileSketch(), QuantileSketch()
+        for i, value in enumerate(values):
+            sketch.add(value)
+            halves[i % 2].add(value)
+        merged = QuantileSketch()
+        for half in halves:
+            merged.merge(half)
+        restored = QuantileSketch.from_list(sketch.to_list())
+
+        for s in [sketch, merged, restored]:
+            self.assertEqual(s.count, len(values))
+            self.assertAlmostEqual(s.sum, sum(values), places=3)
+            self.assertEqual((s.min, s.max), (exact[0], exact[-1]))
+            for q in [0.001, 0.25, 0.5, 0.95, 0.99, 1]:
+                expected = exact[max(int(round(q * len(values) - 1)), 0)]
+                self.assertLessEqual(abs(s.quantile(q) - expected), 0.01 * expected + 1e-9)
+
+        # Ages sketched at an earlier scan are shifted to the current time
+        shifted = QuantileSketch()
+        shifted.merge(sketch, offset=60)
+        self.assertEqual((shifted.min, shifted.max), (exact[0] + 60, exact[-1] + 60))
+        self.assertAlmostEqual(shifted.sum, sum(values) + 60 * len(values), places=3)
+        for q in [0.001, 0.5, 0.95]:
+            expected = exact[max(int(round(q * len(values) - 1)), 0)] + 60
+            self.assertLessEqual(abs(shifted.quantile(q) - expected), 0.02 * expected)
+
+    def test_file_distributions(self):
+        """
+        File distributions are reported with the aggregates of agent histograms
+        """
+        for i, size in enumerate([100, 200, 300]):
+            with open(self.temp_dir + "/log_%s.log" % (i + 1), 'w') as f:
+                f.write("a" * size)
+        dir_tags = ["name:%s" % self.temp_dir]
+
+        for incremental in [False, True]:
+            config = {'instances': [{'directory': self.temp_dir, 'pattern': "*.log", 'incremental': incremental}]}
+            self.run_check(config, force_reload=True)
+            self.assertMetric("system.disk.directory.file.bytes.count", tags=dir_tags, count=1, value=3)
+            self.assertMetric("system.disk.directory.file.bytes.max", tags=dir_tags, count=1, value=300)
+            self.assertMetric("system.disk.directory.file.bytes.avg", tags=dir_tags, count=1, value=200)
+            for m in self.metrics:
+                if m[0] in ["system.disk.directory.file.bytes.median",
+                            "system.disk.directory.file.bytes.95percentile"]:
+                    expected = 200 if m[0].endswith("median") else 300
+                    self.assertLessEqual(abs(m[2] - expected), 0.01 * expected)
+
+    def _age_directories(self):
+        """
+        Directories modified within the last seconds are always scanned again
+        """
+        old = time.time() - 60
+        for root in [self.temp_dir, self.temp_dir + "/subfolder"]:
+            os.utime(root, (old, old))
+
+    def test_incremental_scan(self):
+        """
+        Only the directories that changed are scanned again, the files of the other ones come from the index
+        """
+        instance = {
+            'directory': self.temp_dir,
+            'recursive': True,
+            'incremental': True,
+        }
+        config = {'instances': [instance]}
+        dir_tags = ["name:%s" % self.temp_dir]
+        self._age_directories()
+
+        self.load_check(config)
+        with mock.patch('_directory.scandir', side_effect=scandir) as mock_scandir:
+            self.run_check(config)
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=17)
+            self.assertMetric("system.disk.directory.file.bytes.count", tags=dir_tags, count=1, value=17)
+            self.assertEqual(mock_scandir.call_count, 2)
+
+            # Nothing changed
+            mock_scandir.reset_mock()
+            self.run_check(config)
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=17)
+            self.assertMetric("system.disk.directory.file.bytes.count", tags=dir_tags, count=1, value=17)
+            self.assertEqual(mock_scandir.call_count, 0)
+
+            # Only the subfolder changed
+            with open(self.temp_dir + "/subfolder/file_5", 'w') as f:
+                f.write("abc")
+            mock_scandir.reset_mock()
+            self.run_check(config)
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=18)
+            self.assertMetric("system.disk.directory.bytes", tags=dir_tags, count=1, value=3)
+            mock_scandir.assert_called_once_with(self.temp_dir + "/subfolder")
+
+            # The index is persisted across agent restarts
+            self._age_directories()
+            self.run_check(config)
+            mock_scandir.reset_mock()
+            self.check = self.check.__class__(self.CHECK_NAME, {}, {}, config['instances'])
+            self.run_check(config)
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=18)
+            self.assertEqual(mock_scandir.call_count, 0)
+
+            # Removed directories are dropped from the index
+            shutil.rmtree(self.temp_dir + "/subfolder")
+            self.run_check(config)
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=12)
+
+            # Full scans refresh everything
+            instance['full_scan_interval'] = 0
+            mock_scandir.reset_mock()
+            self.run_check(config)
+            self.assertEqual(mock_scandir.call_count, 1)
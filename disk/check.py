@@ -1,6 +1,10 @@
 # stdlib
+from collections import namedtuple
 import os
+from Queue import Empty, Queue
 import re
+import threading
+import time
 
 # 3p
 try:
@@ -18,6 +22,28 @@ from utils.timeout import (
     TimeoutException,
 )
 
+# Same fields as psutil.disk_usage, computed from the statvfs result we need anyway for inodes
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free', 'percent'])
+
+# Mountpoints are probed concurrently by a few worker threads, with one deadline per run
+DEFAULT_PROBE_WORKERS = 4
+DEFAULT_PROBE_TIMEOUT = 5
+# Mountpoints that didn't answer before the deadline are skipped for this many seconds
+DEFAULT_PROBE_BACKOFF = 300
+
+
+def disk_usage_from_statvfs(st):
+    """
+    Disk usage of a mountpoint from its statvfs result, the same way psutil.disk_usage computes it
+    """
+    total = st.f_blocks * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    used = total - st.f_bfree * st.f_frsize
+    # Like df, the percentage of the space available to non-root users
+    total_user = used + free
+    percent = round(used * 100.0 / total_user, 1) if total_user else 0
+    return DiskUsage(total, used, free, percent)
+
 
 class Disk(AgentCheck):
     """ Collects metrics about the machine's disks. """
@@ -57,6 +83,11 @@ class Disk(AgentCheck):
             instance.get('tag_by_filesystem', False))
         self._all_partitions = _is_affirmative(
             instance.get('all_partitions', False))
+        self._probe_workers = int(instance.get('probe_workers', DEFAULT_PROBE_WORKERS))
+        self._probe_timeout = float(instance.get('probe_timeout', DEFAULT_PROBE_TIMEOUT))
+        self._probe_backoff = float(instance.get('probe_backoff', DEFAULT_PROBE_BACKOFF))
+        # mountpoint -> (time to probe it again, event set once its hung probe returned)
+        self._hung_mountpoints = {}
 
         # Force exclusion of CDROM (iso9660) from disk check
         self._excluded_filesystems.append('iso9660')
@@ -84,23 +115,12 @@ class Disk(AgentCheck):
 
     def collect_metrics_psutil(self):
         self._valid_disks = {}
-        for part in psutil.disk_partitions(all=True):
-            # we check all exclude conditions
-            if self._exclude_disk_psutil(part):
-                continue
+        parts = [part for part in psutil.disk_partitions(all=True)
+                 # we check all exclude conditions
+                 if not self._exclude_disk_psutil(part)]
 
-            # Get disk metrics here to be able to exclude on total usage
-            try:
-                disk_usage = timeout(5)(psutil.disk_usage)(part.mountpoint)
-            except TimeoutException:
-                self.log.warn(
-                    u"Timeout while retrieving the disk usage of `%s` mountpoint. Skipping...",
-                    part.mountpoint
-                )
-                continue
-            except Exception as e:
-                self.log.warn("Unable to get disk metrics for %s: %s", part.mountpoint, e)
-                continue
+        # Get disk metrics here to be able to exclude on total usage
+        for part, disk_usage, statvfs in self._probe_mountpoints(parts):
             # Exclude disks with total disk size 0
             if disk_usage.total == 0:
                 continue
@@ -114,13 +134,99 @@ class Disk(AgentCheck):
             # legacy check names c: vs psutil name C:\\
             if Platform.is_win32():
                 device_name = device_name.strip('\\').lower()
-            for metric_name, metric_value in self._collect_part_metrics(part, disk_usage).iteritems():
+            for metric_name, metric_value in self._collect_part_metrics(disk_usage, statvfs).iteritems():
                 self.gauge(metric_name, metric_value,
                            tags=tags, device_name=device_name)
         # And finally, latency metrics, a legacy gift from the old Windows Check
         if Platform.is_win32():
             self.collect_latency_metrics()
 
+    def _probe_mountpoints(self, parts):
+        """
+        Probe the mountpoints of the partitions with a few worker threads and one deadline
+        for the whole run, so hanging mountpoints (e.g. unreachable NFS servers) don't add up.
+        Return the (part, disk usage, statvfs result) of the mountpoints that answered in time.
+
+        A probe stuck in the kernel can't be interrupted: its mountpoint is skipped until its
+        backoff expires and the stuck probe returned, so we never pile up threads on it.
+        """
+        now = time.time()
+        queue = Queue()
+        for part in parts:
+            hung = self._hung_mountpoints.get(part.mountpoint)
+            if hung is not None:
+                retry_at, probe_done = hung
+                if retry_at > now or not probe_done.is_set():
+                    self.log.debug(u"Skipping the `%s` mountpoint, it didn't answer in time recently", part.mountpoint)
+                    continue
+                del self._hung_mountpoints[part.mountpoint]
+            queue.put(part)
+
+        # Shared with the workers, they may outlive the run when a probe hangs
+        probing = {}
+        results = {}
+        deadline_reached = threading.Event()
+
+        def probe_worker():
+            while not deadline_reached.is_set():
+                try:
+                    part = queue.get_nowait()
+                except Empty:
+                    return
+                if deadline_reached.is_set():
+                    # Dequeued too late, the run is over: leave it for the next one
+                    return
+                probe_done = threading.Event()
+                probing[part.mountpoint] = (time.time(), probe_done)
+                try:
+                    results[part.mountpoint] = self._probe_mountpoint(part.mountpoint)
+                except Exception as e:
+                    results[part.mountpoint] = e
+                finally:
+                    probe_done.set()
+
+        workers = []
+        for _ in xrange(min(self._probe_workers, queue.qsize())):
+            worker = threading.Thread(target=probe_worker, name='disk-probe')
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        deadline = now + self._probe_timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+        deadline_reached.set()
+
+        probed = []
+        for part in parts:
+            mountpoint = part.mountpoint
+            result = results.get(mountpoint)
+            if result is None:
+                probe_started, probe_done = probing.get(mountpoint, (None, None))
+                # Only a probe that had time to answer before the deadline is deemed hung
+                if probe_started is not None and probe_started < deadline:
+                    self.log.warn(
+                        u"Timeout while retrieving the disk usage of `%s` mountpoint. Skipping it for %ss...",
+                        mountpoint, self._probe_backoff
+                    )
+                    self._hung_mountpoints[mountpoint] = (time.time() + self._probe_backoff, probe_done)
+                elif mountpoint not in self._hung_mountpoints:
+                    self.log.warn(u"No time left to retrieve the disk usage of `%s` mountpoint. Skipping...", mountpoint)
+            elif isinstance(result, Exception):
+                self.log.warn("Unable to get disk metrics for %s: %s", mountpoint, result)
+            else:
+                probed.append((part,) + result)
+        return probed
+
+    def _probe_mountpoint(self, mountpoint):
+        """
+        Disk usage and statvfs result (None where there's no statvfs) of a mountpoint
+        """
+        if not Platform.is_unix():
+            return psutil.disk_usage(mountpoint), None
+        statvfs = os.statvfs(mountpoint)
+        return disk_usage_from_statvfs(statvfs), statvfs
+
     def _exclude_disk_psutil(self, part):
         # skip cd-rom drives with no disk in it; they may raise
         # ENOENT, pop-up a Windows GUI error for a non-ready
@@ -155,15 +261,15 @@ class Disk(AgentCheck):
         else:
             return False
 
-    def _collect_part_metrics(self, part, usage):
+    def _collect_part_metrics(self, usage, statvfs=None):
         metrics = {}
         for name in ['total', 'used', 'free']:
             # For legacy reasons,  the standard unit it kB
             metrics[self.METRIC_DISK.format(name)] = getattr(usage, name) / 1024.0
         # FIXME: 6.x, use percent, a lot more logical than in_use
         metrics[self.METRIC_DISK.format('in_use')] = usage.percent / 100.0
-        if Platform.is_unix():
-            metrics.update(self._collect_inodes_metrics(part.mountpoint))
+        if statvfs is not None:
+            metrics.update(self._inodes_metrics(statvfs))
 
         return metrics
 
@@ -182,6 +288,10 @@ class Disk(AgentCheck):
             self.log.warn("Unable to get disk metrics for %s: %s", mountpoint, e)
             return metrics
 
+        return self._inodes_metrics(inodes)
+
+    def _inodes_metrics(self, inodes):
+        metrics = {}
         if inodes.f_files != 0:
             total = inodes.f_files
             free = inodes.f_ffree
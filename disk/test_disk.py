@@ -4,7 +4,10 @@
 
 # stdlib
 import os
+from Queue import Queue
 import re
+import sys
+import threading
 
 # 3p
 import mock
@@ -34,6 +37,11 @@ class MockDiskMetrics(object):
 
 class MockInodesMetrics(object):
     def __init__(self):
+        # statvfs result, the disk usage is computed from it too
+        self.f_frsize = 1024
+        self.f_blocks = 5
+        self.f_bfree = 1
+        self.f_bavail = 1
         self.f_files = 10
         self.f_ffree = 9
 
@@ -266,3 +274,84 @@ class TestCheckDisk(AgentCheckTest):
         self.load_check({'instances': [{}]}, agent_config={'device_blacklist_re': ''})
         self.check._load_conf({})
         self.assertEqual(self.check._excluded_disk_re, re.compile('^$'))
+
+    @mock.patch('psutil.disk_partitions',
+                return_value=[MockPart(), MockPart(device='nfs:/export', fstype='nfs', mountpoint='/mnt/nfs')])
+    def test_hung_mountpoint_backoff(self, mock_partitions):
+        nfs_answers = threading.Event()
+        probed = []
+
+        def statvfs(mountpoint):
+            probed.append(mountpoint)
+            if mountpoint == '/mnt/nfs':
+                nfs_answers.wait()
+            return MockInodesMetrics()
+
+        config = {'instances': [{'use_mount': 'yes', 'probe_timeout': 0.5, 'probe_backoff': 60}]}
+        with mock.patch('os.statvfs', side_effect=statvfs):
+            # The hung mountpoint doesn't block the other ones
+            self.run_check(config, force_reload=True)
+            for metric, value in self.GAUGES_VALUES.iteritems():
+                self.assertMetric(metric, value=value, tags=[], device_name='/')
+            self.assertEqual(len([m for m in self.metrics if m[3]['device_name'] == '/mnt/nfs']), 0)
+
+            # Then it's skipped for its backoff, even once it answers
+            self.run_check(config)
+            nfs_answers.set()
+            self.run_check(config)
+            self.assertEqual(probed.count('/mnt/nfs'), 1)
+            self.assertEqual(len([m for m in self.metrics if m[3]['device_name'] == '/mnt/nfs']), 0)
+
+            # And probed again once the backoff expired
+            retry_at, probe_done = self.check._hung_mountpoints['/mnt/nfs']
+            self.check._hung_mountpoints['/mnt/nfs'] = (0, probe_done)
+            self.run_check(config)
+            self.assertEqual(probed.count('/mnt/nfs'), 2)
+            self.assertMetric('system.disk.total', value=5, tags=[], device_name='/mnt/nfs')
+            self.assertNotIn('/mnt/nfs', self.check._hung_mountpoints)
+
+    @mock.patch('psutil.disk_partitions', return_value=[MockPart(device='nfs:/export', fstype='nfs', mountpoint='/mnt/nfs')])
+    def test_mountpoint_dequeued_after_deadline(self, mock_partitions):
+        nfs_answers = threading.Event()
+        probe_registered = threading.Event()
+        events = []
+        probed = []
+
+        class RunEvent(threading._Event):
+            def __init__(self):
+                super(RunEvent, self).__init__()
+                if threading.current_thread().name == 'disk-probe':
+                    probe_registered.set()
+                events.append(self)
+
+            def set(self):
+                super(RunEvent, self).set()
+                if self is events[0]:
+                    # Give a late worker the time to start its probe before the results are read
+                    probe_registered.wait(1)
+
+        class LateQueue(Queue):
+            def get_nowait(self):
+                # The worker only dequeues its part once the deadline is reached
+                events[0].wait()
+                return Queue.get_nowait(self)
+
+        def statvfs(mountpoint):
+            probed.append(mountpoint)
+            nfs_answers.wait()
+            return MockInodesMetrics()
+
+        config = {'instances': [{'use_mount': 'yes', 'probe_timeout': 0.1, 'probe_backoff': 60}]}
+        self.load_check(config)
+        check_module = sys.modules[self.check.__module__]
+        try:
+            with mock.patch('os.statvfs', side_effect=statvfs), \
+                    mock.patch.object(check_module, 'Queue', LateQueue), \
+                    mock.patch('threading.Event', RunEvent):
+                self.run_check(config)
+        finally:
+            nfs_answers.set()
+
+        # The mountpoint wasn't probed and isn't backed off, it's just left for the next run
+        self.assertEqual(probed, [])
+        self.assertNotIn('/mnt/nfs', self.check._hung_mountpoints)
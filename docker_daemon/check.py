@@ -1,13 +1,20 @@
 # stdlib
+import io
 import os
 import re
 import socket
+import threading
 import urllib2
-from collections import defaultdict, Counter, deque
+from collections import defaultdict, Counter, deque, OrderedDict
 from math import ceil
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # project
 from checks import AgentCheck
+from checks.libs.thread_pool import Pool
 from config import _is_affirmative
 from utils.dockerutil import (DockerUtil,
                               MountException,
@@ -20,6 +27,7 @@ from utils.kubernetes import KubeUtil
 from utils.platform import Platform
 from utils.service_discovery.sd_backend import get_sd_backend
 from utils.orchestrator import MetadataCollector
+from utils.timer import Timer
 
 
 EVENT_TYPE = 'docker'
@@ -27,6 +35,12 @@ SERVICE_CHECK_NAME = 'docker.service_up'
 HEALTHCHECK_SERVICE_CHECK_NAME = 'docker.container_health'
 EXIT_SERVICE_CHECK_NAME = 'docker.exit'
 SIZE_REFRESH_RATE = 5  # Collect container sizes every 5 iterations of the check
+DEFAULT_COLLECTION_WORKERS = 4  # Workers inspecting containers and reading their stats
+# Share of the open files limit the stat files kept open between runs may use,
+# the rest is left to the sockets and files of the agent and the other checks.
+# The soft limit is raised up to the hard limit first.
+STAT_FILES_NOFILE_SHARE = 0.25
+DEFAULT_NOFILE_LIMIT = 1024
 CONTAINER_ID_RE = re.compile('[0-9a-f]{64}')
 
 DISK_STATS_RE = re.compile('([0-9.]+)\s?([a-zA-Z]+)')
@@ -97,6 +111,25 @@ CGROUP_METRICS = [
     },
 ]
 
+
+def get_cgroup_file_keys(cgroup_metrics):
+    """Keys collected from each cgroup stat file, by file name."""
+    file_keys = {}
+    for cgroup in cgroup_metrics:
+        keys = file_keys.setdefault(cgroup['file'], set())
+        keys.update(cgroup['metrics'])
+        for key_list, _, _ in cgroup.get('to_compute', {}).itervalues():
+            keys.update(key_list)
+    return file_keys
+
+# The other keys of the cgroup stat files aren't kept when parsing them
+CGROUP_FILE_KEYS = get_cgroup_file_keys(CGROUP_METRICS)
+
+# Initial size of the buffer stat files are read into, it grows for bigger files
+STAT_BUFFER_SIZE = 4096
+
+NET_DEV_FILE = 'net/dev'
+
 DEFAULT_CONTAINER_TAGS = [
     "docker_image",
     "image_name",
@@ -144,6 +177,9 @@ IMAGE = "image"
 
 ERROR_ALERT_TYPE = ['oom', 'kill']
 
+# Container events after which the pid of a container must be resolved again
+PID_INVALIDATION_EVENTS = ['start', 'die']
+
 def compile_filter_rules(rules):
     patterns = []
     tag_names = []
@@ -165,6 +201,7 @@ class DockerDaemon(AgentCheck):
                             agentConfig, instances=instances)
 
         self.init_success = False
+        self._pool = None
         self._service_discovery = agentConfig.get('service_discovery') and \
             agentConfig.get('service_discovery_backend') == 'docker'
         self.init()
@@ -216,6 +253,33 @@ class DockerDaemon(AgentCheck):
             # Container network mapping cache
             self.network_mappings = {}
 
+            # Container pid index (container id -> pid), resolved from the Docker API
+            # or the /proc crawl. Kept across runs and invalidated by start/die events
+            self._container_pids = {}
+
+            # Stat files of the containers: container id -> (pid, {file name: path})
+            # Their paths are resolved once per container pid and they are kept open
+            # between runs, in `_stat_files` (path -> file), to be re-read from offset 0.
+            # That's a LRU capped below the open files limit, the least recently read
+            # files are closed and reopened at their next read. The files are read in the
+            # same order every run, so when they don't all fit in the LRU every read would
+            # miss it: they are then closed right after being read instead.
+            self._container_stat_files = {}
+            self._stat_files = OrderedDict()
+            self._stat_files_lock = threading.Lock()
+            self._max_open_stat_files = self._get_max_open_stat_files()
+            self._keep_stat_files_open = True
+            # Stat files read during the current run
+            self._stat_files_read = 0
+            # Stat files are read by the collection workers, each one with its own buffer
+            self._local = threading.local()
+
+            # Bounded pool of workers inspecting containers and collecting their stats,
+            # the results are submitted from the check thread
+            self.collection_workers = int(instance.get('collection_workers', DEFAULT_COLLECTION_WORKERS))
+            if self.collection_workers > 1 and self._pool is None:
+                self._pool = Pool(self.collection_workers)
+
             # get the health check whitelist
             self.whitelist_patterns = None
             health_scs_whitelist = instance.get('health_service_check_whitelist', [])
@@ -245,6 +309,21 @@ class DockerDaemon(AgentCheck):
         else:
             self.init_success = True
 
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _map(self, func, items):
+        """Apply `func` to each item, concurrently if the check has collection workers."""
+        if self._pool is None or len(items) < 2:
+            return map(func, items)
+        return self._pool.map(func, items)
+
+    def _submit_stage_time(self, stage, timer):
+        self.gauge('stackstate.agent.docker_daemon.{0}.time'.format(stage), timer.total(), tags=self.custom_tags)
+
     def check(self, instance):
         """Run the Docker check for one instance."""
         if not self.init_success:
@@ -284,15 +363,26 @@ class DockerDaemon(AgentCheck):
 
             # Get the list of containers and the index of their names
             health_service_checks = True if self.whitelist_patterns else False
-            containers_by_id = self._get_and_count_containers(custom_cgroups, health_service_checks)
+            t = Timer()
+            containers_by_id = self._get_and_count_containers(health_service_checks)
+            self._submit_stage_time('containers', t)
+
+            t = Timer()
             containers_by_id = self._crawl_container_pids(containers_by_id, custom_cgroups)
+            self._submit_stage_time('container_pids', t)
 
             # Send events from Docker API
             if self.collect_events or self._service_discovery or not self._disable_net_metrics or self.collect_exit_codes:
+                t = Timer()
                 self._process_events(containers_by_id)
+                self._submit_stage_time('events', t)
 
             # Report performance container metrics (cpu, mem, net, io)
+            t = Timer()
+            self._stat_files_read = 0
             self._report_performance_metrics(containers_by_id)
+            self._update_keep_stat_files_open()
+            self._submit_stage_time('performance_metrics', t)
 
             if self.collect_container_size:
                 self._report_container_size(containers_by_id)
@@ -332,7 +422,7 @@ class DockerDaemon(AgentCheck):
             # It's not an important metric, keep going if it fails
             self.warning("Failed to count Docker images. Exception: {0}".format(e))
 
-    def _get_and_count_containers(self, custom_cgroups=False, healthchecks=False):
+    def _get_and_count_containers(self, healthchecks=False):
         """List all the containers from the API, filter and count them."""
 
         # Querying the size of containers is slow, we don't do it at each run
@@ -358,6 +448,7 @@ class DockerDaemon(AgentCheck):
         self._filter_containers(containers)
 
         containers_by_id = {}
+        containers_to_inspect = []
 
         for container in containers:
             container_name = DockerUtil.container_name_extractor(container)[0]
@@ -373,17 +464,33 @@ class DockerDaemon(AgentCheck):
                 self.log.debug("Container {0} is excluded".format(container_name))
                 continue
 
-            containers_by_id[container['Id']] = container
-
-            # grab pid via API if custom cgroups - otherwise we won't find process when
-            # crawling for pids.
-            if custom_cgroups or healthchecks:
-                try:
-                    inspect_dict = self.docker_util.client.inspect_container(container_name)
-                    container['_pid'] = inspect_dict['State']['Pid']
-                    container['health'] = inspect_dict['State'].get('Health', {})
-                except Exception as e:
-                    self.log.debug("Unable to inspect Docker container: %s", e)
+            container_id = container['Id']
+            containers_by_id[container_id] = container
+
+            # Grab the pid via the API, it spares a /proc crawl and is the only way to
+            # match containers running with custom cgroups. Pids are indexed across runs
+            # so running containers are only inspected once, unless we need their health.
+            is_running = self._is_container_running(container)
+            if not is_running:
+                self._container_pids.pop(container_id, None)
+            if healthchecks or (is_running and container_id not in self._container_pids):
+                containers_to_inspect.append(container)
+
+        for container, inspect_dict in self._map(self._inspect_container, containers_to_inspect):
+            if inspect_dict is not None:
+                container['health'] = inspect_dict['State'].get('Health', {})
+                pid = inspect_dict['State']['Pid']
+                if self._is_container_running(container) and pid:
+                    self._container_pids[container['Id']] = pid
+
+        for container_id, container in containers_by_id.iteritems():
+            if container_id in self._container_pids:
+                container['_pid'] = self._container_pids[container_id]
+
+        # Forget about the pids of containers that are gone
+        listed_ids = set(container['Id'] for container in containers)
+        for container_id in set(self._container_pids).difference(listed_ids):
+            self._container_pids.pop(container_id, None)
 
         # TODO: deprecate these 2, they should be replaced by _report_container_count
         for tags, count in running_containers_count.iteritems():
@@ -395,6 +502,14 @@ class DockerDaemon(AgentCheck):
 
         return containers_by_id
 
+    def _inspect_container(self, container):
+        """Inspect a container, run by the collection workers."""
+        try:
+            return container, self.docker_util.client.inspect_container(DockerUtil.container_name_extractor(container)[0])
+        except Exception as e:
+            self.log.debug("Unable to inspect Docker container: %s", e)
+            return container, None
+
     def _is_container_running(self, container):
         """Tell if a container is running, according to its status.
 
@@ -614,20 +729,27 @@ class DockerDaemon(AgentCheck):
     def _report_performance_metrics(self, containers_by_id):
 
         containers_without_proc_root = []
+        reported_containers = []
         for container in containers_by_id.itervalues():
             if self._is_container_excluded(container) or not self._is_container_running(container):
                 continue
 
-            tags = self._get_tags(container, PERFORMANCE)
+            reported_containers.append((container, self._get_tags(container, PERFORMANCE)))
 
-            try:
-                self._report_cgroup_metrics(container, tags)
-                if "_proc_root" not in container:
-                    containers_without_proc_root.append(DockerUtil.container_name_extractor(container)[0])
-                    continue
-                self._report_net_metrics(container, tags)
-            except BogusPIDException as e:
-                self.log.warning('Unable to report cgroup metrics: %s', e)
+        # Stats are collected by the workers, the metrics are submitted from the check thread
+        for container, samples in self._map(self._collect_performance_metrics, reported_containers):
+            if samples is None:
+                continue
+            for metric_func, mname, value, tags in samples:
+                metric_func(self, mname, value, tags=tags)
+            if "_proc_root" not in container:
+                containers_without_proc_root.append(DockerUtil.container_name_extractor(container)[0])
+
+        # Close the stat files of the containers that are gone
+        reported_container_ids = set(container['Id'] for container, _ in reported_containers)
+        for container_id in set(self._container_stat_files).difference(reported_container_ids):
+            _, stat_files = self._container_stat_files.pop(container_id)
+            self._close_stat_files(stat_files.itervalues())
 
         if containers_without_proc_root:
             message = "Couldn't find pid directory for containers: {0}. They'll be missing network metrics".format(
@@ -638,14 +760,35 @@ class DockerDaemon(AgentCheck):
                 # On kubernetes, this is kind of expected. Network metrics will be collected by the kubernetes integration anyway
                 self.log.debug(message)
 
-    def _report_cgroup_metrics(self, container, tags):
+    def _collect_performance_metrics(self, job):
+        """Collect the cgroup and network metrics of a container, run by the collection workers.
+
+        Return the container and its list of (metric function, name, value, tags) samples,
+        None if the container pid is bogus.
+        """
+        container, tags = job
+        samples = []
+        try:
+            self._collect_cgroup_metrics(container, tags, samples)
+            if "_proc_root" in container:
+                self._collect_net_metrics(container, tags, samples)
+        except BogusPIDException as e:
+            self.log.warning('Unable to report cgroup metrics: %s', e)
+            return container, None
+        return container, samples
+
+    def _collect_cgroup_metrics(self, container, tags, samples):
         cgroup_stat_file_failures = 0
         if not container.get('_pid'):
             raise BogusPIDException('Cannot report on bogus pid(0)')
 
+        stat_files = self._get_container_stat_files(container)
         for cgroup in CGROUP_METRICS:
             try:
-                stat_file = self._get_cgroup_from_proc(cgroup["cgroup"], container['_pid'], cgroup['file'])
+                stat_file = stat_files.get(cgroup['file'])
+                if stat_file is None:
+                    stat_file = self._get_cgroup_from_proc(cgroup["cgroup"], container['_pid'], cgroup['file'])
+                    stat_files[cgroup['file']] = stat_file
             except MountException as e:
                 # We can't find a stat file
                 self.warning(str(e))
@@ -660,7 +803,7 @@ class DockerDaemon(AgentCheck):
                     for key, (dd_key, metric_func) in cgroup['metrics'].iteritems():
                         metric_func = FUNC_MAP[metric_func][self.use_histogram]
                         if key in stats:
-                            metric_func(self, dd_key, int(stats[key]), tags=tags)
+                            samples.append((metric_func, dd_key, int(stats[key]), tags))
 
                     # Computed metrics
                     for mname, (key_list, fct, metric_func) in cgroup.get('to_compute', {}).iteritems():
@@ -671,15 +814,16 @@ class DockerDaemon(AgentCheck):
                         value = fct(*values)
                         metric_func = FUNC_MAP[metric_func][self.use_histogram]
                         if value is not None:
-                            metric_func(self, mname, value, tags=tags)
+                            samples.append((metric_func, mname, value, tags))
 
-    def _report_net_metrics(self, container, tags):
+    def _collect_net_metrics(self, container, tags, samples):
         """Find container network metrics by looking at /proc/$PID/net/dev of the container process."""
         if self._disable_net_metrics:
             self.log.debug("Network metrics are disabled. Skipping")
             return
 
-        proc_net_file = os.path.join(container['_proc_root'], 'net/dev')
+        proc_net_file = os.path.join(container['_proc_root'], NET_DEV_FILE)
+        self._get_container_stat_files(container)[NET_DEV_FILE] = proc_net_file
 
         try:
             if container['Id'] in self.network_mappings:
@@ -697,21 +841,20 @@ class DockerDaemon(AgentCheck):
             self.network_mappings[container['Id']] = networks
 
         try:
-            with open(proc_net_file, 'r') as fp:
-                lines = fp.readlines()
-                """Two first lines are headers:
-                Inter-|   Receive                                                |  Transmit
-                 face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
-                """
-                for l in lines[2:]:
-                    cols = l.split(':', 1)
-                    interface_name = str(cols[0]).strip()
-                    if interface_name in networks:
-                        net_tags = tags + ['docker_network:'+networks[interface_name]]
-                        x = cols[1].split()
-                        m_func = FUNC_MAP[RATE][self.use_histogram]
-                        m_func(self, "docker.net.bytes_rcvd", long(x[0]), net_tags)
-                        m_func(self, "docker.net.bytes_sent", long(x[8]), net_tags)
+            lines = self._read_stat_file(proc_net_file).splitlines()
+            """Two first lines are headers:
+            Inter-|   Receive                                                |  Transmit
+             face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+            """
+            m_func = FUNC_MAP[RATE][self.use_histogram]
+            for l in lines[2:]:
+                interface_name, _, counters = l.partition(':')
+                interface_name = interface_name.strip()
+                if interface_name in networks:
+                    net_tags = tags + ['docker_network:'+networks[interface_name]]
+                    x = counters.split()
+                    samples.append((m_func, "docker.net.bytes_rcvd", long(x[0]), net_tags))
+                    samples.append((m_func, "docker.net.bytes_sent", long(x[8]), net_tags))
 
         except Exception as e:
             # It is possible that the container got stopped between the API call and now
@@ -728,6 +871,12 @@ class DockerDaemon(AgentCheck):
             except Exception:
                 self.log.warning('Malformed network event: %s' % str(ev))
 
+    def _invalidate_container_pid_cache(self, api_events):
+        for ev in api_events:
+            if ev.get('status') in PID_INVALIDATION_EVENTS and ev.get('id') in self._container_pids:
+                self.log.debug("Removing pid cache for container %s" % ev['id'])
+                del self._container_pids[ev['id']]
+
     def _process_events(self, containers_by_id):
         api_events = self._get_events()
 
@@ -755,6 +904,7 @@ class DockerDaemon(AgentCheck):
         events, changed_container_ids = self.docker_util.get_events()
         if not self._disable_net_metrics:
             self._invalidate_network_mapping_cache(events)
+        self._invalidate_container_pid_cache(events)
         if changed_container_ids and self._service_discovery:
             get_sd_backend(self.agentConfig).update_checks(changed_container_ids)
         if changed_container_ids:
@@ -974,17 +1124,120 @@ class DockerDaemon(AgentCheck):
         }
         return DockerUtil.find_cgroup_from_proc(self._mountpoints, pid, cgroup, self.docker_util._docker_root) % (params)
 
+    def _get_container_stat_files(self, container):
+        """Paths of the stat files of a container, by file name. Reset when its pid changes."""
+        pid = str(container['_pid'])
+        cached_pid, stat_files = self._container_stat_files.get(container['Id'], (None, None))
+        if cached_pid != pid:
+            if stat_files:
+                self._close_stat_files(stat_files.itervalues())
+            stat_files = {}
+            self._container_stat_files[container['Id']] = (pid, stat_files)
+        return stat_files
+
+    def _get_max_open_stat_files(self):
+        """
+        How many stat files may be kept open between runs, from the open files limit,
+        whose soft limit is raised up to the hard limit.
+        """
+        limit = DEFAULT_NOFILE_LIMIT
+        if resource is not None:
+            soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft_limit != resource.RLIM_INFINITY and hard_limit != resource.RLIM_INFINITY and \
+                    soft_limit < hard_limit:
+                try:
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+                    soft_limit = hard_limit
+                except (ValueError, OSError) as e:
+                    self.log.debug("Unable to raise the open files limit to %s: %s", hard_limit, e)
+            if 0 < soft_limit != resource.RLIM_INFINITY:
+                limit = soft_limit
+        return int(limit * STAT_FILES_NOFILE_SHARE)
+
+    def _update_keep_stat_files_open(self):
+        """Keep the stat files open between runs only if all the ones read during the run fit in the LRU."""
+        keep_open = self._stat_files_read <= self._max_open_stat_files
+        if keep_open != self._keep_stat_files_open:
+            self.log.info("%s the stat files open between runs, %s files read for a limit of %s",
+                          "Keeping" if keep_open else "No longer keeping",
+                          self._stat_files_read, self._max_open_stat_files)
+            self._keep_stat_files_open = keep_open
+        if not keep_open:
+            self._close_stat_files(list(self._stat_files))
+
+    def _read_stat_file(self, path):
+        """Read a whole pseudo file, keeping it open to re-read it from offset 0 at the next run."""
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = self._local.buffer = bytearray(STAT_BUFFER_SIZE)
+        # Taken out of the LRU while it's read, so that other workers can't close it
+        with self._stat_files_lock:
+            f = self._stat_files.pop(path, None)
+            self._stat_files_read += 1
+        try:
+            if f is None:
+                f = io.FileIO(path)
+            else:
+                f.seek(0)
+            size = 0
+            while True:
+                if size == len(buf):
+                    buf.extend(bytearray(len(buf)))
+                read = f.readinto(memoryview(buf)[size:])
+                if not read:
+                    break
+                size += read
+        except (IOError, OSError) as e:
+            # The file has likely gone with its container, it's reopened at the next read
+            if f is not None:
+                self._close_stat_file(f)
+            raise IOError(e.errno, e.strerror, path)
+
+        if not self._keep_stat_files_open:
+            self._close_stat_file(f)
+            return str(buf[:size])
+
+        with self._stat_files_lock:
+            self._stat_files[path] = f
+            evicted = []
+            while len(self._stat_files) > self._max_open_stat_files:
+                evicted.append(self._stat_files.popitem(last=False)[1])
+        for evicted_file in evicted:
+            self._close_stat_file(evicted_file)
+
+        return str(buf[:size])
+
+    def _close_stat_files(self, paths):
+        with self._stat_files_lock:
+            files = [self._stat_files.pop(path, None) for path in paths]
+        for f in files:
+            if f is not None:
+                self._close_stat_file(f)
+
+    @staticmethod
+    def _close_stat_file(f):
+        try:
+            f.close()
+        except (IOError, OSError):
+            pass
+
     def _parse_cgroup_file(self, stat_file):
         """Parse a cgroup pseudo file for key/values."""
-        self.log.debug("Opening cgroup file: %s" % stat_file)
+        self.log.debug("Reading cgroup file: %s" % stat_file)
         try:
-            with open(stat_file, 'r') as fp:
-                if 'blkio' in stat_file:
-                    return self._parse_blkio_metrics(fp.read().splitlines())
-                elif 'cpuacct.usage' in stat_file:
-                    return dict({'usage': str(int(fp.read())/10000000)})
-                else:
-                    return dict(map(lambda x: x.split(' ', 1), fp.read().splitlines()))
+            content = self._read_stat_file(stat_file)
+            if 'blkio' in stat_file:
+                return self._parse_blkio_metrics(content.splitlines())
+            elif 'cpuacct.usage' in stat_file:
+                return dict({'usage': str(int(content)/10000000)})
+            else:
+                keys = CGROUP_FILE_KEYS.get(os.path.basename(stat_file))
+                stats = {}
+                for line in content.splitlines():
+                    key, _, value = line.partition(' ')
+                    if keys is None or key in keys:
+                        stats[key] = value
+                return stats
         except IOError:
             # It is possible that the container got stopped between the API call and now.
             # Some files can also be missing (like cpu.stat) and that's fine.
@@ -1017,9 +1270,42 @@ class DockerDaemon(AgentCheck):
         return False
 
     # proc files
+    def _is_container_proc_root(self, proc_root, container_id, custom_cgroups=False):
+        """Check that a /proc/<pid> directory belongs to the given container."""
+        try:
+            with open(os.path.join(proc_root, 'cgroup'), 'r') as f:
+                content = f.read()
+        except IOError:
+            return False
+        # Containers with custom cgroups can't be matched on their cgroup paths, trust the API
+        return custom_cgroups or container_id in content
+
     def _crawl_container_pids(self, container_dict, custom_cgroups=False):
-        """Crawl `/proc` to find container PIDs and add them to `containers_by_id`."""
+        """Find container PIDs and add them to `containers_by_id`.
+
+        Pids indexed from the Docker API or previous runs are checked and used as is,
+        `/proc` is only crawled for the running containers that are still unresolved.
+        """
         proc_path = os.path.join(self.docker_util._docker_root, 'proc')
+
+        unresolved = {}
+        for container_id, container in container_dict.iteritems():
+            if not self._is_container_running(container):
+                continue
+
+            if container.get('_pid'):
+                proc_root = os.path.join(proc_path, str(container['_pid']))
+                if self._is_container_proc_root(proc_root, container_id, custom_cgroups):
+                    container['_proc_root'] = proc_root
+                    continue
+
+            unresolved[container_id] = container
+
+        if not unresolved:
+            self._disable_net_metrics = False
+            return container_dict
+
+        self.log.debug("Crawling %s to find the pid of %d container(s)", proc_path, len(unresolved))
         pid_dirs = [_dir for _dir in os.listdir(proc_path) if _dir.isdigit()]
 
         if len(pid_dirs) == 0:
@@ -1032,7 +1318,17 @@ class DockerDaemon(AgentCheck):
 
         self._disable_net_metrics = False
 
+        # Custom cgroups are matched by the pid resolved from the API
+        unresolved_by_pid = {}
+        if custom_cgroups:
+            for container_id, container in unresolved.iteritems():
+                if container.get('_pid'):
+                    unresolved_by_pid[str(container['_pid'])] = container_id
+
         for folder in pid_dirs:
+            if not unresolved:
+                break
+
             try:
                 path = os.path.join(proc_path, folder, 'cgroup')
                 with open(path, 'r') as f:
@@ -1061,22 +1357,31 @@ class DockerDaemon(AgentCheck):
                 matches = re.findall(CONTAINER_ID_RE, cpuacct)
                 if matches:
                     container_id = matches[-1]
-                    if container_id not in container_dict:
-                        self.log.debug(
-                            "Container %s not in container_dict, it's likely excluded", container_id
-                        )
+                    if container_id not in unresolved:
+                        if container_id not in container_dict:
+                            self.log.debug(
+                                "Container %s not in container_dict, it's likely excluded", container_id
+                            )
                         continue
-                    container_dict[container_id]['_pid'] = folder
-                    container_dict[container_id]['_proc_root'] = os.path.join(proc_path, folder)
-                elif custom_cgroups:  # if we match by pid that should be enough (?) - O(n) ugh!
-                    for _, container in container_dict.iteritems():
-                        if container.get('_pid') == int(folder):
-                            container['_proc_root'] = os.path.join(proc_path, folder)
-                            break
+                elif folder in unresolved_by_pid:
+                    container_id = unresolved_by_pid[folder]
+                else:
+                    continue
+
+                container = unresolved.pop(container_id)
+                container['_pid'] = folder
+                container['_proc_root'] = os.path.join(proc_path, folder)
+                self._container_pids[container_id] = int(folder)
 
             except Exception, e:
                 self.warning("Cannot parse %s content: %s" % (path, str(e)))
                 continue
+
+        if not custom_cgroups:
+            # Don't report cgroup metrics from a pid that doesn't belong to the container
+            for container in unresolved.itervalues():
+                container.pop('_pid', None)
+
         return container_dict
 
     def filter_capped_metrics(self):
@@ -5,6 +5,10 @@
 # stdlib
 import logging
 import mock
+import os
+import resource
+import shutil
+import tempfile
 
 # 3p
 from docker import Client
@@ -816,6 +820,159 @@ class TestCheckDockerDaemon(AgentCheckTest):
                 expected_tags += tags
             self.assertMetric(mname, tags=expected_tags, count=1, at_least=1)
 
+    def test_container_pid_index(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+            },
+            ],
+        }
+        DockerUtil().set_docker_settings(config['init_config'], config['instances'][0])
+
+        self.run_check(config, force_reload=True)
+        for c in self.containers:
+            pid = self.docker_client.inspect_container(c['Id'])['State']['Pid']
+            self.assertEqual(self.check._container_pids.get(c['Id']), pid)
+
+        # Indexed pids are used as is, /proc is not crawled anymore
+        with mock.patch('os.listdir', side_effect=Exception("/proc should not be crawled")):
+            self.run_check(config)
+        self.assertMetric('docker.mem.rss', tags=['container_name:test-new-redis-latest', 'docker_image:redis:latest',
+                                                 'image_name:redis', 'image_tag:latest'], count=1)
+
+        # Restarted containers get a new pid
+        redis = self.containers[1]
+        self.docker_client.restart(redis)
+        self.run_check(config)
+        pid = self.docker_client.inspect_container(redis['Id'])['State']['Pid']
+        self.assertEqual(self.check._container_pids.get(redis['Id']), pid)
+        self.assertMetric('docker.mem.rss', tags=['container_name:test-new-redis-latest', 'docker_image:redis:latest',
+                                                 'image_name:redis', 'image_tag:latest'], count=1)
+
+    def test_stat_files_kept_open(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+            },
+            ],
+        }
+        DockerUtil().set_docker_settings(config['init_config'], config['instances'][0])
+
+        self.run_check_twice(config, force_reload=True)
+        redis = self.containers[1]
+        _, stat_files = self.check._container_stat_files[redis['Id']]
+        self.assertIn('memory.stat', stat_files)
+        self.assertIn('net/dev', stat_files)
+        for path in stat_files.itervalues():
+            self.assertFalse(self.check._stat_files[path].closed)
+        self.assertMetric('docker.mem.rss', tags=['container_name:test-new-redis-latest', 'docker_image:redis:latest',
+                                                 'image_name:redis', 'image_tag:latest'], count=1)
+        self.assertMetric('docker.net.bytes_rcvd', tags=['container_name:test-new-redis-latest', 'docker_image:redis:latest',
+                                                        'image_name:redis', 'image_tag:latest', 'docker_network:bridge'], count=1)
+
+        # Files of the containers that are gone are closed
+        open_files = [self.check._stat_files[path] for path in stat_files.itervalues()]
+        self.docker_client.stop(redis)
+        self.run_check(config)
+        self.assertNotIn(redis['Id'], self.check._container_stat_files)
+        for f in open_files:
+            self.assertTrue(f.closed)
+
+    def test_stat_files_open_limit(self):
+        config = {
+            "init_config": {},
+            "instances": [{
+                "url": "unix://var/run/docker.sock",
+            },
+            ],
+        }
+        DockerUtil().set_docker_settings(config['init_config'], config['instances'][0])
+        self.run_check(config, force_reload=True)
+
+        # Below the open files limit, raised up to the hard limit
+        with mock.patch('resource.getrlimit', return_value=(1024, 4096)), \
+                mock.patch('resource.setrlimit') as setrlimit:
+            self.assertEqual(self.check._get_max_open_stat_files(), 1024)
+        setrlimit.assert_called_once_with(resource.RLIMIT_NOFILE, (4096, 4096))
+        self.assertTrue(0 < len(self.check._stat_files) <= self.check._max_open_stat_files)
+
+        # The least recently read files are closed past the limit, and reopened when read again
+        self.check._max_open_stat_files = 2
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in range(3):
+                path = os.path.join(tmp_dir, 'stat%d' % i)
+                with open(path, 'w') as f:
+                    f.write('value %d' % i)
+                paths.append(path)
+            open_files = []
+            for path in paths:
+                self.check._read_stat_file(path)
+                open_files.append(self.check._stat_files[path])
+            self.assertEqual(list(self.check._stat_files)[-2:], paths[1:])
+            self.assertNotIn(paths[0], self.check._stat_files)
+            self.assertTrue(open_files[0].closed)
+            self.assertEqual(self.check._read_stat_file(paths[0]), 'value 0')
+            self.assertEqual(list(self.check._stat_files), [paths[2], paths[0]])
+            self.assertTrue(open_files[1].closed)
+
+            # More files read in a run than the LRU fits: every read would miss, they're closed after being read
+            self.check._stat_files_read = 0
+            for path in paths:
+                self.check._read_stat_file(path)
+            self.check._update_keep_stat_files_open()
+            self.assertFalse(self.check._keep_stat_files_open)
+            self.assertEqual(len(self.check._stat_files), 0)
+            self.assertEqual(self.check._read_stat_file(paths[1]), 'value 1')
+            self.assertEqual(len(self.check._stat_files), 0)
+
+            # Kept open again once they fit
+            self.check._stat_files_read = 0
+            for path in paths[:2]:
+                self.check._read_stat_file(path)
+            self.check._update_keep_stat_files_open()
+            self.assertTrue(self.check._keep_stat_files_open)
+            self.check._read_stat_file(paths[0])
+            self.assertEqual(list(self.check._stat_files), [paths[0]])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_collection_workers(self):
+        expected_metrics = [
+            ('docker.mem.rss', ['container_name:test-new-nginx-latest', 'docker_image:nginx:latest', 'image_name:nginx', 'image_tag:latest']),
+            ('docker.mem.rss', ['container_name:test-new-redis-latest', 'docker_image:redis:latest', 'image_name:redis', 'image_tag:latest']),
+            ('docker.cpu.user', ['container_name:test-new-nginx-latest', 'docker_image:nginx:latest', 'image_name:nginx', 'image_tag:latest']),
+            ('docker.cpu.user', ['container_name:test-new-redis-latest', 'docker_image:redis:latest', 'image_name:redis', 'image_tag:latest']),
+            ('docker.net.bytes_rcvd', ['container_name:test-new-redis-latest', 'docker_image:redis:latest', 'image_name:redis',
+                                       'image_tag:latest', 'docker_network:bridge']),
+        ]
+        stages = ['containers', 'container_pids', 'events', 'performance_metrics']
+
+        for workers in [1, 4]:
+            config = {
+                "init_config": {},
+                "instances": [{
+                    "url": "unix://var/run/docker.sock",
+                    "collection_workers": workers,
+                    "health_service_check_whitelist": ["docker_image:nginx", "docker_image:redis"],
+                },
+                ],
+            }
+            DockerUtil().set_docker_settings(config['init_config'], config['instances'][0])
+            DockerUtil().filtering_enabled = False
+
+            self.run_check_twice(config, force_reload=True)
+            self.assertEqual(self.check._pool is not None, workers > 1)
+            for mname, tags in expected_metrics:
+                self.assertMetric(mname, tags=tags, count=1)
+            for stage in stages:
+                self.assertMetric('stackstate.agent.docker_daemon.{0}.time'.format(stage), count=1)
+            self.assertServiceCheck('docker.container_health', count=2)
+            self.check.stop()
+
     def mock_parse_cgroup_file(self, stat_file):
         with open(stat_file, 'r') as fp:
             if 'blkio' in stat_file:
@@ -1,8 +1,10 @@
 # stdlib
 from collections import defaultdict
 import copy
+import csv
 import re
 import socket
+import threading
 import time
 import urlparse
 
@@ -64,6 +66,18 @@ class HAProxy(AgentCheck):
         # Host status needs to persist across all checks
         self.host_status = defaultdict(lambda: defaultdict(lambda: None))
 
+        # Column plans per stats header, and include/exclude decisions per
+        # service name, resolved once and reused across checks
+        self._column_plans = {}
+        self._excluded_services = defaultdict(dict)
+
+        # Receive buffers per stats socket, grown to fit the largest response
+        self._socket_buffers = {}
+
+        # Counters of the previous run per stats socket of a multi-process HAProxy:
+        # socket url -> (timestamp, {(pxname, svname): {field: value}})
+        self._process_counters = {}
+
     METRICS = {
         "qcur": ("gauge", "queue.current"),
         "scur": ("gauge", "session.current"),
@@ -93,16 +107,45 @@ class HAProxy(AgentCheck):
         "lastchg": ("gauge", "uptime")
     }
 
+    # Non-numeric columns kept from the stats lines, all others are reported metrics
+    TEXT_FIELDS = ('pxname', 'svname', 'status', 'pid')
+
+    # Metrics averaged when merging the stats of several processes, others are summed
+    AVERAGED_METRICS = ('qtime', 'ctime', 'rtime', 'ttime')
+
+    # Cumulative counters, turned into rates per process before merging the stats of several processes
+    RATE_METRICS = frozenset([field for field, (metric_type, _) in METRICS.iteritems() if metric_type == 'rate'])
+
     SERVICE_CHECK_NAME = 'haproxy.backend_up'
 
     def check(self, instance):
         url = instance.get('url')
         self.log.debug('Processing HAProxy data for %s' % url)
 
-        parsed_url = urlparse.urlparse(url)
-
-        if parsed_url.scheme == 'unix':
+        parsed_url = None if isinstance(url, list) else urlparse.urlparse(url)
+
+        processes_stats = None
+        if isinstance(url, list):
+            # One stats socket per process of a multi-process (nbproc) HAProxy
+            socket_urls = url
+            socket_paths = []
+            for socket_url in socket_urls:
+                parsed_socket_url = urlparse.urlparse(socket_url)
+                if parsed_socket_url.scheme != 'unix':
+                    raise Exception('A list of urls is only supported for unix stats sockets, got %s' % socket_url)
+                socket_paths.append(parsed_socket_url.path)
+
+            now = time.time()
+            processes_stats = [
+                self._counters_to_rates(socket_url, self._parse_stats(data), now) if data is not None else None
+                for socket_url, data in zip(socket_urls, self._fetch_sockets_data(socket_paths))
+            ]
+            stats = self._merge_stats([s for s in processes_stats if s is not None])
+            url = tuple(socket_urls)
+
+        elif parsed_url.scheme == 'unix':
             data = self._fetch_socket_data(parsed_url.path)
+            stats = self._parse_stats(data)
 
         else:
             username = instance.get('username')
@@ -110,6 +153,7 @@ class HAProxy(AgentCheck):
             verify = not _is_affirmative(instance.get('disable_ssl_validation', False))
 
             data = self._fetch_url_data(url, username, password, verify)
+            stats = self._parse_stats(data)
 
         collect_aggregates_only = _is_affirmative(
             instance.get('collect_aggregates_only', True)
@@ -141,8 +185,8 @@ class HAProxy(AgentCheck):
 
         process_events = instance.get('status_check', self.init_config.get('status_check', False))
 
-        self._process_data(
-            data, collect_aggregates_only, process_events,
+        self._process_stats(
+            stats, collect_aggregates_only, process_events,
             url=url, collect_status_metrics=collect_status_metrics,
             collect_status_metrics_by_host=collect_status_metrics_by_host,
             tag_service_check_by_host=tag_service_check_by_host,
@@ -151,8 +195,17 @@ class HAProxy(AgentCheck):
             collate_status_tags_per_host=collate_status_tags_per_host,
             count_status_by_service=count_status_by_service,
             custom_tags=custom_tags,
+            precomputed_rates=processes_stats is not None,
         )
 
+        if processes_stats is not None:
+            self._process_processes_metrics(
+                processes_stats, socket_urls, collect_aggregates_only,
+                services_incl_filter=services_incl_filter,
+                services_excl_filter=services_excl_filter,
+                custom_tags=custom_tags,
+            )
+
     def _fetch_url_data(self, url, username, password, verify):
         ''' Hit a given http url and return the stats lines '''
         # Try to fetch data from the stats URL
@@ -172,53 +225,90 @@ class HAProxy(AgentCheck):
 
         self.log.debug("Fetching haproxy stats from socket: %s" % socket_path)
 
+        buf = self._socket_buffers.get(socket_path)
+        if buf is None:
+            buf = self._socket_buffers[socket_path] = bytearray(BUFSIZE)
+
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.connect(socket_path)
-        sock.send("show stat\r\n")
+        sock.settimeout(self.default_integration_http_timeout)
+        try:
+            sock.connect(socket_path)
+            sock.sendall("show stat\r\n")
+
+            size = 0
+            while True:
+                if size == len(buf):
+                    # Full, double the buffer and keep it for the next runs
+                    buf.extend(bytearray(len(buf)))
+                received = sock.recv_into(memoryview(buf)[size:])
+                if not received:
+                    break
+                size += received
+        finally:
+            sock.close()
+
+        return str(buf[:size]).splitlines()
+
+    def _fetch_sockets_data(self, socket_paths):
+        '''
+        Read the stats sockets of all the processes concurrently and return their
+        stats lines, or None for the sockets that couldn't be read
+        '''
+        results = [None] * len(socket_paths)
+        errors = [None] * len(socket_paths)
 
-        response = ""
-        output = sock.recv(BUFSIZE)
-        while output:
-            response += output.decode("ASCII")
-            output = sock.recv(BUFSIZE)
+        def fetch(i, socket_path):
+            try:
+                results[i] = self._fetch_socket_data(socket_path)
+            except Exception as e:
+                errors[i] = e
+
+        workers = [
+            threading.Thread(target=fetch, args=(i, socket_path), name='haproxy-stats')
+            for i, socket_path in enumerate(socket_paths)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
 
-        sock.close()
+        if all(error is not None for error in errors):
+            raise errors[0]
+        for socket_path, error in zip(socket_paths, errors):
+            if error is not None:
+                self.warning("Unable to fetch haproxy stats from socket %s: %s" % (socket_path, error))
 
-        return response.splitlines()
+        return results
 
     def _process_data(self, data, collect_aggregates_only, process_events, url=None,
                       collect_status_metrics=False, collect_status_metrics_by_host=False,
                       tag_service_check_by_host=False, services_incl_filter=None,
                       services_excl_filter=None, collate_status_tags_per_host=False,
                       count_status_by_service=True, custom_tags=[]):
+        ''' Parse the stats lines and process them '''
+        return self._process_stats(
+            self._parse_stats(data), collect_aggregates_only, process_events,
+            url=url, collect_status_metrics=collect_status_metrics,
+            collect_status_metrics_by_host=collect_status_metrics_by_host,
+            tag_service_check_by_host=tag_service_check_by_host,
+            services_incl_filter=services_incl_filter,
+            services_excl_filter=services_excl_filter,
+            collate_status_tags_per_host=collate_status_tags_per_host,
+            count_status_by_service=count_status_by_service,
+            custom_tags=custom_tags,
+        )
+
+    def _process_stats(self, stats, collect_aggregates_only, process_events, url=None,
+                       collect_status_metrics=False, collect_status_metrics_by_host=False,
+                       tag_service_check_by_host=False, services_incl_filter=None,
+                       services_excl_filter=None, collate_status_tags_per_host=False,
+                       count_status_by_service=True, custom_tags=[], precomputed_rates=False):
         ''' Main data-processing loop. For each piece of useful data, we'll
         either save a metric, save an event or both. '''
 
-        # Split the first line into an index of fields
-        # The line looks like:
-        # "# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,ereq,econ,eresp,wretr,wredis,status,weight,act,bck,chkfail,chkdown,lastchg,downtime,qlimit,pid,iid,sid,throttle,lbtot,tracked,type,rate,rate_lim,rate_max,"
-        fields = [f.strip() for f in data[0][2:].split(',') if f]
-
         self.hosts_statuses = defaultdict(int)
 
-        back_or_front = None
-
-        # Sanitize CSV, handle line breaks
-        data = self._sanitize_lines(data)
-
-        # Skip the first line, go backwards to set back_or_front
-        for line in data[:0:-1]:
-            if not line.strip():
-                continue
-
-            # Store each line's values in a dictionary
-            data_dict = self._line_to_dict(fields, line)
-
-            if self._is_aggregate(data_dict):
-                back_or_front = data_dict['svname']
-
-            self._update_data_dict(data_dict, back_or_front)
-
+        for data_dict in stats:
             self._update_hosts_statuses_if_needed(
                 collect_status_metrics, collect_status_metrics_by_host,
                 data_dict, self.hosts_statuses
@@ -231,7 +321,8 @@ class HAProxy(AgentCheck):
                     data_dict, url,
                     services_incl_filter=services_incl_filter,
                     services_excl_filter=services_excl_filter,
-                    custom_tags=custom_tags
+                    custom_tags=custom_tags,
+                    precomputed_rates=precomputed_rates
                 )
             if process_events:
                 self._process_event(
@@ -265,69 +356,171 @@ class HAProxy(AgentCheck):
                 custom_tags=custom_tags
             )
 
-        return data
+        return stats
 
+    def _process_processes_metrics(self, processes_stats, urls, collect_aggregates_only,
+                                   services_incl_filter=None, services_excl_filter=None,
+                                   custom_tags=[]):
+        '''
+        Per-process breakdown of the metrics of a multi-process HAProxy,
+        reported as `haproxy.process.*` and tagged by `process_id`
+        '''
+        for i, (url, stats) in enumerate(zip(urls, processes_stats)):
+            if stats is None:
+                continue
+            for data_dict in stats:
+                if not self._should_process(data_dict, collect_aggregates_only):
+                    continue
+                process_tags = ['process_id:%s' % data_dict.get('pid', i + 1)]
+                self._process_metrics(
+                    data_dict, url,
+                    services_incl_filter=services_incl_filter,
+                    services_excl_filter=services_excl_filter,
+                    custom_tags=custom_tags + process_tags,
+                    metric_prefix='haproxy.process',
+                    precomputed_rates=True
+                )
 
-    def _sanitize_lines(self, data):
-        sanitized = []
-
-        def char_count(line, char):
-            count = 0
-
-            for c in line:
-                if c is char:
-                    count += 1
+    def _counters_to_rates(self, socket_url, stats, now):
+        '''
+        Replace the cumulative counters in the stats of one process by their per second rate
+        since the previous run. Rating them per process keeps the merged rates steady when a
+        process is missing from a run or restarts: counters without a previous value, or that
+        went backwards, are left out for this run.
+        '''
+        previous_ts, previous_counters = self._process_counters.get(socket_url, (None, {}))
+        interval = now - previous_ts if previous_ts is not None else 0
+        counters = {}
+        rates_stats = []
+        for data_dict in stats:
+            data_dict = dict(data_dict)
+            key = (data_dict['pxname'], data_dict['svname'])
+            previous = previous_counters.get(key, {})
+            current = counters[key] = {}
+            for field in self.RATE_METRICS:
+                if field not in data_dict:
+                    continue
+                value = current[field] = data_dict.pop(field)
+                if interval > 0 and field in previous and value >= previous[field]:
+                    data_dict[field] = (value - previous[field]) / interval
+            rates_stats.append(data_dict)
+
+        self._process_counters[socket_url] = (now, counters)
+        return rates_stats
+
+
+    def _get_column_plan(self, header):
+        """
+        Resolve the indices of the columns we report on from the first line, e.g.
+        "# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,ereq,econ,eresp,wretr,wredis,status,weight,act,bck,chkfail,chkdown,lastchg,downtime,qlimit,pid,iid,sid,throttle,lbtot,tracked,type,rate,rate_lim,rate_max,"
+        """
+        plan = self._column_plans.get(header)
+        if plan is None:
+            fields = [f.strip() for f in header[2:].split(',') if f]
+            text_columns = [(i, f) for i, f in enumerate(fields) if f in self.TEXT_FIELDS]
+            metric_columns = [(i, f) for i, f in enumerate(fields) if f in HAProxy.METRICS]
+            plan = self._column_plans[header] = (text_columns, metric_columns)
+        return plan
+
+    def _parse_stats(self, data):
+        '''
+        Parse the stats lines into one dictionary per proxy/server, in the order
+        they are processed: backwards, so that back_or_front is known for the servers
+        '''
+        text_columns, metric_columns = self._get_column_plan(data[0])
 
-            return count
+        stats = self._parse_lines(data[1:], text_columns, metric_columns)
+        stats.reverse()
 
-        clean = ''
-        double_quotes = 0
-        for line in data:
-            double_quotes += char_count(line, '"')
-            clean += line
+        back_or_front = None
+        for data_dict in stats:
+            if self._is_aggregate(data_dict):
+                back_or_front = data_dict['svname']
 
-            if double_quotes % 2 == 0:
-                sanitized.append(clean.replace('\n', '').replace('\r', ''))
-                double_quotes = 0
-                clean = ''
+            self._update_data_dict(data_dict, back_or_front)
 
-        return sanitized
+        return stats
 
+    def _merge_stats(self, processes_stats):
+        '''
+        Merge the stats of the same proxy/server across processes: counters are summed,
+        average times averaged, `lastchg` is the most recent change and a status
+        reported as unavailable by any process wins.
+        '''
+        merged = {}
+        keys = []
+        averaged_counts = defaultdict(int)
+        for stats in processes_stats:
+            for data_dict in stats:
+                key = (data_dict['pxname'], data_dict['svname'])
+                current = merged.get(key)
+                if current is None:
+                    current = merged[key] = dict(data_dict)
+                    keys.append(key)
+                    for field in self.AVERAGED_METRICS:
+                        if field in data_dict:
+                            averaged_counts[key, field] += 1
+                    continue
+
+                for field, value in data_dict.iteritems():
+                    if field not in HAProxy.METRICS or field == 'spct':
+                        continue
+                    if field in self.AVERAGED_METRICS:
+                        averaged_counts[key, field] += 1
+                    if field not in current:
+                        current[field] = value
+                    elif field == 'lastchg':
+                        current[field] = min(current[field], value)
+                    else:
+                        current[field] += value
+
+                status = data_dict.get('status')
+                if status is not None and \
+                        Services.STATUS_TO_COLLATED.get(current.get('status')) == Services.AVAILABLE and \
+                        Services.STATUS_TO_COLLATED.get(status) != Services.AVAILABLE:
+                    current['status'] = status
+
+        stats = []
+        for key in keys:
+            data_dict = merged[key]
+            for field in self.AVERAGED_METRICS:
+                if averaged_counts[key, field] > 1:
+                    data_dict[field] /= averaged_counts[key, field]
+            # The sessions percentage of the merged sessions and limits
+            self._update_data_dict(data_dict, data_dict['back_or_front'])
+            stats.append(data_dict)
+
+        return stats
+
+    def _parse_lines(self, lines, text_columns, metric_columns):
+        """
+        Parse the stats lines in a single pass, only converting the metric columns.
+        The csv module takes care of quoted fields holding commas or line breaks.
+        """
+        parsed = []
+        for values in csv.reader(lines):
+            data_dict = {}
+            length = len(values)
+            for i, field in text_columns:
+                if i < length and values[i]:
+                    data_dict[field] = values[i]
+            if 'pxname' not in data_dict or 'svname' not in data_dict:
+                # Blank line
+                continue
 
-    def _line_to_dict(self, fields, line):
-        data_dict = {}
-        values = line.split(',')
-        if len(values) > len(fields):
-            values = self._gather_quoted_values(values)
-        for i, val in enumerate(values):
-            if val:
-                try:
-                    # Try converting to a long, if failure, just leave it
-                    val = float(val)
-                except Exception:
-                    pass
-                data_dict[fields[i]] = val
+            for i, field in metric_columns:
+                if i < length and values[i]:
+                    try:
+                        data_dict[field] = float(values[i])
+                    except ValueError:
+                        pass
 
-        if 'status' in data_dict:
-            data_dict['status'] = self._normalize_status(data_dict['status'])
+            if 'status' in data_dict:
+                data_dict['status'] = self._normalize_status(data_dict['status'])
 
-        return data_dict
+            parsed.append(data_dict)
 
-    def _gather_quoted_values(self, values):
-        gathered_values = []
-        previous = ''
-        for val in values:
-            if val.startswith('"') and not val.endswith('"'):
-                previous = val
-            elif previous:
-                if val.endswith('"'):
-                    gathered_values.append(previous + val)
-                    previous = ''
-                else:
-                    previous += val
-            else:
-                gathered_values.append(val)
-        return gathered_values
+        return parsed
 
     def _update_data_dict(self, data_dict, back_or_front):
         """
@@ -371,11 +564,16 @@ class HAProxy(AgentCheck):
 
     def _is_service_excl_filtered(self, service_name, services_incl_filter,
                                   services_excl_filter):
-        if self._tag_match_patterns(service_name, services_excl_filter):
-            if self._tag_match_patterns(service_name, services_incl_filter):
-                return False
-            return True
-        return False
+        if not services_excl_filter:
+            return False
+
+        decisions = self._excluded_services[(tuple(services_incl_filter or []), tuple(services_excl_filter))]
+        excluded = decisions.get(service_name)
+        if excluded is None:
+            excluded = self._tag_match_patterns(service_name, services_excl_filter) and \
+                not self._tag_match_patterns(service_name, services_incl_filter)
+            decisions[service_name] = excluded
+        return excluded
 
     def _tag_match_patterns(self, tag, filters):
         if not filters:
@@ -492,21 +690,24 @@ class HAProxy(AgentCheck):
                 self.gauge("haproxy.count_per_status", count, tags=service_tags + ('status:%s' % status, ))
 
     def _process_metrics(self, data, url, services_incl_filter=None,
-                         services_excl_filter=None, custom_tags=[]):
+                         services_excl_filter=None, custom_tags=[], metric_prefix='haproxy',
+                         precomputed_rates=False):
         """
         Data is a dictionary related to one host
         (one line) extracted from the csv.
         It should look like:
         {'pxname':'dogweb', 'svname':'i-4562165', 'scur':'42', ...}
+        The url is a tuple of socket urls for stats merged across processes, whose
+        counters are already per second rates.
         """
         hostname = data['svname']
         service_name = data['pxname']
         back_or_front = data['back_or_front']
         tags = [
             "type:%s" % back_or_front,
-            "instance_url:%s" % url,
             "service:%s" % service_name,
         ]
+        tags.extend("instance_url:%s" % u for u in (url if isinstance(url, tuple) else [url]))
         tags.extend(custom_tags)
 
         if self._is_service_excl_filtered(service_name, services_incl_filter,
@@ -519,8 +720,8 @@ class HAProxy(AgentCheck):
         for key, value in data.items():
             if HAProxy.METRICS.get(key):
                 suffix = HAProxy.METRICS[key][1]
-                name = "haproxy.%s.%s" % (back_or_front.lower(), suffix)
-                if HAProxy.METRICS[key][0] == 'rate':
+                name = "%s.%s.%s" % (metric_prefix, back_or_front.lower(), suffix)
+                if HAProxy.METRICS[key][0] == 'rate' and not precomputed_rates:
                     self.rate(name, value, tags=tags)
                 else:
                     self.gauge(name, value, tags=tags)
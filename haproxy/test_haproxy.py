@@ -6,6 +6,10 @@
 from collections import defaultdict
 import copy
 import os
+import shutil
+import socket
+import tempfile
+import threading
 
 # 3p
 import mock
@@ -255,6 +259,133 @@ b,BACKEND,0,0,1,2,0,421,1,0,0,0,,0,0,0,0,UP,6,6,0,,0,1,0,,1,3,0,,421,,1,0,,1,,,,
                                  collect_status_metrics_by_host=True)
         self.assertEquals(self.check.hosts_statuses, expected_hosts_statuses)
 
+    def test_parse_lines(self):
+        self.load_check(self.BASE_CONFIG)
+        lines = MOCK_DATA_EVIL.split('\n')
+        text_columns, metric_columns = self.check._get_column_plan(lines[0])
+        self.assertEquals(self.check._get_column_plan(lines[0]), (text_columns, metric_columns))
+
+        # quoted fields with commas and line breaks don't shift the columns,
+        # and non-numeric values in metric columns are dropped
+        parsed = self.check._parse_lines(lines[1:], text_columns, metric_columns)
+        self.assertEquals(len(parsed), 13)
+        for data_dict in parsed:
+            for field, value in data_dict.iteritems():
+                if field not in ('pxname', 'svname', 'status', 'pid'):
+                    self.assertTrue(isinstance(value, float))
+        self.assertEquals(parsed[9], {
+            'pxname': 'c', 'svname': 'i-1', 'status': 'up', 'pid': '1', 'qcur': 0.0, 'scur': 0.0,
+            'stot': 1.0, 'bin': 1.0, 'bout': 0.0, 'dresp': 0.0, 'econ': 0.0, 'eresp': 0.0,
+            'wretr': 0.0, 'wredis': 0.0, 'lastchg': 1.0,
+        })
+
+    def test_service_filter_decisions(self):
+        self.load_check(self.BASE_CONFIG)
+        with mock.patch.object(self.check, '_tag_match_patterns', wraps=self.check._tag_match_patterns) as match:
+            for _ in range(3):
+                self.assertFalse(self.check._is_service_excl_filtered('datadog', ['datadog'], ['.*']))
+                self.assertTrue(self.check._is_service_excl_filtered('other', ['datadog'], ['.*']))
+                self.assertFalse(self.check._is_service_excl_filtered('other', [], []))
+            # decisions are only computed once per service name and filters
+            self.assertEquals(match.call_count, 4)
+
+    def _serve_stats(self, socket_path, data):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+
+        def serve():
+            conn, _ = server.accept()
+            conn.recv(1024)
+            conn.sendall(data)
+            conn.close()
+            server.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+    def test_multiple_stats_sockets(self):
+        # Second process: pid 2, and i-1 of service b seen DOWN by this process only
+        process_2 = []
+        for line in MOCK_DATA.split('\n'):
+            values = line.split(',')
+            if len(values) > 26 and not line.startswith('#'):
+                values[26] = '2'
+                if values[:2] == ['b', 'i-1']:
+                    values[17] = 'DOWN'
+            process_2.append(','.join(values))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            socket_urls = []
+            for i, data in enumerate([MOCK_DATA, '\n'.join(process_2)]):
+                socket_path = os.path.join(tmp_dir, 'haproxy-%d.sock' % (i + 1))
+                self._serve_stats(socket_path, data)
+                socket_urls.append('unix://%s' % socket_path)
+
+            config = copy.deepcopy(self.BASE_CONFIG)
+            config['instances'][0]['url'] = socket_urls
+            config['instances'][0]['collect_aggregates_only'] = False
+            self.load_check(config)
+            # Start with a small receive buffer, grown while reading
+            self.check._socket_buffers[socket_urls[0][len('unix://'):]] = bytearray(16)
+            self.run_check(config)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        url_tags = ['instance_url:%s' % u for u in socket_urls]
+        i2_tags = ['type:BACKEND', 'service:b', 'backend:i-2']
+        self.assertMetric('haproxy.backend.session.current', value=2, tags=i2_tags + url_tags, count=1)
+        for i, url_tag in enumerate(url_tags):
+            self.assertMetric('haproxy.process.backend.session.current', value=1, count=1,
+                              tags=i2_tags + [url_tag, 'process_id:%d' % (i + 1)])
+
+        self.assertMetric('haproxy.count_per_status', value=2, tags=['status:up', 'service:b'])
+        self.assertMetric('haproxy.count_per_status', value=2, tags=['status:down', 'service:b'])
+        self.assertServiceCheck('haproxy.backend_up', status=AgentCheck.CRITICAL, count=1,
+                                tags=['service:b', 'backend:i-1'])
+        # the buffer was grown to fit the whole response and is kept for the next runs
+        self.assertTrue(len(self.check._socket_buffers[socket_urls[0][len('unix://'):]]) >= len(MOCK_DATA))
+
+    def test_merge_stats(self):
+        self.load_check(self.BASE_CONFIG)
+        merged = self.check._merge_stats([
+            [{'pxname': 'a', 'svname': 'BACKEND', 'back_or_front': 'BACKEND', 'status': 'up',
+              'scur': 1.0, 'slim': 10.0, 'spct': 10.0, 'qtime': 10.0, 'lastchg': 30.0}],
+            [{'pxname': 'a', 'svname': 'BACKEND', 'back_or_front': 'BACKEND', 'status': 'up',
+              'scur': 4.0, 'slim': 10.0, 'spct': 40.0, 'qtime': 20.0, 'lastchg': 5.0}],
+        ])
+        self.assertEquals(merged, [{
+            'pxname': 'a', 'svname': 'BACKEND', 'back_or_front': 'BACKEND', 'status': 'up',
+            'scur': 5.0, 'slim': 20.0, 'spct': 25.0, 'qtime': 15.0, 'lastchg': 5.0,
+        }])
+
+    def test_counters_to_rates(self):
+        """
+        Counters are rated per process before being merged, a process missing from a run or
+        restarting doesn't make the merged rates drop and spike
+        """
+        self.load_check(self.BASE_CONFIG)
+
+        def merged_stot(stot_per_process, now):
+            processes_stats = [
+                self.check._counters_to_rates(url, [{'pxname': 'a', 'svname': 'BACKEND', 'back_or_front': 'BACKEND',
+                                                     'stot': stot, 'scur': 1.0}], now)
+                for url, stot in stot_per_process if stot is not None
+            ]
+            return self.check._merge_stats(processes_stats)[0].get('stot')
+
+        self.assertIsNone(merged_stot([('p1', 100.0), ('p2', 1000.0)], 0))
+        self.assertEquals(merged_stot([('p1', 110.0), ('p2', 1010.0)], 10), 2.0)
+        # the socket of p2 failed
+        self.assertEquals(merged_stot([('p1', 120.0), ('p2', None)], 20), 1.0)
+        # p2 is back, rated since its last read
+        self.assertEquals(merged_stot([('p1', 130.0), ('p2', 1050.0)], 30), 3.0)
+        # p2 restarted, its counters went back
+        self.assertEquals(merged_stot([('p1', 140.0), ('p2', 5.0)], 40), 1.0)
+        self.assertEquals(merged_stot([('p1', 150.0), ('p2', 15.0)], 50), 2.0)
+
     @mock.patch('requests.get', return_value=mock.Mock(content=MOCK_DATA))
     def test_optional_tags(self, mock_requests):
         config = copy.deepcopy(self.BASE_CONFIG)
@@ -1,18 +1,67 @@
 
 # stdlib
-from collections import defaultdict
+from collections import deque
+from itertools import groupby
+import json
+import re
+import select
+import time
 
 # 3p
 from kafka import KafkaClient
+from kafka.common import (KafkaError, KafkaUnavailableError, NotLeaderForPartitionError,
+                          UnknownTopicOrPartitionError, check_error, for_code)
 from kafka.common import OffsetRequestPayload as OffsetRequest
+from kafka.conn import get_ip_port_afi
+from kafka.protocol.commit import GroupCoordinatorRequest, OffsetFetchRequest
 from kazoo.client import KazooClient
-from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import ConnectionLoss, NoNodeError, SessionExpiredError
+from kazoo.handlers.threading import KazooTimeoutError
 
 # project
 from checks import AgentCheck
+from config import _is_affirmative
 
 DEFAULT_KAFKA_TIMEOUT = 5
 DEFAULT_ZK_TIMEOUT = 5
+# Number of Zookeeper reads in flight at once
+DEFAULT_ZK_MAX_INFLIGHT = 100
+# Seconds between two discoveries of the consumer groups, topics and partitions
+DEFAULT_DISCOVERY_REFRESH_INTERVAL = 300
+
+# Zookeeper errors after which the connection isn't worth using anymore for this run
+ZK_CONNECTION_ERRORS = (ConnectionLoss, SessionExpiredError, KazooTimeoutError)
+
+
+class PartitionLayout(object):
+    """
+    The partitions and consumer offsets monitored by an instance, in a fixed order so that
+    offsets are fetched and subtracted as aligned lists.
+    """
+
+    def __init__(self, consumer_groups, expires_at=None):
+        self.consumer_groups = consumer_groups
+        self.expires_at = expires_at
+        # [(consumer_group, topic, partition), ...]
+        self.consumer_keys = sorted(
+            (consumer_group, topic, partition)
+            for consumer_group, topic_partitions in consumer_groups.iteritems()
+            for topic, partitions in topic_partitions.iteritems()
+            for partition in partitions
+        )
+        # [(topic, partition), ...]
+        self.partitions = sorted(set((topic, partition) for _, topic, partition in self.consumer_keys))
+        # Position in `partitions` of the partition of each consumer key
+        positions = dict((partition, i) for i, partition in enumerate(self.partitions))
+        self.partition_positions = [positions[(topic, partition)] for _, topic, partition in self.consumer_keys]
+
+    def consumer_lags(self, broker_offsets, consumer_offsets):
+        """
+        Lag of each consumer key, None when one of its offsets is unknown
+        """
+        broker_offsets = [broker_offsets[i] for i in self.partition_positions]
+        return [None if broker_offset is None or consumer_offset is None else broker_offset - consumer_offset
+                for broker_offset, consumer_offset in zip(broker_offsets, consumer_offsets)]
 
 
 class KafkaCheck(AgentCheck):
@@ -25,91 +74,368 @@ class KafkaCheck(AgentCheck):
             init_config.get('zk_timeout', DEFAULT_ZK_TIMEOUT))
         self.kafka_timeout = int(
             init_config.get('kafka_timeout', DEFAULT_KAFKA_TIMEOUT))
+        self.zk_max_inflight = int(
+            init_config.get('zk_max_inflight', DEFAULT_ZK_MAX_INFLIGHT))
+        # Clients are kept across runs, keyed by connection string
+        self._zk_clients = {}
+        self._kafka_clients = {}
+        # Kafka client key -> consumer group -> (host, port) of its coordinator
+        self._group_coordinators = {}
+        # instance key -> PartitionLayout
+        self._layouts = {}
+
+    def stop(self):
+        for zk_connect_str in self._zk_clients.keys():
+            self._close_zk_client(zk_connect_str)
+        for kafka_host_ports in self._kafka_clients.keys():
+            self._close_kafka_client(kafka_host_ports)
 
     def check(self, instance):
-        consumer_groups = self.read_config(instance, 'consumer_groups',
-                                           cast=self._validate_consumer_groups)
-        zk_connect_str = self.read_config(instance, 'zk_connect_str')
+        monitor_unlisted_consumer_groups = _is_affirmative(instance.get('monitor_unlisted_consumer_groups', False))
+        if monitor_unlisted_consumer_groups:
+            consumer_groups = instance.get('consumer_groups') or {}
+        else:
+            consumer_groups = self.read_config(instance, 'consumer_groups',
+                                               cast=self._validate_consumer_groups)
         kafka_host_ports = self.read_config(instance, 'kafka_connect_str')
-
-        # Construct the Zookeeper path pattern
+        kafka_consumer_offsets = _is_affirmative(instance.get('kafka_consumer_offsets', False))
+        # Consumer offsets may be stored in Kafka only
+        if kafka_consumer_offsets:
+            zk_connect_str = instance.get('zk_connect_str')
+        else:
+            zk_connect_str = self.read_config(instance, 'zk_connect_str')
         zk_prefix = instance.get('zk_prefix', '')
-        zk_path_tmpl = zk_prefix + '/consumers/%s/offsets/%s/%s'
 
-        # Connect to Zookeeper
-        zk_conn = KazooClient(zk_connect_str, timeout=self.zk_timeout)
-        zk_conn.start()
+        # The consumer offsets and topic partitions to look up, discovered or not
+        layout = self._get_partition_layout(instance, consumer_groups, kafka_host_ports, zk_connect_str, zk_prefix,
+                                            monitor_unlisted_consumer_groups)
 
-        try:
-            # Query Zookeeper for consumer offsets
-            consumer_offsets = {}
-            topics = defaultdict(set)
-            for consumer_group, topic_partitions in consumer_groups.iteritems():
-                for topic, partitions in topic_partitions.iteritems():
-                    # Remember the topic partitions that we've see so that we can
-                    # look up their broker offsets later
-                    topics[topic].update(set(partitions))
-                    for partition in partitions:
-                        zk_path = zk_path_tmpl % (consumer_group, topic, partition)
-                        try:
-                            consumer_offset = int(zk_conn.get(zk_path)[0])
-                            key = (consumer_group, topic, partition)
-                            consumer_offsets[key] = consumer_offset
-                        except NoNodeError:
-                            self.log.warn('No zookeeper node at %s' % zk_path)
-                        except Exception:
-                            self.log.exception('Could not read consumer offset from %s' % zk_path)
-        finally:
+        # Query Zookeeper and Kafka for consumer offsets, by source
+        consumer_offsets = {}
+        if zk_connect_str:
+            consumer_offsets['zk'] = self._get_zk_consumer_offsets(zk_connect_str, zk_prefix, layout.consumer_keys)
+        if kafka_consumer_offsets:
+            consumer_offsets['kafka'] = self._get_kafka_consumer_offsets(kafka_host_ports, layout.consumer_keys)
+
+        # Query Kafka for the broker offsets
+        broker_offsets = self._get_broker_offsets(kafka_host_ports, layout.partitions)
+
+        # Report the broker data
+        for (topic, partition), broker_offset in zip(layout.partitions, broker_offsets):
+            if broker_offset is None:
+                continue
+            broker_tags = ['topic:%s' % topic, 'partition:%s' % partition]
+            self.gauge('kafka.broker_offset', broker_offset, tags=broker_tags)
+
+        # Report the consumer
+        for source, source_offsets in consumer_offsets.iteritems():
+            consumer_lags = layout.consumer_lags(broker_offsets, source_offsets)
+            for (consumer_group, topic, partition), consumer_offset, consumer_lag in zip(
+                    layout.consumer_keys, source_offsets, consumer_lags):
+                if consumer_offset is None:
+                    continue
+
+                # Report the consumer offset and lag
+                tags = ['topic:%s' % topic, 'partition:%s' % partition,
+                        'consumer_group:%s' % consumer_group]
+                # Offsets of both sources can coexist while consumers migrate
+                if kafka_consumer_offsets:
+                    tags.append('source:%s' % source)
+                self.gauge('kafka.consumer_offset', consumer_offset, tags=tags)
+                if consumer_lag is not None:
+                    self.gauge('kafka.consumer_lag', consumer_lag, tags=tags)
+
+    def _get_zk_client(self, zk_connect_str):
+        if zk_connect_str not in self._zk_clients:
+            zk_conn = KazooClient(zk_connect_str, timeout=self.zk_timeout)
+            self._zk_clients[zk_connect_str] = zk_conn
             try:
-                zk_conn.stop()
-                zk_conn.close()
+                zk_conn.start()
             except Exception:
-                self.log.exception('Error cleaning up Zookeeper connection')
+                self._close_zk_client(zk_connect_str)
+                raise
+        return self._zk_clients[zk_connect_str]
 
-        # Connect to Kafka
-        kafka_conn = KafkaClient(kafka_host_ports, timeout=self.kafka_timeout)
+    def _close_zk_client(self, zk_connect_str):
+        zk_conn = self._zk_clients.pop(zk_connect_str)
+        try:
+            zk_conn.stop()
+            zk_conn.close()
+        except Exception:
+            self.log.exception('Error cleaning up Zookeeper connection')
 
+    def _get_kafka_client(self, kafka_host_ports):
+        key = tuple(kafka_host_ports) if isinstance(kafka_host_ports, list) else kafka_host_ports
+        if key not in self._kafka_clients:
+            self._kafka_clients[key] = KafkaClient(kafka_host_ports, timeout=self.kafka_timeout)
+        return key, self._kafka_clients[key]
+
+    def _close_kafka_client(self, key):
+        kafka_conn = self._kafka_clients.pop(key)
+        self._group_coordinators.pop(key, None)
         try:
-            # Query Kafka for the broker offsets
-            broker_offsets = {}
-            for topic, partitions in topics.items():
-                offset_responses = kafka_conn.send_offset_request([
-                    OffsetRequest(topic, p, -1, 1) for p in partitions])
-
-                for resp in offset_responses:
-                    broker_offsets[(resp.topic, resp.partition)] = resp.offsets[0]
-        finally:
+            kafka_conn.close()
+        except Exception:
+            self.log.exception('Error cleaning up Kafka connection')
+
+    def _get_partition_layout(self, instance, consumer_groups, kafka_host_ports, zk_connect_str, zk_prefix,
+                              monitor_unlisted_consumer_groups):
+        """
+        The layout of the configured partitions is built once. When it has to be discovered,
+        it's cached for `discovery_refresh_interval` seconds.
+        """
+        instance_key = json.dumps(instance, sort_keys=True)
+        layout = self._layouts.get(instance_key)
+        if layout is not None and (layout.expires_at is None or layout.expires_at > time.time()):
+            return layout
+
+        discovery = monitor_unlisted_consumer_groups or any(
+            not topic_partitions or any(not partitions for partitions in topic_partitions.itervalues())
+            for topic_partitions in consumer_groups.itervalues())
+        if not discovery:
+            layout = PartitionLayout(consumer_groups)
+        else:
+            refresh_interval = float(instance.get('discovery_refresh_interval', DEFAULT_DISCOVERY_REFRESH_INTERVAL))
+            try:
+                discovered = self._discover_consumer_groups(
+                    consumer_groups, kafka_host_ports, zk_connect_str, zk_prefix, monitor_unlisted_consumer_groups,
+                    [re.compile(pattern) for pattern in instance.get('discovery_include') or []],
+                    [re.compile(pattern) for pattern in instance.get('discovery_exclude') or []])
+            except Exception as e:
+                if layout is None:
+                    raise
+                # Keep monitoring the partitions we know about
+                self.warning('Could not discover the consumer groups, topics and partitions: %s' % e)
+                discovered = layout.consumer_groups
+            layout = PartitionLayout(discovered, expires_at=time.time() + refresh_interval)
+
+        self._layouts[instance_key] = layout
+        return layout
+
+    def _discover_consumer_groups(self, consumer_groups, kafka_host_ports, zk_connect_str, zk_prefix,
+                                  monitor_unlisted_consumer_groups, include, exclude):
+        """
+        Fill in the consumer groups listed in Zookeeper, the topics of the consumer groups listed
+        without any, and the partitions of the topics listed without any.
+        Discovered consumer groups and topics are filtered by the include and exclude patterns.
+        """
+        def is_included(consumer_group, topic):
+            name = '%s/%s' % (consumer_group, topic)
+            return ((not include or any(pattern.search(name) for pattern in include)) and
+                    not any(pattern.search(name) for pattern in exclude))
+
+        # Copy the configuration, missing topics and partitions are filled in
+        discovered = dict((consumer_group, dict((topic, list(partitions or []))
+                                                for topic, partitions in (topic_partitions or {}).iteritems()))
+                          for consumer_group, topic_partitions in consumer_groups.iteritems())
+        discovered_topics = set()
+
+        if zk_connect_str:
+            zk_consumers = zk_prefix + '/consumers'
+            if monitor_unlisted_consumer_groups:
+                for consumer_group in self._zk_read(zk_connect_str, [zk_consumers], children=True)[0] or []:
+                    discovered.setdefault(consumer_group, {})
+
+            unlisted = [consumer_group for consumer_group, topic_partitions in discovered.iteritems()
+                        if not topic_partitions]
+            topic_paths = ['%s/%s/offsets' % (zk_consumers, consumer_group) for consumer_group in unlisted]
+            for consumer_group, topics in zip(unlisted, self._zk_read(zk_connect_str, topic_paths, children=True)):
+                for topic in topics or []:
+                    if is_included(consumer_group, topic):
+                        discovered[consumer_group][topic] = []
+                        discovered_topics.add(topic)
+        else:
+            for consumer_group, topic_partitions in discovered.iteritems():
+                if not topic_partitions:
+                    self.warning('The topics of consumer group %s can only be discovered from Zookeeper'
+                                 % consumer_group)
+
+        # Take the partitions of the topics from the Kafka metadata
+        if any(not partitions for topic_partitions in discovered.itervalues()
+               for partitions in topic_partitions.itervalues()):
+            key, kafka_conn = self._get_kafka_client(kafka_host_ports)
             try:
-                kafka_conn.close()
+                # A full refresh doesn't fail on the topics deleted since their offsets were committed
+                kafka_conn.load_metadata_for_topics()
             except Exception:
-                self.log.exception('Error cleaning up Kafka connection')
+                self._close_kafka_client(key)
+                raise
+            for topic_partitions in discovered.itervalues():
+                for topic, partitions in topic_partitions.iteritems():
+                    if not partitions:
+                        partitions.extend(sorted(kafka_conn.topic_partitions.get(topic, {})))
 
-        # Report the broker data
-        for (topic, partition), broker_offset in broker_offsets.items():
-            broker_tags = ['topic:%s' % topic, 'partition:%s' % partition]
-            broker_offset = broker_offsets.get((topic, partition))
-            self.gauge('kafka.broker_offset', broker_offset, tags=broker_tags)
+        self.log.debug('Discovered %s consumer groups and %s topics', len(discovered), len(discovered_topics))
+        return discovered
 
-        # Report the consumer
-        for (consumer_group, topic, partition), consumer_offset in consumer_offsets.items():
+    def _zk_read(self, zk_connect_str, zk_paths, children=False):
+        """
+        Read the Zookeeper nodes, or their children, pipelining up to `zk_max_inflight` reads.
+        Return their values in the same order, None for the nodes that couldn't be read.
+        """
+        zk_conn = self._get_zk_client(zk_connect_str)
+        read_async = zk_conn.get_children_async if children else zk_conn.get_async
+        values = [None] * len(zk_paths)
+        in_flight = deque()
+
+        def collect():
+            i, result = in_flight.popleft()
+            try:
+                values[i] = result.get(timeout=self.zk_timeout)
+            except NoNodeError:
+                self.log.warn('No zookeeper node at %s' % zk_paths[i])
+            except ZK_CONNECTION_ERRORS:
+                raise
+            except Exception:
+                self.log.exception('Could not read zookeeper node %s' % zk_paths[i])
+
+        try:
+            for i, zk_path in enumerate(zk_paths):
+                in_flight.append((i, read_async(zk_path)))
+                if len(in_flight) >= self.zk_max_inflight:
+                    collect()
+            while in_flight:
+                collect()
+        except ZK_CONNECTION_ERRORS:
+            # Reconnect at the next run, the other reads would fail the same way
+            self._close_zk_client(zk_connect_str)
+            raise
 
-            # Get the broker offset
-            broker_offset = broker_offsets.get((topic, partition))
+        return values
+
+    def _get_zk_consumer_offsets(self, zk_connect_str, zk_prefix, consumer_keys):
+        """
+        Read the consumer offsets from Zookeeper, in the order of the consumer keys
+        """
+        # Construct the Zookeeper path pattern
+        zk_path_tmpl = zk_prefix + '/consumers/%s/offsets/%s/%s'
+        zk_paths = [zk_path_tmpl % consumer_key for consumer_key in consumer_keys]
+        consumer_offsets = []
+        for zk_path, value in zip(zk_paths, self._zk_read(zk_connect_str, zk_paths)):
+            consumer_offset = None
+            if value is not None:
+                try:
+                    consumer_offset = int(value[0])
+                except ValueError:
+                    self.log.warn('Could not read consumer offset from %s: %r' % (zk_path, value[0]))
+            consumer_offsets.append(consumer_offset)
+        return consumer_offsets
+
+    def _get_kafka_consumer_offsets(self, kafka_host_ports, consumer_keys):
+        """
+        Read the consumer offsets committed to Kafka, in the order of the consumer keys,
+        with a request per consumer group to its coordinator. None for the ones that failed.
+        """
+        key, kafka_conn = self._get_kafka_client(kafka_host_ports)
+        coordinators = self._group_coordinators.setdefault(key, {})
+        consumer_offsets = []
+        for consumer_group, group_keys in groupby(consumer_keys, lambda consumer_key: consumer_key[0]):
+            group_keys = list(group_keys)
+            topics = [(topic, [partition for _, _, partition in topic_keys])
+                      for topic, topic_keys in groupby(group_keys, lambda consumer_key: consumer_key[1])]
+            offsets = {}
+            try:
+                if consumer_group not in coordinators:
+                    coordinators[consumer_group] = self._get_group_coordinator(kafka_conn, consumer_group)
+                host, port = coordinators[consumer_group]
+                # Version 1 reads the offsets committed to Kafka rather than Zookeeper
+                resp = self._send_kafka_request(kafka_conn, host, port,
+                                                OffsetFetchRequest[1](consumer_group=consumer_group, topics=topics))
+                for topic, partitions in resp.topics:
+                    for partition, offset, _, error_code in partitions:
+                        if error_code:
+                            # e.g. the coordinator moved, look it up again on the next run
+                            coordinators.pop(consumer_group, None)
+                            self.log.warn('Could not read consumer offset of %s from Kafka: %r' % (
+                                consumer_group, for_code(error_code)()))
+                        # -1 when the group never committed an offset for the partition
+                        elif offset >= 0:
+                            offsets[topic, partition] = offset
+            except KafkaError as e:
+                coordinators.pop(consumer_group, None)
+                self.log.warn('Could not read consumer offsets of %s from Kafka: %r' % (consumer_group, e))
+            consumer_offsets.extend(offsets.get((topic, partition)) for _, topic, partition in group_keys)
+
+        return consumer_offsets
+
+    def _get_group_coordinator(self, kafka_conn, consumer_group):
+        """
+        Ask the brokers for the (host, port) of the coordinator of a consumer group,
+        which serves its committed offsets
+        """
+        brokers = [(broker.host, broker.port) for broker in kafka_conn.brokers.values()] or \
+            [(host, port) for host, port, _ in kafka_conn.hosts]
+        error = KafkaUnavailableError('No broker to look up the coordinator of %s' % consumer_group)
+        for host, port in brokers:
+            try:
+                resp = self._send_kafka_request(kafka_conn, host, port, GroupCoordinatorRequest[0](consumer_group))
+            except KafkaError as e:
+                error = e
+                continue
+            if resp.error_code:
+                raise for_code(resp.error_code)(consumer_group)
+            return resp.host, resp.port
+        raise error
+
+    def _send_kafka_request(self, kafka_conn, host, port, request):
+        """
+        Send a protocol request over the client's connection to a broker and wait for the
+        response. The legacy client encoders for the group requests are broken in
+        kafka-python 1.3, they don't take the keywords the client passes them.
+        """
+        # Pinned to the kafka-python 1.3 client API: its connections to the brokers
+        # are only reachable through the private `_get_conn`
+        host, _, afi = get_ip_port_afi(host)
+        conn = kafka_conn._get_conn(host, port, afi)
+        future = conn.send(request)
+        while not future.is_done:
+            # recv() doesn't block, wait for the socket to be readable like the client does.
+            # The connection fails the request itself once it timed out.
+            if conn._sock is not None:
+                select.select([conn._sock], [], [], self.kafka_timeout)
+            conn.recv()
+        if future.failed():
+            raise future.exception
+        return future.value
+
+    def _get_broker_offsets(self, kafka_host_ports, partitions):
+        """
+        Read the latest offsets of the partitions, in their order, None for the ones that failed.
+        The client sends a single request per leader.
+        """
+        key, kafka_conn = self._get_kafka_client(kafka_host_ports)
+        try:
+            offset_responses = kafka_conn.send_offset_request([
+                OffsetRequest(topic, partition, -1, 1) for topic, partition in partitions], fail_on_error=False)
+        except Exception:
+            self._close_kafka_client(key)
+            raise
+
+        broker_offsets = []
+        for resp in offset_responses:
+            broker_offset = None
+            try:
+                check_error(resp)
+                broker_offset = resp.offsets[0]
+            except (NotLeaderForPartitionError, UnknownTopicOrPartitionError) as e:
+                # The client is kept across runs, make it look up the new leader on the next one
+                kafka_conn.reset_topic_metadata(resp.topic)
+                self.log.warn('Could not read broker offset: %r' % e)
+            except KafkaError as e:
+                self.log.warn('Could not read broker offset: %r' % e)
+            broker_offsets.append(broker_offset)
 
-            # Report the consumer offset and lag
-            tags = ['topic:%s' % topic, 'partition:%s' % partition,
-                    'consumer_group:%s' % consumer_group]
-            self.gauge('kafka.consumer_offset', consumer_offset, tags=tags)
-            self.gauge('kafka.consumer_lag', broker_offset - consumer_offset,
-                       tags=tags)
+        return broker_offsets
 
     def _validate_consumer_groups(self, val):
         try:
             consumer_group, topic_partitions = val.items()[0]
             assert isinstance(consumer_group, (str, unicode))
-            topic, partitions = topic_partitions.items()[0]
-            assert isinstance(topic, (str, unicode))
-            assert isinstance(partitions, (list, tuple))
+            # Topics and partitions left empty are discovered
+            if topic_partitions:
+                topic, partitions = topic_partitions.items()[0]
+                assert isinstance(topic, (str, unicode))
+                assert partitions is None or isinstance(partitions, (list, tuple))
             return val
         except Exception as e:
             self.log.exception(e)
@@ -120,4 +446,7 @@ consumer_groups:
   myconsumer1:
     mytopic0: [0, 1, 2]
     mytopic1: [10, 12]
+  myconsumer2: # all the topics of the consumer group
+  myconsumer3:
+    mytopic0: # all the partitions of the topic
 ''')
@@ -3,9 +3,18 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+import select
+import socket
+
 from nose.plugins.attrib import attr
 
 # 3p
+from kafka.common import BrokerMetadata, NotLeaderForPartitionError, OffsetResponsePayload
+from kafka.future import Future
+from kafka.protocol.api import RequestHeader
+from kafka.protocol.commit import GroupCoordinatorResponse, OffsetFetchResponse
+from kazoo.exceptions import ConnectionLoss, NoNodeError
+import mock
 
 # project
 from tests.checks.common import AgentCheckTest
@@ -45,3 +54,226 @@ class TestKafka(AgentCheckTest):
             self.assertMetric(mname, at_least=1)
 
         self.coverage_report()
+
+
+class FakeBrokerConnection(object):
+    """
+    Encodes the requests like kafka.conn.BrokerConnection does, and answers them
+    with encoded responses: broker1 coordinates all the groups. The responses are
+    received on the next recv(), once the socket is readable.
+    """
+    requests = []
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._sock, self._peer = socket.socketpair()
+        self.pending = None
+
+    def send(self, request):
+        header = RequestHeader(request, correlation_id=1, client_id='test')
+        header.encode()
+        request = type(request).decode(request.encode())
+        FakeBrokerConnection.requests.append((self.host, self.port, request))
+        if request.API_KEY == 10:
+            response = GroupCoordinatorResponse[0](0, 1, 'broker1', 9093)
+        else:
+            assert (self.host, self.port, request.API_VERSION) == ('broker1', 9093, 1)
+            response = OffsetFetchResponse[1](topics=[
+                (topic, [(partition, 5 if partition == 0 else -1, '', 0) for partition in partitions])
+                for topic, partitions in request.topics])
+        self.pending = Future(), type(response).decode(response.encode())
+        self._peer.send(b'x')
+        return self.pending[0]
+
+    def recv(self):
+        future, response = self.pending
+        self._sock.recv(1)
+        future.success(response)
+
+
+class FakeAsyncResult(object):
+    def __init__(self, value=None, exception=None):
+        self.value = value
+        self.exception = exception
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+@attr(requires='kafka_consumer')
+class TestKafkaOffsets(AgentCheckTest):
+    """Offset fetching against mocked Zookeeper and Kafka clients."""
+    CHECK_NAME = 'kafka_consumer'
+
+    ZK_OFFSETS = {
+        '/consumers/my_consumer/offsets/test/0': '10',
+        '/consumers/my_consumer/offsets/test/1': '15',
+        '/consumers/my_consumer/offsets/other/0': '3',
+    }
+
+    def setUp(self):
+        self.config = {
+            'init_config': {'zk_max_inflight': 2},
+            'instances': [{
+                'kafka_connect_str': 'localhost:9092',
+                'zk_connect_str': 'localhost:2181',
+                'consumer_groups': {
+                    'my_consumer': {'test': [0, 1, 2], 'other': [0]},
+                },
+            }],
+        }
+        self.zk_conn = mock.MagicMock()
+        self.zk_conn.get_async.side_effect = self._zk_get_async
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.kafka_conn = mock.MagicMock()
+        self.kafka_conn.send_offset_request.side_effect = lambda payloads, **kwargs: [
+            OffsetResponsePayload(p.topic, p.partition, 0, (20 + p.partition,)) for p in payloads]
+        self.kafka_conn.brokers = {0: BrokerMetadata(0, 'broker0', 9092, None)}
+        self.kafka_conn._get_conn.side_effect = lambda host, port, afi: FakeBrokerConnection(host, port)
+
+    def _zk_get_async(self, path):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        zk_test = self
+
+        class Result(FakeAsyncResult):
+            def get(self, timeout=None):
+                zk_test.in_flight -= 1
+                return FakeAsyncResult.get(self, timeout)
+
+        if path in self.ZK_OFFSETS:
+            return Result((self.ZK_OFFSETS[path], None))
+        return Result(exception=NoNodeError())
+
+    def test_pipelined_offsets(self):
+        """
+        Zookeeper reads are pipelined in a bounded window, broker offsets are fetched at once,
+        and the clients are kept across runs
+        """
+        self.load_check(self.config)
+        with mock.patch('_kafka_consumer.KazooClient', return_value=self.zk_conn) as zk_client, \
+                mock.patch('_kafka_consumer.KafkaClient', return_value=self.kafka_conn) as kafka_client:
+            self.run_check(self.config)
+            self.run_check(self.config)
+
+            self.assertEqual(zk_client.call_count, 1)
+            self.assertEqual(kafka_client.call_count, 1)
+            self.assertEqual(self.zk_conn.get_async.call_count, 8)
+            self.assertEqual(self.max_in_flight, 2)
+            # All the partitions in a single request, split per leader by the client
+            self.assertEqual(self.kafka_conn.send_offset_request.call_count, 2)
+
+            tags = ['topic:test', 'partition:1', 'consumer_group:my_consumer']
+            self.assertMetric('kafka.broker_offset', value=21, tags=['topic:test', 'partition:1'], count=1)
+            self.assertMetric('kafka.consumer_offset', value=15, tags=tags, count=1)
+            self.assertMetric('kafka.consumer_lag', value=6, tags=tags, count=1)
+            self.assertMetric('kafka.consumer_lag', value=17, count=1,
+                              tags=['topic:other', 'partition:0', 'consumer_group:my_consumer'])
+            # No offset in Zookeeper
+            self.assertMetric('kafka.consumer_offset', tags=['topic:test', 'partition:2',
+                                                             'consumer_group:my_consumer'], count=0)
+
+            # Reconnect after a connection loss
+            self.zk_conn.get_async.side_effect = lambda path: FakeAsyncResult(exception=ConnectionLoss())
+            self.assertRaises(ConnectionLoss, self.run_check, self.config)
+            self.zk_conn.get_async.side_effect = self._zk_get_async
+            self.run_check(self.config)
+            self.assertEqual(zk_client.call_count, 2)
+
+            self.check.stop()
+            self.assertEqual(self.kafka_conn.close.call_count, 1)
+
+    def test_kafka_consumer_offsets(self):
+        """
+        Consumer offsets committed to Kafka are tagged with their source
+        """
+        instance = self.config['instances'][0]
+        instance['kafka_consumer_offsets'] = True
+        del instance['zk_connect_str']
+        FakeBrokerConnection.requests = []
+        self.load_check(self.config)
+        with mock.patch('_kafka_consumer.KafkaClient', return_value=self.kafka_conn), \
+                mock.patch('select.select', wraps=select.select) as select_mock:
+            self.run_check(self.config)
+            self.run_check(self.config)
+
+        # Waited for each response on its socket instead of spinning on recv()
+        self.assertEqual(select_mock.call_count, 3)
+
+        # The coordinator is looked up once, then asked for the offsets of the group on each run
+        self.assertEqual([(host, port, request.API_KEY) for host, port, request in FakeBrokerConnection.requests],
+                         [('broker0', 9092, 10), ('broker1', 9093, 9), ('broker1', 9093, 9)])
+        self.assertEqual(FakeBrokerConnection.requests[1][2].consumer_group, 'my_consumer')
+        tags = ['topic:test', 'partition:0', 'consumer_group:my_consumer', 'source:kafka']
+        self.assertMetric('kafka.consumer_offset', value=5, tags=tags, count=1)
+        self.assertMetric('kafka.consumer_lag', value=15, tags=tags, count=1)
+        # Never committed
+        self.assertMetric('kafka.consumer_offset', tags=['topic:test', 'partition:1', 'consumer_group:my_consumer',
+                                                         'source:kafka'], count=0)
+
+    def test_broker_offsets_not_leader(self):
+        """
+        The client kept across runs looks up the leaders again after a partition moved
+        """
+        self.kafka_conn.send_offset_request.side_effect = lambda payloads, **kwargs: [
+            OffsetResponsePayload(p.topic, p.partition, NotLeaderForPartitionError.errno, ())
+            if (p.topic, p.partition) == ('test', 1) else OffsetResponsePayload(p.topic, p.partition, 0, (20,))
+            for p in payloads]
+        self.load_check(self.config)
+        with mock.patch('_kafka_consumer.KazooClient', return_value=self.zk_conn), \
+                mock.patch('_kafka_consumer.KafkaClient', return_value=self.kafka_conn):
+            self.run_check(self.config)
+
+        self.kafka_conn.reset_topic_metadata.assert_called_once_with('test')
+        self.assertMetric('kafka.broker_offset', tags=['topic:test', 'partition:1'], count=0)
+        self.assertMetric('kafka.broker_offset', value=20, tags=['topic:test', 'partition:0'], count=1)
+
+    def _zk_get_children_async(self, path):
+        children = {
+            '/consumers': ['my_consumer', 'other_group'],
+            '/consumers/my_consumer/offsets': ['test', 'other'],
+            '/consumers/other_group/offsets': ['test', '__ignored'],
+        }
+        if path in children:
+            return FakeAsyncResult(children[path])
+        return FakeAsyncResult(exception=NoNodeError())
+
+    def test_discovery(self):
+        """
+        Consumer groups, topics and partitions are discovered, filtered, and cached
+        """
+        instance = self.config['instances'][0]
+        del instance['consumer_groups']
+        instance['monitor_unlisted_consumer_groups'] = True
+        instance['discovery_exclude'] = ['/__']
+        self.zk_conn.get_children_async.side_effect = self._zk_get_children_async
+        self.kafka_conn.topic_partitions = {'test': {0: 1, 1: 2, 2: 1}, 'other': {0: 1}, '__ignored': {0: 1}}
+        self.ZK_OFFSETS = dict(self.ZK_OFFSETS)
+        self.ZK_OFFSETS['/consumers/other_group/offsets/test/2'] = '19'
+
+        self.load_check(self.config)
+        with mock.patch('_kafka_consumer.KazooClient', return_value=self.zk_conn), \
+                mock.patch('_kafka_consumer.KafkaClient', return_value=self.kafka_conn):
+            self.run_check(self.config)
+            self.run_check(self.config)
+
+            # Discovered once
+            self.assertEqual(self.zk_conn.get_children_async.call_count, 3)
+            self.assertEqual(self.kafka_conn.load_metadata_for_topics.call_count, 1)
+            # 4 partitions of my_consumer and 3 of other_group, per run
+            self.assertEqual(self.zk_conn.get_async.call_count, 14)
+            self.assertMetric('kafka.consumer_lag', value=6, count=1,
+                              tags=['topic:test', 'partition:1', 'consumer_group:my_consumer'])
+            self.assertMetric('kafka.consumer_lag', value=3, count=1,
+                              tags=['topic:test', 'partition:2', 'consumer_group:other_group'])
+            self.assertMetric('kafka.broker_offset', tags=['topic:__ignored', 'partition:0'], count=0)
+
+            # Discovered again once the layout expired
+            instance['discovery_refresh_interval'] = 0
+            self.run_check(self.config)
+            self.run_check(self.config)
+            self.assertEqual(self.kafka_conn.load_metadata_for_topics.call_count, 3)
@@ -3,8 +3,10 @@
 Collects network metrics.
 """
 # stdlib
+import io
 import re
 import socket
+import time
 from collections import defaultdict
 
 # project
@@ -28,6 +30,51 @@ SOLARIS_TCP_METRICS = [
     (re.compile("\s*tcpInSegs\s*=\s*(\d+)\s*"), 'system.net.tcp.out_segs')
 ]
 
+# Socket states of /proc/net/tcp{,6} (see include/net/tcp_states.h), named like `ss` does
+PROC_NET_TCP_STATES = {
+    '01': 'ESTAB',
+    '02': 'SYN-SENT',
+    '03': 'SYN-RECV',
+    '04': 'FIN-WAIT-1',
+    '05': 'FIN-WAIT-2',
+    '06': 'TIME-WAIT',
+    '07': 'UNCONN',
+    '08': 'CLOSE-WAIT',
+    '09': 'LAST-ACK',
+    '0A': 'LISTEN',
+    '0B': 'CLOSING',
+    '0C': 'SYN-RECV',
+}
+
+# Counters of /proc/net/netstat and /proc/net/snmp, per category
+NSTAT_METRICS_NAMES = {
+    'Tcp': {
+        'RetransSegs': 'system.net.tcp.retrans_segs',
+        'InSegs': 'system.net.tcp.in_segs',
+        'OutSegs': 'system.net.tcp.out_segs',
+    },
+    'TcpExt': {
+        'ListenOverflows': 'system.net.tcp.listen_overflows',
+        'ListenDrops': 'system.net.tcp.listen_drops',
+        'TCPBacklogDrop': 'system.net.tcp.backlog_drops',
+    },
+    'Udp': {
+        'InDatagrams': 'system.net.udp.in_datagrams',
+        'NoPorts': 'system.net.udp.no_ports',
+        'InErrors': 'system.net.udp.in_errors',
+        'OutDatagrams': 'system.net.udp.out_datagrams',
+        'RcvbufErrors': 'system.net.udp.rcv_buf_errors',
+        'SndbufErrors': 'system.net.udp.snd_buf_errors',
+        'InCsumErrors': 'system.net.udp.in_csum_errors'
+    }
+}
+
+# Initial size of the buffer procfs files are read into, grown when a file doesn't fit
+PROC_READ_BUFFER_SIZE = 64 * 1024
+
+# Maximum amount of interface names whose filtering result is cached
+MAX_CACHED_INTERFACES = 10000
+
 
 class Network(AgentCheck):
 
@@ -48,21 +95,38 @@ class Network(AgentCheck):
         if instances is not None and len(instances) > 1:
             raise Exception("Network check only supports one configured instance.")
 
+        # Reused for every read of a procfs file
+        self._proc_buffer = bytearray(PROC_READ_BUFFER_SIZE)
+        # Header line of /proc/net/{netstat,snmp} -> [(value index, metric name)]
+        self._nstat_columns = {}
+
+        # Interfaces filtering, see _setup_interfaces
+        self._interfaces_config = None
+        self._excluded_ifaces = []
+        self._exclude_iface_re = None
+        self._include_iface_re = None
+        self._aggregated_ifaces_re = []
+        # Interface name -> device name its metrics are reported under, None if filtered out
+        self._device_names = {}
+        # Aggregate device name -> summed per second rates of its interfaces during a run
+        self._aggregated_devicemetrics = {}
+        # Aggregated interface name -> (timestamp, counters) of its previous run
+        self._aggregated_counters = {}
+        self._seen_aggregated_ifaces = set()
+
     def check(self, instance):
         if instance is None:
             instance = {}
 
-        self._excluded_ifaces = instance.get('excluded_interfaces', [])
         self._collect_cx_state = instance.get('collect_connection_state', False)
+        self._cx_state_method = instance.get('connection_state_method', 'procfs')
 
         # This decides whether we should split or combine connection states, along with a few other things
         self._setup_metrics(instance)
 
-        self._exclude_iface_re = None
-        exclude_re = instance.get('excluded_interface_re', None)
-        if exclude_re:
-            self.log.debug("Excluding network devices matching: %s" % exclude_re)
-            self._exclude_iface_re = re.compile(exclude_re)
+        self._setup_interfaces(instance)
+        self._aggregated_devicemetrics = {}
+        self._seen_aggregated_ifaces = set()
 
         if Platform.is_linux():
             self._check_linux(instance)
@@ -73,6 +137,105 @@ class Network(AgentCheck):
         elif Platform.is_windows():
             self._check_psutil()
 
+        self._submit_aggregated_devicemetrics(self._seen_aggregated_ifaces)
+
+    def _setup_interfaces(self, instance):
+        """
+        Compile the interfaces filters, and reset the per interface cache, when their configuration changed
+        """
+        excluded_ifaces = instance.get('excluded_interfaces', [])
+        exclude_re = instance.get('excluded_interface_re', None)
+        include_re = instance.get('included_interface_re', None)
+        aggregated_ifaces = instance.get('aggregated_interfaces', None) or {}
+
+        config = (tuple(excluded_ifaces), exclude_re, include_re, tuple(sorted(aggregated_ifaces.iteritems())))
+        if config == self._interfaces_config:
+            return
+        self._interfaces_config = config
+
+        self._excluded_ifaces = excluded_ifaces
+        self._exclude_iface_re = None
+        if exclude_re:
+            self.log.debug("Excluding network devices matching: %s" % exclude_re)
+            self._exclude_iface_re = re.compile(exclude_re)
+
+        self._include_iface_re = None
+        if include_re:
+            self.log.debug("Only including network devices matching: %s" % include_re)
+            self._include_iface_re = re.compile(include_re)
+
+        self._aggregated_ifaces_re = []
+        for device, aggregate_re in sorted(aggregated_ifaces.iteritems()):
+            self.log.debug("Aggregating network devices matching %s as %s" % (aggregate_re, device))
+            self._aggregated_ifaces_re.append((device, re.compile(aggregate_re)))
+
+        self._device_names = {}
+        self._aggregated_counters = {}
+
+    def _get_device_name(self, iface):
+        """
+        Return the device name the metrics of an interface are reported under: the interface
+        itself, the aggregate it belongs to, or None if it's filtered out. Cached per interface.
+        """
+        device = self._device_names.get(iface, False)
+        if device is not False:
+            return device
+
+        if len(self._device_names) >= MAX_CACHED_INTERFACES:
+            # Interfaces churn on container hosts, forget the ones that are gone
+            self._device_names = {}
+
+        device = iface
+        if iface in self._excluded_ifaces or (self._exclude_iface_re and self._exclude_iface_re.match(iface)):
+            device = None
+        elif self._include_iface_re and not self._include_iface_re.match(iface):
+            device = None
+        else:
+            for aggregate, aggregate_re in self._aggregated_ifaces_re:
+                if aggregate_re.match(iface):
+                    device = aggregate
+                    break
+
+        self._device_names[iface] = device
+        return device
+
+    def _aggregate_devicemetrics(self, device, iface, vals_by_metric):
+        """
+        Add the per second rates of the counters of an interface to its aggregate. Interfaces come
+        and go, so rate every interface counter on its own: a rate of their sum would drop or spike
+        whenever an interface appears, disappears or resets its counters.
+        """
+        now = time.time()
+        previous = self._aggregated_counters.get(iface)
+        self._aggregated_counters[iface] = (now, vals_by_metric)
+        if previous is None:
+            # First sample of this interface, no rate yet
+            return
+
+        previous_ts, previous_vals = previous
+        interval = now - previous_ts
+        if interval <= 0:
+            return
+
+        aggregated = self._aggregated_devicemetrics.setdefault(device, dict.fromkeys(vals_by_metric, 0))
+        for metric, val in vals_by_metric.iteritems():
+            delta = val - previous_vals.get(metric, val)
+            if delta < 0:
+                # Counter reset or wrapped, skip this interface for the run
+                continue
+            aggregated[metric] += delta / interval
+
+    def _submit_aggregated_devicemetrics(self, seen_ifaces):
+        for device, vals_by_metric in self._aggregated_devicemetrics.iteritems():
+            for metric, val in vals_by_metric.iteritems():
+                self.gauge('system.net.%s' % metric, val, device_name=device)
+            self.log.debug("tracked %s network metrics for aggregated interfaces %s" % (len(vals_by_metric), device))
+        self._aggregated_devicemetrics = {}
+
+        # Forget the counters of the interfaces that are gone
+        for iface in set(self._aggregated_counters) - seen_ifaces:
+            del self._aggregated_counters[iface]
+
 
     def _setup_metrics(self, instance):
         self._combine_connection_states = instance.get('combine_connection_states', True)
@@ -211,7 +374,8 @@ class Network(AgentCheck):
             }
 
     def _submit_devicemetrics(self, iface, vals_by_metric):
-        if iface in self._excluded_ifaces or (self._exclude_iface_re and self._exclude_iface_re.match(iface)):
+        device = self._get_device_name(iface)
+        if device is None:
             # Skip this network interface.
             return False
 
@@ -227,6 +391,12 @@ class Network(AgentCheck):
             assert m in vals_by_metric
         assert len(vals_by_metric) == len(expected_metrics)
 
+        if device != iface:
+            # Summed with the other interfaces of its aggregate, submitted at the end of the run
+            self._seen_aggregated_ifaces.add(iface)
+            self._aggregate_devicemetrics(device, iface, vals_by_metric)
+            return
+
         count = 0
         for metric, val in vals_by_metric.iteritems():
             self.rate('system.net.%s' % metric, val, device_name=iface)
@@ -253,130 +423,186 @@ class Network(AgentCheck):
     def _check_linux(self, instance):
         proc_location = self.agentConfig.get('procfs_path', '/proc').rstrip('/')
         if self._collect_cx_state:
-            try:
-                self.log.debug("Using `ss` to collect connection state")
-                # Try using `ss` for increased performance over `netstat`
-                for ip_version in ['4', '6']:
-                    for protocol in ['tcp', 'udp']:
-                        # Call `ss` for each IP version because there's no built-in way of distinguishing
-                        # between the IP versions in the output
-                        # Also calls `ss` for each protocol, because on some systems (e.g. Ubuntu 14.04), there is a
-                        # bug that print `tcp` even if it's `udp`
-                        output, _, _ = get_subprocess_output(["ss", "-n", "-{0}".format(protocol[0]), "-a", "-{0}".format(ip_version)], self.log)
-                        lines = output.splitlines()
-
-                        # State      Recv-Q Send-Q     Local Address:Port       Peer Address:Port
-                        # UNCONN     0      0              127.0.0.1:8125                  *:*
-                        # ESTAB      0      0              127.0.0.1:37036         127.0.0.1:8125
-                        # UNCONN     0      0        fe80::a00:27ff:fe1c:3c4:123          :::*
-                        # TIME-WAIT  0      0          90.56.111.177:56867        46.105.75.4:143
-                        # LISTEN     0      0       ::ffff:127.0.0.1:33217  ::ffff:127.0.0.1:7199
-                        # ESTAB      0      0       ::ffff:127.0.0.1:58975  ::ffff:127.0.0.1:2181
-
-                        metrics = self._parse_linux_cx_state(lines[1:], self.tcp_states['ss'], 0, protocol=protocol, ip_version=ip_version)
-                        # Only send the metrics which match the loop iteration's ip version
-                        for stat, metric in self.cx_state_gauge.iteritems():
-                            if stat[0].endswith(ip_version) and stat[0].startswith(protocol):
-                                self.gauge(metric, metrics.get(metric))
-
-            except OSError:
-                self.log.info("`ss` not found: using `netstat` as a fallback")
-                output, _, _ = get_subprocess_output(["netstat", "-n", "-u", "-t", "-a"], self.log)
-                lines = output.splitlines()
-                # Active Internet connections (w/o servers)
-                # Proto Recv-Q Send-Q Local Address           Foreign Address         State
-                # tcp        0      0 46.105.75.4:80          79.220.227.193:2032     SYN_RECV
-                # tcp        0      0 46.105.75.4:143         90.56.111.177:56867     ESTABLISHED
-                # tcp        0      0 46.105.75.4:50468       107.20.207.175:443      TIME_WAIT
-                # tcp6       0      0 46.105.75.4:80          93.15.237.188:58038     FIN_WAIT2
-                # tcp6       0      0 46.105.75.4:80          79.220.227.193:2029     ESTABLISHED
-                # udp        0      0 0.0.0.0:123             0.0.0.0:*
-                # udp6       0      0 :::41458                :::*
-
-                metrics = self._parse_linux_cx_state(lines[2:], self.tcp_states['netstat'], 5)
-                for metric, value in metrics.iteritems():
-                    self.gauge(metric, value)
-            except SubprocessOutputEmptyError:
-                self.log.exception("Error collecting connection stats.")
+            collected = False
+            if self._cx_state_method == 'procfs':
+                try:
+                    self._cx_state_procfs(proc_location)
+                    collected = True
+                except IOError as e:
+                    self.log.info("Unable to read connection state from procfs (%s): using `ss` as a fallback", e)
+            if not collected:
+                self._cx_state_subprocess()
 
         proc_dev_path = "{}/net/dev".format(proc_location)
-        proc = open(proc_dev_path, 'r')
-        try:
-            lines = proc.readlines()
-        finally:
-            proc.close()
+        lines = self._read_proc_file(proc_dev_path).splitlines()
         # Inter-|   Receive                                                 |  Transmit
         #  face |bytes     packets errs drop fifo frame compressed multicast|bytes       packets errs drop fifo colls carrier compressed
         #     lo:45890956   112797   0    0    0     0          0         0    45890956   112797    0    0    0     0       0          0
         #   eth0:631947052 1042233   0   19    0   184          0      1206  1208625538  1320529    0    0    0     0       0          0
         #   eth1:       0        0   0    0    0     0          0         0           0        0    0    0    0     0       0          0
         for l in lines[2:]:
-            cols = l.split(':', 1)
-            x = cols[1].split()
+            iface, _, counters = l.partition(':')
+            x = counters.split()
             # Filter inactive interfaces
-            if self._parse_value(x[0]) or self._parse_value(x[8]):
-                iface = cols[0].strip()
-                metrics = {
-                    'bytes_rcvd': self._parse_value(x[0]),
-                    'bytes_sent': self._parse_value(x[8]),
-                    'packets_in.count': self._parse_value(x[1]),
-                    'packets_in.error': self._parse_value(x[2]) + self._parse_value(x[3]),
-                    'packets_out.count': self._parse_value(x[9]),
-                    'packets_out.error':self._parse_value(x[10]) + self._parse_value(x[11]),
-                }
-                self._submit_devicemetrics(iface, metrics)
-
-
+            if x[0] == '0' and x[8] == '0':
+                continue
+            metrics = {
+                'bytes_rcvd': self._parse_value(x[0]),
+                'bytes_sent': self._parse_value(x[8]),
+                'packets_in.count': self._parse_value(x[1]),
+                'packets_in.error': self._parse_value(x[2]) + self._parse_value(x[3]),
+                'packets_out.count': self._parse_value(x[9]),
+                'packets_out.error': self._parse_value(x[10]) + self._parse_value(x[11]),
+            }
+            self._submit_devicemetrics(iface.strip(), metrics)
 
-        netstat_data = {}
+        nstat_values = []
         for f in ['netstat', 'snmp']:
             proc_data_path = "{}/net/{}".format(proc_location, f)
             try:
-                with open(proc_data_path, 'r') as netstat:
-                    while True:
-                        n_header = netstat.readline()
-                        if not n_header:
-                            break # No more? Abort!
-                        n_data = netstat.readline()
-
-                        h_parts = n_header.strip().split(' ')
-                        h_values = n_data.strip().split(' ')
-                        ns_category = h_parts[0][:-1]
-                        netstat_data[ns_category] = {}
-                        # Turn the data into a dictionary
-                        for idx, hpart in enumerate(h_parts[1:]):
-                            netstat_data[ns_category][hpart] = h_values[idx + 1]
+                data = self._read_proc_file(proc_data_path)
             except IOError:
                 # On Openshift, /proc/net/snmp is only readable by root
                 self.log.debug("Unable to read %s.", proc_data_path)
+                continue
 
-        nstat_metrics_names = {
-            'Tcp': {
-                'RetransSegs': 'system.net.tcp.retrans_segs',
-                'InSegs': 'system.net.tcp.in_segs',
-                'OutSegs': 'system.net.tcp.out_segs',
-            },
-            'TcpExt': {
-                'ListenOverflows': 'system.net.tcp.listen_overflows',
-                'ListenDrops': 'system.net.tcp.listen_drops',
-                'TCPBacklogDrop': 'system.net.tcp.backlog_drops',
-            },
-            'Udp': {
-                'InDatagrams': 'system.net.udp.in_datagrams',
-                'NoPorts': 'system.net.udp.no_ports',
-                'InErrors': 'system.net.udp.in_errors',
-                'OutDatagrams': 'system.net.udp.out_datagrams',
-                'RcvbufErrors': 'system.net.udp.rcv_buf_errors',
-                'SndbufErrors': 'system.net.udp.snd_buf_errors',
-                'InCsumErrors': 'system.net.udp.in_csum_errors'
-            }
-        }
+            # Lines come by pairs of header and values of a category
+            # TcpExt: SyncookiesSent SyncookiesRecv SyncookiesFailed EmbryonicRsts PruneCalled RcvPruned ...
+            # TcpExt: 0 0 0 0 0 0 ...
+            lines = data.splitlines()
+            for n_header, n_data in zip(lines[::2], lines[1::2]):
+                columns = self._nstat_columns.get(n_header)
+                if columns is None:
+                    columns = self._nstat_columns[n_header] = self._get_nstat_columns(n_header)
+                if columns:
+                    h_values = n_data.split()
+                    for idx, metric in columns:
+                        nstat_values.append((metric, h_values[idx]))
+
+        for metric, value in nstat_values:
+            self.rate(metric, self._parse_value(value))
+
+    def _read_proc_file(self, path):
+        """
+        Read a whole procfs file into the reused buffer, growing it when the file doesn't fit
+        """
+        size = 0
+        with io.FileIO(path) as f:
+            while True:
+                if size == len(self._proc_buffer):
+                    self._proc_buffer.extend(bytearray(len(self._proc_buffer)))
+                read = f.readinto(memoryview(self._proc_buffer)[size:])
+                if not read:
+                    break
+                size += read
+        return str(self._proc_buffer[:size])
+
+    def _get_nstat_columns(self, n_header):
+        """
+        Index in the values line of the counters we collect from a /proc/net/{netstat,snmp} header line
+        """
+        h_parts = n_header.split()
+        metrics_names = NSTAT_METRICS_NAMES.get(h_parts[0][:-1], {})
+        return [(idx, metrics_names[hpart]) for idx, hpart in enumerate(h_parts) if hpart in metrics_names]
+
+    def _cx_state_procfs(self, proc_location):
+        """
+        Collect metrics about connections state from /proc/net/{tcp,udp}{,6}, without
+        spawning `ss`. The files are streamed line by line, only counting the sockets per state.
+        """
+        self.log.debug("Using procfs to collect connection state")
+        metrics_by_proto = {}
+        for ip_version in ['4', '6']:
+            for protocol in ['tcp', 'udp']:
+                path = "{0}/net/{1}{2}".format(proc_location, protocol, '6' if ip_version == '6' else '')
+                try:
+                    with open(path, 'r') as proc_net:
+                        metrics = self._parse_proc_net_cx_state(proc_net, protocol, ip_version)
+                except IOError:
+                    if ip_version == '4':
+                        raise
+                    # IPv6 is disabled, there are no sockets to count
+                    metrics = self._parse_proc_net_cx_state([], protocol, ip_version)
+                metrics_by_proto[protocol, ip_version] = metrics
+
+        # Only send the metrics which match each file's protocol and ip version
+        for (protocol, ip_version), metrics in metrics_by_proto.iteritems():
+            for stat, metric in self.cx_state_gauge.iteritems():
+                if stat[0].endswith(ip_version) and stat[0].startswith(protocol):
+                    self.gauge(metric, metrics.get(metric))
+
+    # Parse the lines of /proc/net/{tcp,udp}{,6}, header included
+    # Returns a dict metric_name -> value, like _parse_linux_cx_state does for `ss`
+    def _parse_proc_net_cx_state(self, lines, protocol, ip_version):
+        #   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+        #    0: 0100007F:20D0 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 17361 ...
+        #    1: 0F02000A:0016 0202000A:C310 01 00000000:00000000 02:0008A5F6 00000000     0        0 20173 ...
+        counts = defaultdict(int)
+        lines = iter(lines)
+        next(lines, None)
+        for l in lines:
+            counts[l.split(None, 4)[3]] += 1
+
+        metrics = dict.fromkeys(self.cx_state_gauge.values(), 0)
+        proto = "{0}{1}".format(protocol, ip_version)
+        for state, count in counts.iteritems():
+            if protocol == 'udp':
+                metrics[self.cx_state_gauge[proto, 'connections']] += count
+            elif PROC_NET_TCP_STATES.get(state) in self.tcp_states['ss']:
+                metric = self.cx_state_gauge[proto, self.tcp_states['ss'][PROC_NET_TCP_STATES[state]]]
+                metrics[metric] += count
+
+        return metrics
 
-        # Skip the first line, as it's junk
-        for k in nstat_metrics_names:
-            for met in nstat_metrics_names[k]:
-                if met in netstat_data.get(k, {}):
-                    self.rate(nstat_metrics_names[k][met], self._parse_value(netstat_data[k][met]))
+    def _cx_state_subprocess(self):
+        """
+        Collect metrics about connections state with `ss`, or `netstat` if `ss` is not available
+        """
+        try:
+            self.log.debug("Using `ss` to collect connection state")
+            # Try using `ss` for increased performance over `netstat`
+            for ip_version in ['4', '6']:
+                for protocol in ['tcp', 'udp']:
+                    # Call `ss` for each IP version because there's no built-in way of distinguishing
+                    # between the IP versions in the output
+                    # Also calls `ss` for each protocol, because on some systems (e.g. Ubuntu 14.04), there is a
+                    # bug that print `tcp` even if it's `udp`
+                    output, _, _ = get_subprocess_output(["ss", "-n", "-{0}".format(protocol[0]), "-a", "-{0}".format(ip_version)], self.log)
+                    lines = output.splitlines()
+
+                    # State      Recv-Q Send-Q     Local Address:Port       Peer Address:Port
+                    # UNCONN     0      0              127.0.0.1:8125                  *:*
+                    # ESTAB      0      0              127.0.0.1:37036         127.0.0.1:8125
+                    # UNCONN     0      0        fe80::a00:27ff:fe1c:3c4:123          :::*
+                    # TIME-WAIT  0      0          90.56.111.177:56867        46.105.75.4:143
+                    # LISTEN     0      0       ::ffff:127.0.0.1:33217  ::ffff:127.0.0.1:7199
+                    # ESTAB      0      0       ::ffff:127.0.0.1:58975  ::ffff:127.0.0.1:2181
+
+                    metrics = self._parse_linux_cx_state(lines[1:], self.tcp_states['ss'], 0, protocol=protocol, ip_version=ip_version)
+                    # Only send the metrics which match the loop iteration's ip version
+                    for stat, metric in self.cx_state_gauge.iteritems():
+                        if stat[0].endswith(ip_version) and stat[0].startswith(protocol):
+                            self.gauge(metric, metrics.get(metric))
+
+        except OSError:
+            self.log.info("`ss` not found: using `netstat` as a fallback")
+            output, _, _ = get_subprocess_output(["netstat", "-n", "-u", "-t", "-a"], self.log)
+            lines = output.splitlines()
+            # Active Internet connections (w/o servers)
+            # Proto Recv-Q Send-Q Local Address           Foreign Address         State
+            # tcp        0      0 46.105.75.4:80          79.220.227.193:2032     SYN_RECV
+            # tcp        0      0 46.105.75.4:143         90.56.111.177:56867     ESTABLISHED
+            # tcp        0      0 46.105.75.4:50468       107.20.207.175:443      TIME_WAIT
+            # tcp6       0      0 46.105.75.4:80          93.15.237.188:58038     FIN_WAIT2
+            # tcp6       0      0 46.105.75.4:80          79.220.227.193:2029     ESTABLISHED
+            # udp        0      0 0.0.0.0:123             0.0.0.0:*
+            # udp6       0      0 :::41458                :::*
+
+            metrics = self._parse_linux_cx_state(lines[2:], self.tcp_states['netstat'], 5)
+            for metric, value in metrics.iteritems():
+                self.gauge(metric, value)
+        except SubprocessOutputEmptyError:
+            self.log.exception("Error collecting connection stats.")
 
     # Parse the output of the command that retrieves the connection state (either `ss` or `netstat`)
     # Returns a dict metric_name -> value
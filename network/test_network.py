@@ -6,6 +6,7 @@
 from collections import namedtuple
 import socket
 import os
+import time
 
 # 3p
 import mock
@@ -62,10 +63,18 @@ class TestCheckNetwork(AgentCheckTest):
         'system.net.tcp6.time_wait': 1,
     }
 
+    SS_INSTANCES = [
+        {
+            "collect_connection_state": True,
+            "connection_state_method": "ss"
+        }
+    ]
+
     @attr('unix')
     @mock.patch('_network.get_subprocess_output', side_effect=ss_subprocess_mock)
     @mock.patch('_network.Platform.is_linux', return_value=True)
     def test_cx_state_linux_ss(self, mock_subprocess, mock_platform):
+        self.check.instances = self.SS_INSTANCES
         self.run_check({})
 
         # Assert metrics
@@ -76,12 +85,133 @@ class TestCheckNetwork(AgentCheckTest):
     @mock.patch('_network.get_subprocess_output', side_effect=netstat_subprocess_mock)
     @mock.patch('_network.Platform.is_linux', return_value=True)
     def test_cx_state_linux_netstat(self, mock_subprocess, mock_platform):
+        self.check.instances = self.SS_INSTANCES
         self.run_check({})
 
         # Assert metrics
         for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
             self.assertMetric(metric, value=value)
 
+    @attr('unix')
+    @mock.patch('_network.get_subprocess_output')
+    @mock.patch('_network.Platform.is_linux', return_value=True)
+    def test_cx_state_linux_procfs(self, mock_platform, mock_subprocess):
+        self.check.agentConfig = dict(self.check.agentConfig, procfs_path=os.path.join(FIXTURE_DIR, 'fixtures', 'procfs'))
+        self.run_check({})
+
+        # Same metrics as `ss`, without spawning it
+        mock_subprocess.assert_not_called()
+        for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
+            self.assertMetric(metric, value=value, count=1)
+
+    @attr('unix')
+    @mock.patch('_network.Platform.is_linux', return_value=True)
+    def test_linux_procfs_counters(self, mock_platform):
+        self.check.agentConfig = dict(self.check.agentConfig, procfs_path=os.path.join(FIXTURE_DIR, 'fixtures', 'procfs'))
+        # Use a tiny buffer to read the files in several reads
+        self.check._proc_buffer = bytearray(16)
+        self.check.instances = [{'excluded_interfaces': ['lo']}]
+        self.run_check({})
+
+        self.assertMetric('system.net.bytes_rcvd', value=631947052, device_name='eth0', count=1)
+        self.assertMetric('system.net.packets_in.error', value=19, device_name='eth0', count=1)
+        self.assertMetric('system.net.bytes_sent', device_name='eth1', count=0)
+        self.assertMetric('system.net.bytes_sent', device_name='lo', count=0)
+        nstat_values = {
+            'system.net.tcp.retrans_segs': 7,
+            'system.net.tcp.in_segs': 3542,
+            'system.net.tcp.out_segs': 3534,
+            'system.net.tcp.listen_overflows': 11,
+            'system.net.tcp.listen_drops': 12,
+            'system.net.tcp.backlog_drops': 13,
+            'system.net.udp.in_datagrams': 20,
+            'system.net.udp.no_ports': 1,
+            'system.net.udp.in_errors': 2,
+            'system.net.udp.out_datagrams': 21,
+            'system.net.udp.rcv_buf_errors': 3,
+            'system.net.udp.snd_buf_errors': 4,
+            'system.net.udp.in_csum_errors': 5,
+        }
+        for metric, value in nstat_values.iteritems():
+            self.assertMetric(metric, value=value, count=1)
+
+    @attr('unix')
+    @mock.patch('_network.Platform.is_linux', return_value=True)
+    def test_linux_aggregated_interfaces(self, mock_platform):
+        self.check.agentConfig = dict(self.check.agentConfig, procfs_path=os.path.join(FIXTURE_DIR, 'fixtures', 'procfs'))
+        self.check.instances = [{
+            'included_interface_re': '(eth|lo).*',
+            'aggregated_interfaces': {'ethernet': 'eth.*'},
+        }]
+        self.run_check({})
+
+        # eth1 is inactive, eth0 is reported under its aggregate, which has no rate until the next run
+        self.assertMetric('system.net.bytes_rcvd', value=45890956, device_name='lo', count=1)
+        self.assertMetric('system.net.bytes_rcvd', device_name='ethernet', count=0)
+        self.assertMetric('system.net.bytes_rcvd', device_name='eth0', count=0)
+        self.assertEqual(self.check._device_names, {'lo': 'lo', 'eth0': 'ethernet'})
+        self.assertEqual(self.check._aggregated_counters.keys(), ['eth0'])
+
+        self.check.instances = [{'aggregated_interfaces': {'ethernet': 'eth.*'}, 'excluded_interfaces': ['eth0']}]
+        self.run_check({})
+        self.assertMetric('system.net.bytes_rcvd', device_name='ethernet', count=0)
+        self.assertMetric('system.net.bytes_rcvd', device_name='lo', count=1)
+
+    @mock.patch('_network.time.time')
+    def test_aggregated_interfaces_churn(self, mock_time):
+        """
+        The aggregate is the sum of the rates of its interfaces, interfaces appearing, disappearing
+        or resetting their counters don't make it drop or spike.
+        """
+        self.check._setup_interfaces({'aggregated_interfaces': {'veth': 'veth.*'}})
+
+        def run(timestamp, counters_by_iface):
+            mock_time.return_value = timestamp
+            self.check._aggregated_devicemetrics = {}
+            self.check._seen_aggregated_ifaces = set()
+            for iface, counter in counters_by_iface.iteritems():
+                vals_by_metric = dict.fromkeys(['bytes_rcvd', 'bytes_sent', 'packets_in.count',
+                                                'packets_in.error', 'packets_out.count', 'packets_out.error'], 0)
+                vals_by_metric['bytes_rcvd'] = counter
+                self.check._submit_devicemetrics(iface, vals_by_metric)
+            self.check._submit_aggregated_devicemetrics(self.check._seen_aggregated_ifaces)
+            metrics = dict(((m[0], m[3].get('device_name')), m[2]) for m in self.check.get_metrics())
+            return metrics.get(('system.net.bytes_rcvd', 'veth'))
+
+        self.assertIsNone(run(0, {'veth0': 1000, 'veth1': 5000}))
+        self.assertEqual(run(10, {'veth0': 2000, 'veth1': 6000}), 200)
+        # veth1 is gone and a busy veth2 appears: no negative rate, no spike from its absolute counter
+        self.assertEqual(run(20, {'veth0': 3000, 'veth2': 10 ** 9}), 100)
+        self.assertEqual(self.check._aggregated_counters.keys(), ['veth0', 'veth2'])
+        # veth0 counters reset
+        self.assertEqual(run(30, {'veth0': 10, 'veth2': 10 ** 9 + 500}), 50)
+
+    @attr('unix')
+    def test_cx_state_procfs_benchmark(self):
+        """
+        Parse the connection state of many sockets from procfs and from `ss` output, which must agree.
+        The `ss` timing doesn't even include running `ss` itself.
+        """
+        states = [('01', 'ESTAB'), ('06', 'TIME-WAIT'), ('0A', 'LISTEN'), ('08', 'CLOSE-WAIT'), ('02', 'SYN-SENT')]
+        proc_lines = ['  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode']
+        ss_lines = []
+        for i in xrange(50000):
+            code, name = states[i % len(states)]
+            proc_lines.append('%6d: 0F02000A:%04X 0202000A:C310 %s 00000000:00000000 02:0008A5F6 00000000     0        0 %d 4 '
+                              '0000000000000000 20 4 29 10 -1' % (i, i % 65536, code, i))
+            ss_lines.append('%-10s 0      0          10.0.2.15:%d          10.0.2.2:49936' % (name, i % 65536))
+
+        start = time.time()
+        procfs_metrics = self.check._parse_proc_net_cx_state(proc_lines, 'tcp', '4')
+        procfs_time = time.time() - start
+        start = time.time()
+        ss_metrics = self.check._parse_linux_cx_state(ss_lines, self.check.tcp_states['ss'], 0, protocol='tcp', ip_version='4')
+        ss_time = time.time() - start
+
+        self.check.log.info("Parsed 50000 sockets in %.3fs from procfs, %.3fs from ss", procfs_time, ss_time)
+        self.assertEqual(procfs_metrics, ss_metrics)
+        self.assertEqual(procfs_metrics['system.net.tcp4.established'], 10000)
+
     @mock.patch('_network.Platform.is_linux', return_value=False)
     @mock.patch('_network.Platform.is_bsd', return_value=False)
     @mock.patch('_network.Platform.is_solaris', return_value=False)
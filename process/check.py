@@ -1,8 +1,11 @@
 
 # stdlib
 from collections import defaultdict
+import errno
+import io
 import time
 import os
+import re
 # 3p
 import psutil
 
@@ -41,6 +44,181 @@ ATTR_TO_METRIC_RATE = {
     'cmajflt':          'mem.page_faults.children_major_faults'
 }
 
+# Attributes collected by the procfs reader, see ProcfsReader.sample
+PROCFS_ATTRS = [
+    'rss', 'vms', 'real', 'mem_pct', 'thr', 'cpu', 'open_fd', 'ctx_swtch_vol', 'ctx_swtch_invol',
+    'r_count', 'w_count', 'r_bytes', 'w_bytes', 'minflt', 'cminflt', 'majflt', 'cmajflt', 'run_time'
+]
+
+PROCFS_STATUS_FIELDS = {
+    'voluntary_ctxt_switches:': 'ctx_swtch_vol',
+    'nonvoluntary_ctxt_switches:': 'ctx_swtch_invol',
+}
+
+PROCFS_IO_FIELDS = {
+    'syscr:': 'r_count',
+    'syscw:': 'w_count',
+    'read_bytes:': 'r_bytes',
+    'write_bytes:': 'w_bytes',
+}
+
+
+class ProcfsReader(object):
+    """
+    Linux fast path reading the metrics of a process straight from procfs.
+    `stat`, `statm`, `status` and `io` are read once per process into a reused
+    buffer, and all the metrics are computed from them.
+    """
+    BUFFER_SIZE = 8192
+
+    def __init__(self, procfs_path):
+        self.procfs_path = procfs_path.rstrip('/')
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        self._boot_time = None
+
+    def read(self, *path):
+        with io.FileIO('/'.join((self.procfs_path,) + path)) as f:
+            size = f.readinto(self.buffer)
+            data = bytes(self.buffer[:size])
+            if size == len(self.buffer):
+                data += f.read()
+        return data
+
+    def boot_time(self):
+        if self._boot_time is None:
+            for line in self.read('stat').splitlines():
+                if line.startswith('btime'):
+                    self._boot_time = float(line.split()[1])
+                    break
+        return self._boot_time
+
+    def total_memory(self):
+        """
+        Total physical memory in bytes, None if it can't be read
+        """
+        try:
+            for line in self.read('meminfo').splitlines():
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+        return None
+
+    def sample(self, pid):
+        """
+        Read the metrics of one process, as a dict of attribute -> value plus its
+        `cpu_time` and `create_time` in seconds.
+        Raise IOError (ENOENT) if the process is gone, the metrics of the other files
+        we can't read (e.g. `io` of processes of another user) are missing.
+        """
+        # http://man7.org/linux/man-pages/man5/proc.5.html
+        stat = self.read(str(pid), 'stat')
+        # The process name can contain spaces and parentheses, fields start after the last one
+        fields = stat[stat.rfind(')') + 2:].split()
+        sample = {
+            'minflt': int(fields[7]),
+            'cminflt': int(fields[8]),
+            'majflt': int(fields[9]),
+            'cmajflt': int(fields[10]),
+            'cpu_time': (int(fields[11]) + int(fields[12])) / self.clock_ticks,
+            'thr': int(fields[17]),
+            'create_time': self.boot_time() + int(fields[19]) / self.clock_ticks,
+        }
+
+        try:
+            size, resident, shared = self.read(str(pid), 'statm').split()[:3]
+            sample['vms'] = int(size) * self.page_size
+            sample['rss'] = int(resident) * self.page_size
+            sample['real'] = (int(resident) - int(shared)) * self.page_size
+        except (IOError, OSError, ValueError):
+            pass
+
+        for filename, field_names in (('status', PROCFS_STATUS_FIELDS), ('io', PROCFS_IO_FIELDS)):
+            try:
+                for line in self.read(str(pid), filename).splitlines():
+                    parts = line.split()
+                    if len(parts) == 2 and parts[0] in field_names:
+                        sample[field_names[parts[0]]] = int(parts[1])
+            except (IOError, OSError):
+                pass
+
+        try:
+            sample['open_fd'] = len(os.listdir('%s/%s/fd' % (self.procfs_path, pid)))
+        except OSError:
+            pass
+
+        return sample
+
+
+class ProcessMatcher(object):
+    """
+    Match processes against the search strings of several instances at once.
+    Exact names are looked up in a hash map. Command lines are searched with a
+    single regex of all the substrings first, and only the few matching ones are
+    then searched for every substring to find which instances they belong to.
+    """
+    def __init__(self, search_specs):
+        # instance name -> (search_string, exact_match)
+        self.match_all = set()
+        self.names = defaultdict(set)
+        self.substrings = defaultdict(set)
+        for name, (search_string, exact_match) in search_specs.iteritems():
+            for string in search_string:
+                # FIXME 6.x: All has been deprecated from the doc, should be removed
+                if string == 'All':
+                    self.match_all.add(name)
+                elif exact_match:
+                    self.names[self._normalize(string)].add(name)
+                else:
+                    self.substrings[self._normalize(string)].add(name)
+
+        self.substrings_re = None
+        if self.substrings:
+            self.substrings_re = re.compile('|'.join(re.escape(string) for string in self.substrings))
+
+        # Instances needing the name, and the command line, of the processes
+        self.name_instances = set(name for names in self.names.itervalues() for name in names)
+        self.cmdline_instances = set(name for names in self.substrings.itervalues() for name in names)
+
+    @staticmethod
+    def _normalize(string):
+        # Process names are case-insensitive on Windows
+        if os.name == 'nt':
+            return string.lower()
+        return string
+
+    def match(self, proc_name, cmdline):
+        """
+        Return the names of the instances matching a process, `proc_name` and
+        `cmdline` are None when they were not read.
+        """
+        matched = set(self.match_all)
+        if proc_name is not None:
+            matched.update(self.names.get(self._normalize(proc_name), ()))
+        if cmdline is not None and self.substrings_re is not None:
+            cmdline = self._normalize(' '.join(cmdline))
+            if self.substrings_re.search(cmdline):
+                for string, names in self.substrings.iteritems():
+                    if string in cmdline:
+                        matched.update(names)
+        return matched
+
+    def denied(self, denied_name_pids, denied_cmdline_pids):
+        """
+        Return the pids each instance was denied access to, given the pids whose name
+        and whose command line could not be read.
+        """
+        denied_pids = {}
+        if denied_name_pids:
+            for name in self.name_instances:
+                denied_pids[name] = denied_name_pids
+        if denied_cmdline_pids:
+            for name in self.cmdline_instances:
+                denied_pids[name] = denied_cmdline_pids
+        return denied_pids
+
 
 class ProcessCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances=None):
@@ -52,7 +230,10 @@ class ProcessCheck(AgentCheck):
         # This cache is for all PIDs so it's global, but it should
         # be refreshed by instance
         self.last_ad_cache_ts = {}
-        self.ad_cache = set()
+        # pid -> fields we were denied access to, among 'name' and 'cmdline'
+        self.ad_cache = {}
+        # Pids each instance was denied access to during the last scan, indexed by instance
+        self.denied_pids = {}
         self.access_denied_cache_duration = int(
             init_config.get(
                 'access_denied_cache_duration',
@@ -86,6 +267,12 @@ class ProcessCheck(AgentCheck):
         # Process cache, indexed by instance
         self.process_cache = defaultdict(dict)
 
+        # Read the process metrics straight from procfs on Linux
+        self.procfs_batch_read = Platform.is_linux() and _is_affirmative(init_config.get('procfs_batch_read', True))
+        self.procfs_reader = None
+        # Last (create_time, cpu_time, timestamp) per pid for the procfs reader, indexed by instance
+        self.procfs_cpu_times = defaultdict(dict)
+
     def should_refresh_ad_cache(self, name):
         now = time.time()
         return now - self.last_ad_cache_ts.get(name, 0) > self.access_denied_cache_duration
@@ -97,67 +284,98 @@ class ProcessCheck(AgentCheck):
     def find_pids(self, name, search_string, exact_match, ignore_ad=True):
         """
         Create a set of pids of selected processes.
-        Search for search_string
+        Search for search_string. The processes are scanned once for all the instances
+        with a search_string, and their pid caches are refreshed together.
         """
-        if not self.should_refresh_pid_cache(name):
-            return self.pid_cache[name]
-
-        ad_error_logger = self.log.debug
-        if not ignore_ad:
-            ad_error_logger = self.log.error
-
-        refresh_ad_cache = self.should_refresh_ad_cache(name)
+        if self.should_refresh_pid_cache(name):
+            search_specs = self._get_search_specs()
+            search_specs[name] = (search_string, exact_match)
+
+            refresh_ad_cache = self.should_refresh_ad_cache(name)
+            matching_pids, denied_pids = self._scan_processes(ProcessMatcher(search_specs), refresh_ad_cache)
+
+            now = time.time()
+            for spec_name in search_specs:
+                self.pid_cache[spec_name] = matching_pids[spec_name]
+                self.last_pid_cache_ts[spec_name] = now
+                # Reported on the next find_pids of the instance
+                self.denied_pids[spec_name] = denied_pids.get(spec_name)
+                if refresh_ad_cache:
+                    self.last_ad_cache_ts[spec_name] = now
+
+        # Only the processes this instance needed to read and couldn't
+        denied_pids = self.denied_pids.pop(name, None)
+        if denied_pids and not ignore_ad:
+            self.log.error('Access denied to processes with PID %s', ', '.join(str(pid) for pid in sorted(denied_pids)))
+            # Scan again on the next run, without the processes now in the access denied cache
+            self.last_pid_cache_ts[name] = 0
+            raise psutil.AccessDenied(min(denied_pids))
+
+        return self.pid_cache[name]
+
+    def _get_search_specs(self):
+        """
+        Search strings of all the instances looking for processes by search_string,
+        indexed by instance name
+        """
+        search_specs = {}
+        for instance in self.instances or []:
+            name = instance.get('name')
+            search_string = instance.get('search_string')
+            if name is not None and isinstance(search_string, list):
+                search_specs[name] = (search_string, _is_affirmative(instance.get('exact_match', True)))
+        return search_specs
+
+    def _scan_processes(self, matcher, refresh_ad_cache):
+        """
+        Read the name and/or the command line of every process once and match them
+        against the search strings of all the instances.
+        Return the matching pids and the pids we were denied access to, per instance name.
+        """
+        matching_pids = defaultdict(set)
+        denied_name_pids = set()
+        denied_cmdline_pids = set()
 
-        matching_pids = set()
         for proc in psutil.process_iter():
-            # Skip access denied processes
-            if not refresh_ad_cache and proc.pid in self.ad_cache:
+            # Skip the fields of the processes we were denied access to
+            cached_denied = frozenset() if refresh_ad_cache else self.ad_cache.get(proc.pid, frozenset())
+            read_name = bool(matcher.names) and 'name' not in cached_denied
+            read_cmdline = bool(matcher.substrings) and 'cmdline' not in cached_denied
+            if cached_denied and not read_name and not read_cmdline and not matcher.match_all:
                 continue
 
-            found = False
-            for string in search_string:
+            proc_name = None
+            cmdline = None
+            denied = set()
+            try:
+                try:
+                    if read_name:
+                        proc_name = proc.name()
+                except psutil.AccessDenied as e:
+                    self.log.debug('Access denied to the name of process with PID %s: %s', proc.pid, e)
+                    denied_name_pids.add(proc.pid)
+                    denied.add('name')
                 try:
-                    # FIXME 6.x: All has been deprecated from the doc, should be removed
-                    if string == 'All':
-                        found = True
-                    if exact_match:
-                        if os.name == 'nt':
-                            if proc.name().lower() == string.lower():
-                                found = True
-                        else:
-                            if proc.name() == string:
-                                found = True
-
-                    else:
+                    if read_cmdline:
                         cmdline = proc.cmdline()
-                        if os.name == 'nt':
-                            lstring = string.lower()
-                            if lstring in ' '.join(cmdline).lower():
-                                found = True
-                        else:
-                            if string in ' '.join(cmdline):
-                                found = True
-                except psutil.NoSuchProcess:
-                    self.log.warning('Process disappeared while scanning')
                 except psutil.AccessDenied as e:
-                    ad_error_logger('Access denied to process with PID %s', proc.pid)
-                    ad_error_logger('Error: %s', e)
-                    if refresh_ad_cache:
-                        self.ad_cache.add(proc.pid)
-                    if not ignore_ad:
-                        raise
+                    self.log.debug('Access denied to the cmdline of process with PID %s: %s', proc.pid, e)
+                    denied_cmdline_pids.add(proc.pid)
+                    denied.add('cmdline')
+            except psutil.NoSuchProcess:
+                self.log.warning('Process disappeared while scanning')
+                continue
+
+            if refresh_ad_cache:
+                if denied:
+                    self.ad_cache[proc.pid] = denied
                 else:
-                    if refresh_ad_cache:
-                        self.ad_cache.discard(proc.pid)
-                    if found:
-                        matching_pids.add(proc.pid)
-                        break
-
-        self.pid_cache[name] = matching_pids
-        self.last_pid_cache_ts[name] = time.time()
-        if refresh_ad_cache:
-            self.last_ad_cache_ts[name] = time.time()
-        return matching_pids
+                    self.ad_cache.pop(proc.pid, None)
+
+            for name in matcher.match(proc_name, cmdline):
+                matching_pids[name].add(proc.pid)
+
+        return matching_pids, matcher.denied(denied_name_pids, denied_cmdline_pids)
 
     def psutil_wrapper(self, process, method, accessors, *args, **kwargs):
         """
@@ -202,6 +420,9 @@ class ProcessCheck(AgentCheck):
         return result
 
     def get_process_state(self, name, pids):
+        if self.procfs_batch_read:
+            return self.get_process_state_procfs(name, pids)
+
         st = defaultdict(list)
 
         # Remove from cache the processes that are not in `pids`
@@ -286,6 +507,58 @@ class ProcessCheck(AgentCheck):
 
         return st
 
+    def get_process_state_procfs(self, name, pids):
+        """
+        Linux version of get_process_state reading each process once with the procfs reader,
+        the values are stored by pid index in lists preallocated for all the pids.
+        """
+        if self.procfs_reader is None or self.procfs_reader.procfs_path != psutil.PROCFS_PATH.rstrip('/'):
+            self.procfs_reader = ProcfsReader(psutil.PROCFS_PATH)
+        reader = self.procfs_reader
+
+        st = defaultdict(list)
+        st['pids'] = list(pids)
+        for attr in PROCFS_ATTRS:
+            st[attr] = [None] * len(st['pids'])
+
+        total_memory = reader.total_memory()
+        cpu_times = self.procfs_cpu_times[name]
+        # Remove from cache the processes that are not in `pids`
+        for pid in set(cpu_times) - pids:
+            del cpu_times[pid]
+
+        for i, pid in enumerate(st['pids']):
+            try:
+                sample = reader.sample(pid)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.ENOENT, errno.ESRCH):
+                    self.log.debug('Unable to read procfs for process %s: %s', pid, e)
+                    continue
+                # Skip processes dead in the meantime
+                self.warning('Process %s disappeared while scanning' % pid)
+                # reset the PID cache now, something changed
+                self.last_pid_cache_ts[name] = 0
+                cpu_times.pop(pid, None)
+                continue
+
+            for attr, value in sample.iteritems():
+                if attr in st:
+                    st[attr][i] = value
+
+            if total_memory and sample.get('rss') is not None:
+                st['mem_pct'][i] = sample['rss'] * 100.0 / total_memory
+
+            now = time.time()
+            st['run_time'][i] = now - sample['create_time']
+
+            # No cpu.pct the first time a process is sampled, like psutil's cpu_percent
+            previous = cpu_times.get(pid)
+            if previous is not None and previous[0] == sample['create_time'] and now > previous[2]:
+                st['cpu'][i] = (sample['cpu_time'] - previous[1]) * 100.0 / (now - previous[2])
+            cpu_times[pid] = (sample['create_time'], sample['cpu_time'], now)
+
+        return st
+
     def get_pagefault_stats(self, pid):
         if not Platform.is_linux():
             return None
@@ -257,6 +257,63 @@ class ProcessCheckTest(AgentCheckTest):
         # Shouldn't throw an exception
         self.run_check(config, mocks={'get_pagefault_stats': noop_get_pagefault_stats})
 
+    def test_find_pids_single_scan(self):
+        """
+        The processes are scanned once for all instances, reading each name and cmdline once
+        """
+        config = {
+            'instances': [
+                {'name': 'ssh', 'search_string': ['ssh', 'sshd']},
+                {'name': 'java', 'search_string': ['kafka.Kafka', 'zookeeper'], 'exact_match': False},
+                {'name': 'all', 'search_string': ['All']},
+            ]
+        }
+        procs = [
+            MagicMock(pid=1, **{'name.return_value': 'sshd', 'cmdline.return_value': ['/usr/sbin/sshd', '-D']}),
+            MagicMock(pid=2, **{'name.return_value': 'java', 'cmdline.return_value': ['java', 'kafka.Kafka']}),
+            MagicMock(pid=3, **{'name.return_value': 'bash', 'cmdline.return_value': ['-bash']}),
+        ]
+        self.load_check(config)
+
+        with patch('psutil.process_iter', return_value=procs) as process_iter:
+            self.assertEquals(self.check.find_pids('ssh', ['ssh', 'sshd'], True), set([1]))
+            self.assertEquals(self.check.find_pids('java', ['kafka.Kafka', 'zookeeper'], False), set([2]))
+            self.assertEquals(self.check.find_pids('all', ['All'], True), set([1, 2, 3]))
+
+        self.assertEquals(process_iter.call_count, 1)
+        for proc in procs:
+            self.assertEquals(proc.name.call_count, 1)
+            self.assertEquals(proc.cmdline.call_count, 1)
+
+    def test_find_pids_access_denied_per_instance(self):
+        """
+        An instance only fails on the processes it couldn't read the needed field of
+        """
+        config = {
+            'instances': [
+                {'name': 'ssh', 'search_string': ['sshd'], 'ignore_denied_access': False},
+                {'name': 'java', 'search_string': ['kafka.Kafka'], 'exact_match': False, 'ignore_denied_access': False},
+            ]
+        }
+        procs = [
+            MagicMock(pid=1, **{'name.return_value': 'sshd', 'cmdline.return_value': ['/usr/sbin/sshd', '-D']}),
+            MagicMock(pid=2, **{'name.return_value': 'java', 'cmdline.side_effect': psutil.AccessDenied(2)}),
+        ]
+        self.load_check(config)
+
+        with patch('psutil.process_iter', return_value=procs):
+            # Only the command line of pid 2 was denied, which the exact match instance doesn't need
+            self.assertEquals(self.check.find_pids('ssh', ['sshd'], True, ignore_ad=False), set([1]))
+            self.assertRaises(psutil.AccessDenied, self.check.find_pids, 'java', ['kafka.Kafka'], False,
+                              ignore_ad=False)
+            self.assertEquals(self.check.ad_cache, {2: set(['cmdline'])})
+
+            # The name of pid 2 is still read for the exact match instances while its cmdline is cached as denied
+            procs[1].name.return_value = 'sshd'
+            self.check.last_pid_cache_ts = {}
+            self.assertEquals(self.check.find_pids('ssh', ['sshd'], True, ignore_ad=False), set([1, 2]))
+            self.assertEquals(self.check.find_pids('java', ['kafka.Kafka'], False, ignore_ad=False), set())
+
     def mock_find_pids(self, name, search_string, exact_match=True, ignore_ad=True,
                        refresh_ad_cache=True):
         if search_string is not None:
@@ -295,6 +352,8 @@ class ProcessCheckTest(AgentCheckTest):
         }
 
         config = {
+            # the psutil collection is mocked, don't read procfs
+            'init_config': {'procfs_batch_read': False},
             'instances': [stub['config'] for stub in self.CONFIG_STUBS]
         }
 
@@ -427,6 +486,56 @@ class ProcessCheckTest(AgentCheckTest):
         self.run_check(config, mocks={'get_pagefault_stats': noop_get_pagefault_stats})
         self.assertMetric('system.processes.cpu.pct', count=1, tags=expected_tags)
 
+    @attr('unix')
+    def test_procfs_batch_read(self):
+        """
+        Collect the process metrics from one read of the procfs files of each process
+        """
+        import tempfile
+        import shutil
+
+        my_procfs = tempfile.mkdtemp()
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        files = {
+            'stat': "cpu  13034 0 18596 380856797 2013 2 2962 0 0 0\nbtime 1448632481\n",
+            'meminfo': "MemTotal:       16384 kB\nMemFree:        8192 kB\n",
+            '42/stat': '42 (my (odd) proc) S 1 42 42 0 -1 0 10 1 20 2 %s %s 0 0 20 0 3 0 %s 0 0' % (
+                clock_ticks, clock_ticks, 10 * clock_ticks),
+            '42/statm': '300 200 50 1 0 100 0',
+            '42/status': "Name:\tmy (odd) proc\nThreads:\t3\nvoluntary_ctxt_switches:\t7\n"
+                         "nonvoluntary_ctxt_switches:\t8\n",
+            '42/io': "rchar: 1\nwchar: 2\nsyscr: 3\nsyscw: 4\nread_bytes: 5\nwrite_bytes: 6\n",
+        }
+        try:
+            os.makedirs(os.path.join(my_procfs, '42', 'fd'))
+            for path, content in files.iteritems():
+                with open(os.path.join(my_procfs, path), 'w') as f:
+                    f.write(content)
+            open(os.path.join(my_procfs, '42', 'fd', '0'), 'w').close()
+
+            self.load_check({'instances': []})
+            self.check.procfs_batch_read = True
+            with patch.object(psutil, 'PROCFS_PATH', my_procfs):
+                st = self.check.get_process_state('odd', set([42, 43]))
+                self.assertEquals(st['cpu'], [None, None])
+                st = self.check.get_process_state('odd', set([42]))
+        finally:
+            shutil.rmtree(my_procfs)
+
+        self.assertEquals(st['pids'], [42])
+        self.assertEquals(st['rss'], [200 * page_size])
+        self.assertEquals(st['vms'], [300 * page_size])
+        self.assertEquals(st['real'], [150 * page_size])
+        self.assertEquals(st['mem_pct'], [200 * page_size * 100.0 / (16384 * 1024)])
+        self.assertEquals(st['thr'], [3])
+        self.assertEquals(st['open_fd'], [1])
+        self.assertEquals((st['ctx_swtch_vol'], st['ctx_swtch_invol']), ([7], [8]))
+        self.assertEquals((st['r_count'], st['w_count'], st['r_bytes'], st['w_bytes']), ([3], [4], [5], [6]))
+        self.assertEquals((st['minflt'], st['cminflt'], st['majflt'], st['cmajflt']), ([10], [1], [20], [2]))
+        self.assertEquals(st['cpu'], [0.0])
+        self.assertTrue(st['run_time'][0] > 0)
+
     @attr('unix')
     def test_relocated_procfs(self):
         from utils.platform import Platform
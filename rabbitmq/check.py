@@ -88,6 +88,16 @@ METRIC_SUFFIX = {
     NODE_TYPE: "node",
 }
 
+# Only ask the management API for the fields we report on: full queue and
+# node objects carry e.g. the backing queue status and the GC details
+COLUMNS = {}
+for _object_type, _attributes in ATTRIBUTES.iteritems():
+    COLUMNS[_object_type] = ','.join(sorted(
+        set(path.replace('/', '.') for path, _, _ in _attributes) |
+        set(t for t in TAGS_MAP[_object_type] if t != 'queue_family')
+    ))
+BINDINGS_COLUMNS = 'vhost,destination,destination_type'
+
 
 class RabbitMQException(Exception):
     pass
@@ -103,6 +113,11 @@ class RabbitMQ(AgentCheck):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
         self.already_alerted = []
         self.cached_vhosts = {} # this is used to send CRITICAL rabbitmq.aliveness check if the server goes down
+        # Keep the connections to the management API alive between requests and runs
+        self.session = requests.Session()
+
+    def stop(self):
+        self.session.close()
 
     def _get_config(self, instance):
         # make sure 'rabbitmq_api_url' is present and get parameters
@@ -190,9 +205,10 @@ class RabbitMQ(AgentCheck):
             for vhost in self.cached_vhosts.get(base_url, []):
                 self.service_check('rabbitmq.aliveness', AgentCheck.CRITICAL, ['vhost:%s' % vhost] + custom_tags, message=u"Could not contact aliveness API")
 
-    def _get_data(self, url, auth=None, ssl_verify=True, proxies={}):
+    def _get_data(self, url, auth=None, ssl_verify=True, proxies={}, params=None):
         try:
-            r = requests.get(url, auth=auth, proxies=proxies, timeout=self.default_integration_http_timeout, verify=ssl_verify)
+            r = self.session.get(url, auth=auth, proxies=proxies, params=params,
+                                 timeout=self.default_integration_http_timeout, verify=ssl_verify)
             r.raise_for_status()
             return r.json()
         except RequestException as e:
@@ -265,7 +281,8 @@ class RabbitMQ(AgentCheck):
         """
         instance_proxy = self.get_instance_proxy(instance, base_url)
         data = self._get_data(urlparse.urljoin(base_url, object_type), auth=auth,
-                              ssl_verify=ssl_verify, proxies=instance_proxy)
+                              ssl_verify=ssl_verify, proxies=instance_proxy,
+                              params={'columns': COLUMNS[object_type]})
 
         # Make a copy of this list as we will remove items from it at each
         # iteration
@@ -301,11 +318,10 @@ class RabbitMQ(AgentCheck):
             # We truncate the list of nodes/queues if it's above the limit
             self._get_metrics(data_line, object_type, custom_tags)
 
-        # get a list of the number of bindings on a given queue
-        # /api/queues/vhost/name/bindings
+        # get the number of bindings on each queue
         if object_type is QUEUE_TYPE:
             self._get_queue_bindings_metrics(base_url, custom_tags, data, instance_proxy,
-                                            instance, object_type, auth, ssl_verify)
+                                             object_type, auth, ssl_verify)
 
     def _get_metrics(self, data, object_type, custom_tags):
         tags = self._get_tags(data, object_type, custom_tags)
@@ -326,15 +342,21 @@ class RabbitMQ(AgentCheck):
                         METRIC_SUFFIX[object_type], attribute, value, tags))
 
     def _get_queue_bindings_metrics(self, base_url, custom_tags, data, instance_proxy,
-                                    instance, object_type, auth=None, ssl_verify=True):
+                                    object_type, auth=None, ssl_verify=True):
+        # A single /api/bindings request instead of one /api/queues/vhost/name/bindings
+        # per queue: both list the same bindings, default exchange included
+        bindings = self._get_data(urlparse.urljoin(base_url, 'bindings'), auth=auth,
+                                  ssl_verify=ssl_verify, proxies=instance_proxy,
+                                  params={'columns': BINDINGS_COLUMNS})
+        bindings_count = defaultdict(int)
+        for binding in bindings:
+            if binding.get('destination_type') == 'queue':
+                bindings_count[(binding.get('vhost'), binding.get('destination'))] += 1
+
         for item in data:
-            vhost = item['vhost']
             tags = self._get_tags(item, object_type, custom_tags)
-            url = '{}/{}/{}/bindings'.format(QUEUE_TYPE, urllib.quote_plus(vhost), item['name'])
-            bindings_count = len(self._get_data(urlparse.urljoin(base_url, url), auth=auth,
-                    ssl_verify=ssl_verify, proxies=instance_proxy))
-
-            self.gauge('rabbitmq.queue.bindings.count', bindings_count, tags)
+            self.gauge('rabbitmq.queue.bindings.count',
+                       bindings_count[(item['vhost'], item['name'])], tags)
 
     def get_connections_stat(self, instance, base_url, object_type, vhosts, custom_tags, auth=None, ssl_verify=True):
         """
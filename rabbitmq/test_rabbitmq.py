@@ -218,7 +218,7 @@ class TestRabbitMQ(AgentCheckTest):
         with mock.patch('check.requests') as r:
             from check import RabbitMQ, RabbitMQException  # pylint: disable=import-error,no-name-in-module
             check = RabbitMQ('rabbitmq', {}, {"instances": [{"rabbitmq_api_url": "http://example.com"}]})
-            r.get.side_effect = [requests.exceptions.HTTPError, ValueError]
+            r.Session.return_value.get.side_effect = [requests.exceptions.HTTPError, ValueError]
             self.assertRaises(RabbitMQException, check._get_data, '')
             self.assertRaises(RabbitMQException, check._get_data, '')
 
@@ -275,3 +275,38 @@ class TestRabbitMQ(AgentCheckTest):
         from check import RabbitMQException  # pylint: disable=import-error,no-name-in-module
         self.check._get_data.side_effect = RabbitMQException
         self.assertRaises(RabbitMQException, self.check._get_vhosts, instances['instances'][0], '')
+
+    def test_queue_bindings(self):
+        instance = {"rabbitmq_api_url": "http://example.com/api/"}
+        self.load_check({"instances": [instance]})
+        queues = [
+            {"name": "q1", "vhost": "/", "node": "rabbit@host", "messages": 1},
+            {"name": "q2", "vhost": "/", "node": "rabbit@host", "messages": 2},
+            {"name": "q1", "vhost": "test", "node": "rabbit@host", "messages": 3},
+        ]
+        bindings = [
+            {"vhost": "/", "destination": "q1", "destination_type": "queue"},
+            {"vhost": "/", "destination": "q1", "destination_type": "queue"},
+            {"vhost": "/", "destination": "q2", "destination_type": "queue"},
+            {"vhost": "/", "destination": "q2", "destination_type": "exchange"},
+            {"vhost": "test", "destination": "q1", "destination_type": "queue"},
+        ]
+        responses = {
+            "http://example.com/api/queues": queues,
+            "http://example.com/api/bindings": bindings,
+        }
+        self.check._get_data = mock.MagicMock(side_effect=lambda url, **kwargs: responses[url])
+
+        self.check.get_stats(instance, instance['rabbitmq_api_url'], 'queues', 200,
+                             {'explicit': [], 'regexes': []}, [])
+        self.metrics = self.check.get_metrics()
+
+        # the bindings of all queues come from a single request
+        self.assertEqual(self.check._get_data.call_count, 2)
+        self.assertIn('columns', self.check._get_data.call_args_list[0][1]['params'])
+        self.assertMetric('rabbitmq.queue.bindings.count', value=2, count=1,
+                          tags=['rabbitmq_queue:q1', 'rabbitmq_vhost:/', 'rabbitmq_node:rabbit@host'])
+        self.assertMetric('rabbitmq.queue.bindings.count', value=1, count=1,
+                          tags=['rabbitmq_queue:q2', 'rabbitmq_vhost:/', 'rabbitmq_node:rabbit@host'])
+        self.assertMetric('rabbitmq.queue.bindings.count', value=1, count=1,
+                          tags=['rabbitmq_queue:q1', 'rabbitmq_vhost:test', 'rabbitmq_node:rabbit@host'])
@@ -1,8 +1,9 @@
 
 # stdlib
-from datetime import datetime, timedelta
+from datetime import datetime
 from hashlib import md5
 from Queue import Empty, Queue
+import random
 import re
 import ssl
 import time
@@ -11,7 +12,8 @@ import urllib3
 
 # 3p
 from pyVim import connect
-from pyVmomi import vim  # pylint: disable=E0611
+from pyVmomi import vim, vmodl  # pylint: disable=E0611
+from pyVmomi.Iso8601 import ISO8601Format, ParseISO8601
 import requests
 from vmware.vapi.vsphere.client import create_vsphere_client
 from com.vmware.vapi.std_client import DynamicID
@@ -22,6 +24,7 @@ from checks import AgentCheck
 from checks.libs.thread_pool import Pool
 from checks.libs.vmware.basic_metrics import BASIC_METRICS
 from checks.libs.vmware.all_metrics import ALL_METRICS
+from utils.persistable_store import PersistableStore
 from utils.timer import Timer
 
 SOURCE_TYPE = 'vsphere'
@@ -35,8 +38,24 @@ DEFAULT_SIZE_POOL = 4
 REFRESH_MORLIST_INTERVAL = 3 * 60
 # The interval in seconds between two refresh of metrics metadata (id<->name)
 REFRESH_METRICS_METADATA_INTERVAL = 10 * 60
+# The interval in seconds between two topology collections
+REFRESH_TOPOLOGY_INTERVAL = 3 * 60
 # The amount of jobs batched at the same time in the queue to query available metrics
 BATCH_MORLIST_SIZE = 50
+# The maximum amount of MORs queried in a single QueryPerf call
+BATCH_QUERY_PERF_SIZE = 50
+# The maximum amount of metrics vCenter accepts in a single historical QueryPerf call (vpxd.stats.maxQueryMetrics)
+MAX_QUERY_METRICS = 64
+# The share of MORs whose available metrics are queried again to validate the cached ones
+AVAILABLE_METRICS_SAMPLE_RATE = 0.05
+# The interval in seconds between two refresh of the vSphere tags metadata (id<->category/name)
+REFRESH_TAGS_METADATA_INTERVAL = 10 * 60
+# The maximum amount of objects returned per PropertyCollector page when collecting topology
+TOPOLOGY_PAGE_SIZE = 1000
+# The amount of events read at once from the event history collector
+EVENTS_PAGE_SIZE = 100
+# The maximum amount of events processed per check run, the next ones are read on the next runs
+MAX_EVENTS_PER_RUN = 1000
 
 REALTIME_RESOURCES = {'vm', 'host'}
 
@@ -70,6 +89,31 @@ class VSPHERE_RELATION_TYPE:
     CLUSTERCOMPUTERESOURCE_DATACENTER = 'vsphere-clustercomputeresource-is-located-on'
     COMPUTERESOURCE_DATACENTER = 'vsphere-computeresources-is-located-on'
 
+# Properties retrieved per resource type to build the topology and discover the MORs
+TOPOLOGY_PROPERTIES = {
+    'vm': ['name', 'customValue', 'datastore', 'config.guestId', 'config.guestFullName',
+           'config.hardware.numCPU', 'config.hardware.memoryMB', 'config.version',
+           'runtime.powerState', 'runtime.host', 'parent'],
+    'datacenter': ['name', 'datastore', 'hostFolder', 'parent'],
+    'host': ['name', 'vm', 'datastore', 'parent', 'summary.config.product.version'],
+    'datastore': ['name', 'vm', 'summary.accessible', 'summary.capacity', 'summary.type', 'summary.url'],
+    'clustercomputeresource': ['name', 'datastore', 'host', 'parent'],
+    'computeresource': ['name', 'datastore', 'host', 'parent'],
+    'folder': ['name', 'parent']
+}
+
+# Resource types of the inventory, the folders are only needed for the tags of the MORs
+INVENTORY_TYPE_MAP = dict(RESOURCE_TYPE_MAP, folder=vim.Folder)
+
+# Resource types the parents of the MORs are looked up as, most specific first
+PARENT_RESOURCE_TYPES = [
+    ('folder', vim.Folder),
+    ('datacenter', vim.Datacenter),
+    ('clustercomputeresource', vim.ClusterComputeResource),
+    ('computeresource', vim.ComputeResource),
+    ('host', vim.HostSystem),
+]
+
 class TOPOLOGY_LAYERS:
     DATASTORE = 'VSphere Datastores'
     HOST = 'VSphere Hosts'
@@ -107,6 +151,7 @@ EXCLUDE_FILTERS = {
 
 MORLIST = 'morlist'
 METRICS_METADATA = 'metrics_metadata'
+TOPOLOGY = 'topology'
 LAST = 'last'
 INTERVAL = 'interval'
 
@@ -332,6 +377,108 @@ class VSphereEvent(object):
         return self.payload
 
 
+class VSphereTagCache(object):
+    """ Tags and categories metadata of the vSphere automation API, kept for `interval` seconds
+    so a tag attached to many objects is resolved only once.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = time.time()
+        # tag id -> (category name, tag name)
+        self.tags = {}
+        # category id -> category name
+        self.categories = {}
+
+    def get(self, client, tag_id):
+        if time.time() - self.last > self.interval:
+            self.tags.clear()
+            self.categories.clear()
+            self.last = time.time()
+
+        if tag_id not in self.tags:
+            tag_model = client.tagging.Tag.get(tag_id)
+            if tag_model.category_id not in self.categories:
+                category = client.tagging.Category.get(tag_model.category_id)
+                self.categories[tag_model.category_id] = category.name.lower()
+            self.tags[tag_id] = (self.categories[tag_model.category_id], tag_model.name.lower())
+
+        return self.tags[tag_id]
+
+
+class VSphereInventory(object):
+    """ Properties of the vCenter managed objects needed for the topology and the MORs discovery.
+
+    All objects of a resource type are retrieved with one PropertyCollector `RetrievePropertiesEx`
+    call (paged with the continuation token) instead of touching the lazy pyVmomi attributes,
+    which are a SOAP round trip each.
+    """
+
+    def __init__(self, content, page_size=TOPOLOGY_PAGE_SIZE):
+        self.content = content
+        self.page_size = page_size
+        # resource type -> [(mor, properties)]
+        self.objects = {}
+        # moId -> properties, of all retrieved objects
+        self.properties_by_moid = {}
+
+    def get(self, resource_type):
+        if resource_type not in self.objects:
+            self.objects[resource_type] = self._retrieve(resource_type)
+        return self.objects[resource_type]
+
+    def properties(self, mor, resource_type):
+        self.get(resource_type)
+        return self.properties_by_moid.get(mor._moId, {})
+
+    def name(self, mor, resource_type):
+        return self.properties(mor, resource_type).get('name')
+
+    def parent_properties(self, mor):
+        """ The `name` and `parent` of a parent in the inventory tree, from the properties of its
+        resource type. Those of other objects, e.g. the root folder, are read once from the object.
+        """
+        for resource_type, vimtype in PARENT_RESOURCE_TYPES:
+            if isinstance(mor, vimtype):
+                properties = self.properties(mor, resource_type)
+                if properties:
+                    return properties
+                break
+
+        properties = self.properties_by_moid.get(mor._moId)
+        if properties is None:
+            properties = self.properties_by_moid[mor._moId] = {'name': mor.name, 'parent': mor.parent}
+        return properties
+
+    def _retrieve(self, resource_type):
+        vimtype = INVENTORY_TYPE_MAP[resource_type]
+        property_collector = self.content.propertyCollector
+        view = self.content.viewManager.CreateContainerView(self.content.rootFolder, [vimtype], True)
+        try:
+            traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverseEntities', path='view', skip=False, type=vim.view.ContainerView)
+            object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+            property_spec = vmodl.query.PropertyCollector.PropertySpec(
+                type=vimtype, pathSet=TOPOLOGY_PROPERTIES[resource_type], all=False)
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=[property_spec])
+            options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=self.page_size)
+
+            objects = []
+            result = property_collector.RetrievePropertiesEx([filter_spec], options)
+            while result:
+                for object_content in result.objects:
+                    properties = dict((prop.name, prop.val) for prop in object_content.propSet)
+                    objects.append((object_content.obj, properties))
+                    self.properties_by_moid[object_content.obj._moId] = properties
+                if not result.token:
+                    break
+                result = property_collector.ContinueRetrievePropertiesEx(result.token)
+        finally:
+            view.Destroy()
+
+        return objects
+
+
 def atomic_method(method):
     """ Decorator to catch the exceptions that happen in detached thread atomic tasks
     and display them in the logs.
@@ -356,6 +503,7 @@ class VSphereCheck(AgentCheck):
 
     SERVICE_CHECK_NAME = 'vcenter.can_connect'
     INSTANCE_TYPE = "vsphere"
+    PERSISTENCE_CHECK_NAME = "vsphere"
 
     def __init__(self, name, init_config, agentConfig, instances):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
@@ -382,6 +530,11 @@ class VSphereCheck(AgentCheck):
                     LAST: 0,
                     INTERVAL: init_config.get('refresh_metrics_metadata_interval',
                                     REFRESH_METRICS_METADATA_INTERVAL)
+                },
+                TOPOLOGY: {
+                    LAST: 0,
+                    INTERVAL: init_config.get('topology_refresh_interval',
+                                    REFRESH_TOPOLOGY_INTERVAL)
                 }
             }
 
@@ -395,8 +548,18 @@ class VSphereCheck(AgentCheck):
         self.morlist = {}
         # Metrics metadata, basically perfCounterId -> {name, group, description}
         self.metrics_metadata = {}
-
-        self.latest_event_query = {}
+        # Available perfCounterIds per (resource type, hardware/host version), reset with the metadata
+        self.available_metrics_cache = {}
+        self.available_metrics_sample_rate = float(init_config.get('available_metrics_sample_rate',
+                                                                   AVAILABLE_METRICS_SAMPLE_RATE))
+        # vSphere tags metadata, shared by all topology collectors
+        self.tag_cache = VSphereTagCache(init_config.get('refresh_tags_metadata_interval',
+                                                         REFRESH_TAGS_METADATA_INTERVAL))
+
+        # Last completed topology per instance, waiting to be sent
+        self.topology_snapshots = {}
+        # Instances with a topology collection running in the pool
+        self.topology_collecting = set()
 
     def stop(self):
         self.stop_pool()
@@ -415,6 +578,7 @@ class VSphereCheck(AgentCheck):
             self.pool.terminate()
             self.pool.join()
             self.jobs_status.clear()
+            self.topology_collecting.clear()
             assert self.pool.get_nworkers() == 0
             self.pool_started = False
 
@@ -433,38 +597,64 @@ class VSphereCheck(AgentCheck):
                 break
 
     def _query_event(self, instance):
+        """ Read the events created since the persisted resume point, page by page, with an
+        EventHistoryCollector filtered server-side on the event types we transform.
+        At most `max_events_per_run` events are processed per run, the next ones are read
+        on the next runs.
+        """
         i_key = self._instance_key(instance)
-        last_time = self.latest_event_query.get(i_key)
+        store = PersistableStore(self.PERSISTENCE_CHECK_NAME, i_key)
+        page_size = self.init_config.get('events_page_size', EVENTS_PAGE_SIZE)
+        max_events = self.init_config.get('max_events_per_run', MAX_EVENTS_PER_RUN)
 
         server_instance = self._get_server_instance(instance)
         event_manager = server_instance.content.eventManager
 
+        # Resume after the last processed event, events created in the same second have a higher key
+        last_time = store['last_event_time']
+        last_key = store['last_event_key']
+
         # Be sure we don't duplicate any event, never query the "past"
-        if not last_time:
-            last_time = self.latest_event_query[i_key] = \
-                event_manager.latestEvent.createdTime + timedelta(seconds=1)
+        if last_time is None or last_key is None:
+            latest_event = event_manager.latestEvent
+            last_time, last_key = ISO8601Format(latest_event.createdTime), latest_event.key
 
-        query_filter = vim.event.EventFilterSpec()
-        time_filter = vim.event.EventFilterSpec.ByTime(beginTime=self.latest_event_query[i_key])
-        query_filter.time = time_filter
+        query_filter = vim.event.EventFilterSpec(eventTypeId=list(EXCLUDE_FILTERS))
+        query_filter.time = vim.event.EventFilterSpec.ByTime(beginTime=ParseISO8601(last_time))
 
+        processed = 0
         try:
-            new_events = event_manager.QueryEvents(query_filter)
-            self.log.debug("Got {0} events from vCenter event manager".format(len(new_events)))
-            for event in new_events:
-                normalized_event = VSphereEvent(event, self.event_config[i_key])
-                # Can return None if the event if filtered out
-                event_payload = normalized_event.get_stackstate_payload()
-                if event_payload is not None:
-                    self.event(event_payload)
-                last_time = event.createdTime + timedelta(seconds=1)
+            collector = event_manager.CreateCollectorForEvents(query_filter)
+            try:
+                while processed < max_events:
+                    events = collector.ReadNextEvents(page_size)
+                    if not events:
+                        break
+                    for event in events:
+                        if event.key <= last_key:
+                            continue
+                        if processed == max_events:
+                            break
+                        normalized_event = VSphereEvent(event, self.event_config[i_key])
+                        # Can return None if the event if filtered out
+                        event_payload = normalized_event.get_stackstate_payload()
+                        if event_payload is not None:
+                            self.event(event_payload)
+                        last_time, last_key = ISO8601Format(event.createdTime), event.key
+                        processed += 1
+            finally:
+                collector.DestroyCollector()
+            self.log.debug("Processed {0} events from vCenter event history collector".format(processed))
         except Exception as e:
             # Don't get stuck on a failure to fetch an event
             # Ignore them for next pass
             self.log.warning("Unable to fetch Events %s", e)
-            last_time = event_manager.latestEvent.createdTime + timedelta(seconds=1)
+            latest_event = event_manager.latestEvent
+            last_time, last_key = ISO8601Format(latest_event.createdTime), latest_event.key
 
-        self.latest_event_query[i_key] = last_time
+        store['last_event_time'] = last_time
+        store['last_event_key'] = last_key
+        store.commit_status()
 
     def _instance_key(self, instance):
         i_key = instance.get('name')
@@ -605,68 +795,71 @@ class VSphereCheck(AgentCheck):
         If it's a node we want to query metric for, queue it in `self.morlist_raw` that
         will be processed by another job.
         """
-        def _get_parent_tags(mor):
+        def _get_parent_tags(inventory, properties):
             tags = []
-            if mor.parent:
+            parent = properties.get('parent')
+            while parent is not None:
+                parent_properties = inventory.parent_properties(parent)
+                name = parent_properties.get('name')
                 tag = []
-                if isinstance(mor.parent, vim.HostSystem):
-                    tag.append(u'vsphere_host:{}'.format(mor.parent.name))
-                elif isinstance(mor.parent, vim.Folder):
-                    tag.append(u'vsphere_folder:{}'.format(mor.parent.name))
-                elif isinstance(mor.parent, vim.ComputeResource):
-                    if isinstance(mor.parent, vim.ClusterComputeResource):
-                        tag.append(u'vsphere_cluster:{}'.format(mor.parent.name))
-                    tag.append(u'vsphere_compute:{}'.format(mor.parent.name))
-                elif isinstance(mor.parent, vim.Datacenter):
-                    tag.append(u'vsphere_datacenter:{}'.format(mor.parent.name))
-
-                tags = _get_parent_tags(mor.parent)
-                if tag:
-                    tags.extend(tag)
+                if isinstance(parent, vim.HostSystem):
+                    tag.append(u'vsphere_host:{}'.format(name))
+                elif isinstance(parent, vim.Folder):
+                    tag.append(u'vsphere_folder:{}'.format(name))
+                elif isinstance(parent, vim.ComputeResource):
+                    if isinstance(parent, vim.ClusterComputeResource):
+                        tag.append(u'vsphere_cluster:{}'.format(name))
+                    tag.append(u'vsphere_compute:{}'.format(name))
+                elif isinstance(parent, vim.Datacenter):
+                    tag.append(u'vsphere_datacenter:{}'.format(name))
+
+                # the tags of the upper parents come first
+                tags[:0] = tag
+                parent = parent_properties.get('parent')
 
             return tags
 
 
-        def _get_all_objs(content, vimtype, regexes=None, include_only_marked=False, tags=[]):
+        def _get_all_objs(inventory, vimtype, regexes=None, include_only_marked=False, tags=[]):
             """
-            Get all the vsphere objects associated with a given type
+            Get all the vsphere objects associated with a given type, from their properties
+            retrieved in bulk
             """
             obj_list = []
-            container = content.viewManager.CreateContainerView(
-                content.rootFolder,
-                [RESOURCE_TYPE_MAP[vimtype]],
-                True)
-
-            for c in container.view:
+            for c, properties in inventory.get(vimtype):
                 instance_tags = []
-                if not self._is_excluded(c, regexes, include_only_marked):
-                    hostname = c.name
-                    if c.parent:
-                        instance_tags += _get_parent_tags(c)
+                if not self._is_excluded_by_properties(vimtype, properties, regexes, include_only_marked):
+                    hostname = properties.get('name')
+                    instance_tags += _get_parent_tags(inventory, properties)
 
                     vsphere_type = None
+                    # MORs of the same type and version share their available metrics
+                    perf_version = None
                     if isinstance(c, vim.VirtualMachine):
                         vsphere_type = u'vsphere_type:vm'
-                        if c.runtime.powerState == vim.VirtualMachinePowerState.poweredOff:
+                        if properties.get('runtime.powerState') == vim.VirtualMachinePowerState.poweredOff:
                             continue
-                        host = c.runtime.host.name
-                        instance_tags.append(u'vsphere_host:{}'.format(host))
+                        host = properties.get('runtime.host')
+                        if host is not None:
+                            instance_tags.append(u'vsphere_host:{}'.format(inventory.name(host, 'host')))
+                        perf_version = properties.get('config.version')
                     elif isinstance(c, vim.HostSystem):
-                        # c.vm contains list of virtual machines on a host.
-                        # c.hardware - info about hardware
-                        # c.compability
                         vsphere_type = u'vsphere_type:host'
+                        perf_version = properties.get('summary.config.product.version')
                     elif isinstance(c, vim.Datastore):
                         vsphere_type = u'vsphere_type:datastore'
-                        instance_tags.append(u'vsphere_datastore:{}'.format(c.name))
+                        instance_tags.append(u'vsphere_datastore:{}'.format(hostname))
                         hostname = None
+                        # VMFS, NFS and vSAN datastores have different metrics
+                        perf_version = properties.get('summary.type')
                     elif isinstance(c, vim.Datacenter):
                         vsphere_type = u'vsphere_type:datacenter'
                         hostname = None
 
                     if vsphere_type:
                         instance_tags.append(vsphere_type)
-                    obj_list.append(dict(mor_type=vimtype, mor=c, hostname=hostname, tags=tags+instance_tags))
+                    obj_list.append(dict(mor_type=vimtype, mor=c, hostname=hostname, tags=tags+instance_tags,
+                                         perf_key=(vimtype, perf_version)))
 
             return obj_list
 
@@ -677,9 +870,12 @@ class VSphereCheck(AgentCheck):
             if i_key not in self.morlist_raw:
                 self.morlist_raw[i_key] = {}
 
+            # The properties of all the objects of a type are retrieved in bulk with the topology ones
+            inventory = VSphereInventory(server_instance.RetrieveContent(),
+                                         self.init_config.get('topology_page_size', TOPOLOGY_PAGE_SIZE))
             for resource in sorted(RESOURCE_TYPE_MAP):
                 self.morlist_raw[i_key][resource] = _get_all_objs(
-                    server_instance.RetrieveContent(),
+                    inventory,
                     resource,
                     regexes,
                     include_only_marked,
@@ -702,24 +898,42 @@ class VSphereCheck(AgentCheck):
         """
         # Host
         if isinstance(obj, vim.HostSystem):
+            return VSphereCheck._is_excluded_by_properties('host', {'name': obj.name}, regexes, include_only_marked)
+
+        # VirtualMachine
+        elif isinstance(obj, vim.VirtualMachine):
+            properties = {'name': obj.name}
+            if include_only_marked:
+                properties['customValue'] = obj.customValue
+            return VSphereCheck._is_excluded_by_properties('vm', properties, regexes, include_only_marked)
+
+        return False
+
+    @staticmethod
+    def _is_excluded_by_properties(resource_type, properties, regexes, include_only_marked):
+        """
+        Same rules as `_is_excluded`, applied on already retrieved `name` and `customValue` properties
+        """
+        # Host
+        if resource_type == 'host':
             # Based on `host_include_only_regex`
             if regexes and regexes.get('host_include') is not None:
-                match = re.search(regexes['host_include'], obj.name)
+                match = re.search(regexes['host_include'], properties.get('name'))
                 if not match:
                     return True
 
         # VirtualMachine
-        elif isinstance(obj, vim.VirtualMachine):
+        elif resource_type == 'vm':
             # Based on `vm_include_only_regex`
             if regexes and regexes.get('vm_include') is not None:
-                match = re.search(regexes['vm_include'], obj.name)
+                match = re.search(regexes['vm_include'], properties.get('name'))
                 if not match:
                     return True
 
             # Based on `include_only_marked`
             if include_only_marked:
                 monitored = False
-                for field in obj.customValue:
+                for field in properties.get('customValue') or []:
                     if field.value == VM_MONITORING_FLAG:
                         monitored = True
                         break  # we shall monitor
@@ -779,8 +993,7 @@ class VSphereCheck(AgentCheck):
 
         mor['interval'] = REAL_TIME_INTERVAL if mor['mor_type'] in REALTIME_RESOURCES else None
 
-        available_metrics = perfManager.QueryAvailablePerfMetric(
-            mor['mor'], intervalId=mor['interval'])
+        available_metrics = self._get_available_metrics(instance, perfManager, mor)
 
         mor['metrics'] = self._compute_needed_metrics(instance, available_metrics)
 
@@ -797,6 +1010,39 @@ class VSphereCheck(AgentCheck):
         self.histogram('stackstate.agent.vsphere.morlist_process_atomic.time', t.total())
         ### </TEST-INSTRUMENTATION>
 
+    def _get_available_metrics(self, instance, perfManager, mor):
+        """ Get the metrics available for one MOR. MORs sharing a perf key (resource type
+        plus hardware/host version, datastore type) share them, so only the first MOR of a key
+        and a random sample of the others are queried with QueryAvailablePerfMetric.
+        A sampled MOR whose metrics differ from the cached ones keeps its own, the cache is
+        refreshed with the metrics metadata.
+        Metrics are always returned for all instances ('*') of their counter, so the series
+        of a MOR don't depend on whether it was queried.
+        """
+        i_key = self._instance_key(instance)
+        cache = self.available_metrics_cache.setdefault(i_key, {})
+        perf_key = mor.get('perf_key')
+        counter_ids = cache.get(perf_key)
+
+        if counter_ids is None or random.random() < self.available_metrics_sample_rate:
+            available_metrics = perfManager.QueryAvailablePerfMetric(
+                mor['mor'], intervalId=mor['interval'])
+            queried_ids = frozenset(metric.counterId for metric in available_metrics)
+
+            if perf_key is not None:
+                if counter_ids is None:
+                    cache[perf_key] = queried_ids
+                elif queried_ids != counter_ids:
+                    self.log.warning(
+                        "Available metrics of MOR {0} differ from the cached ones for {1}, "
+                        "missing: {2}, extra: {3}".format(mor['mor'], perf_key, sorted(counter_ids - queried_ids),
+                                                          sorted(queried_ids - counter_ids))
+                    )
+            counter_ids = queried_ids
+
+        return [vim.PerformanceManager.MetricId(counterId=counter_id, instance='*')
+                for counter_id in sorted(counter_ids)]
+
     def _cache_morlist_process(self, instance):
         """ Empties the self.morlist_raw by popping items and running asynchronously
         the _cache_morlist_process_atomic operation that will get the available
@@ -864,6 +1110,8 @@ class VSphereCheck(AgentCheck):
         self.log.info("Finished metadata collection for instance {0}".format(i_key))
         # Reset metadata
         self.metrics_metadata[i_key] = new_metadata
+        # Available metrics are cached until the next metadata refresh
+        self.available_metrics_cache[i_key] = {}
 
         ### <TEST-INSTRUMENTATION>
         self.histogram('stackstate.agent.vsphere.metric_metadata_collection.time', t.total())
@@ -883,8 +1131,9 @@ class VSphereCheck(AgentCheck):
         return value
 
     @atomic_method
-    def _collect_metrics_atomic(self, instance, mor):
-        """ Task that collects the metrics listed in the morlist for one MOR
+    def _collect_metrics_atomic(self, instance, mors):
+        """ Task that collects the metrics listed in the morlist for a batch of MORs
+        of the same resource type with one QueryPerf call
         """
         ### <TEST-INSTRUMENTATION>
         t = Timer()
@@ -894,14 +1143,24 @@ class VSphereCheck(AgentCheck):
         server_instance = self._get_server_instance(instance)
         perfManager = server_instance.content.perfManager
 
-        query = vim.PerformanceManager.QuerySpec(maxSample=1,
-                                                 entity=mor['mor'],
-                                                 metricId=mor['metrics'],
-                                                 intervalId=mor['interval'],
-                                                 format='normal')
-        results = perfManager.QueryPerf(querySpec=[query])
-        if results:
-            for result in results[0].value:
+        queries = []
+        mor_by_moid = {}
+        for mor in mors:
+            queries.append(vim.PerformanceManager.QuerySpec(maxSample=1,
+                                                            entity=mor['mor'],
+                                                            metricId=mor['metrics'],
+                                                            intervalId=mor['interval'],
+                                                            format='normal'))
+            mor_by_moid[mor['mor']._moId] = mor
+
+        results = self._query_perf(perfManager, queries)
+        for entity_metrics in results:
+            mor = mor_by_moid.get(entity_metrics.entity._moId)
+            if mor is None:
+                self.log.debug(u"Skipping metric values of unexpected entity %s", entity_metrics.entity)
+                continue
+
+            for result in entity_metrics.value:
                 if result.id.counterId not in self.metrics_metadata[i_key]:
                     self.log.debug("Skipping this metric value, because there is no metadata about it")
                     continue
@@ -938,10 +1197,58 @@ class VSphereCheck(AgentCheck):
 
         ### <TEST-INSTRUMENTATION>
         self.histogram('stackstate.agent.vsphere.metric_colection.time', t.total())
+        self.histogram('stackstate.agent.vsphere.metric_colection.batch_size', len(mors))
         ### </TEST-INSTRUMENTATION>
 
+    def _query_perf(self, perfManager, queries):
+        """ QueryPerf a batch of query specs. vCenter faults the whole call when one of the MORs
+        is gone (e.g. `ManagedObjectNotFound`), so a faulted batch is split in halves and queried
+        again, until the faulty MORs are isolated and skipped.
+        """
+        try:
+            return perfManager.QueryPerf(querySpec=queries) or []
+        except vmodl.MethodFault as e:
+            if len(queries) == 1:
+                self.log.warning(u"Unable to query the metrics of %s: %s", queries[0].entity, e.msg)
+                return []
+            self.log.debug(u"QueryPerf of %s MORs failed, splitting the batch: %s", len(queries), e.msg)
+
+        half = len(queries) // 2
+        return self._query_perf(perfManager, queries[:half]) + self._query_perf(perfManager, queries[half:])
+
+    def _plan_query_perf_batches(self, mors):
+        """ Group the MORs per resource type in batches of at most `batch_query_perf_size` MORs.
+        Historical (non real-time) queries are also limited by vCenter to `max_query_metrics`
+        metrics per call.
+        """
+        batch_size = int(self.init_config.get('batch_query_perf_size', BATCH_QUERY_PERF_SIZE))
+        max_query_metrics = int(self.init_config.get('max_query_metrics', MAX_QUERY_METRICS))
+
+        mors_per_type = {}
+        for mor in mors:
+            mors_per_type.setdefault(mor['mor_type'], []).append(mor)
+
+        batches = []
+        for resource_type, typed_mors in mors_per_type.iteritems():
+            limit_metrics = resource_type not in REALTIME_RESOURCES and max_query_metrics > 0
+            batch = []
+            batch_metrics = 0
+            for mor in typed_mors:
+                mor_metrics = len(mor['metrics'])
+                if batch and (len(batch) >= batch_size or
+                              (limit_metrics and batch_metrics + mor_metrics > max_query_metrics)):
+                    batches.append(batch)
+                    batch = []
+                    batch_metrics = 0
+                batch.append(mor)
+                batch_metrics += mor_metrics
+            if batch:
+                batches.append(batch)
+
+        return batches
+
     def collect_metrics(self, instance):
-        """ Calls asynchronously _collect_metrics_atomic on all MORs, as the
+        """ Calls asynchronously _collect_metrics_atomic on batches of MORs, as the
         job queue is processed the Aggregator will receive the metrics.
         """
         i_key = self._instance_key(instance)
@@ -953,6 +1260,7 @@ class VSphereCheck(AgentCheck):
         self.log.debug("Collecting metrics of %d mors" % len(mors))
 
         vm_count = 0
+        mors_to_query = []
 
         for mor_name, mor in mors:
             if mor['mor_type'] == 'vm':
@@ -961,264 +1269,226 @@ class VSphereCheck(AgentCheck):
                 # self.log.debug("Skipping entity %s collection because we didn't cache its metrics yet" % mor['hostname'])
                 continue
 
-            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, mor))
+            mors_to_query.append(mor)
+
+        for batch in self._plan_query_perf_batches(mors_to_query):
+            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, batch))
 
         self.gauge('vsphere.vm.count', vm_count, tags=["vcenter_server:%s" % instance.get('name')])
 
-    def extract_tags(self, object_type, object_id):
-        sts_identifiers = []
-        labels = []
-        dynamic_id = DynamicID(type=object_type, id=object_id)
-        tag_ids = self.client.tagging.TagAssociation.list_attached_tags(dynamic_id)
-        for tag_id in tag_ids:
-            tag_model = self.client.tagging.Tag.get(tag_id)
-            category = self.client.tagging.Category.get(tag_model.category_id)
-            if category.name.lower() == "stackstate-identifier":
-                sts_identifiers.append(tag_model.name.lower())
-            else:
-                add_label_pair(labels, category.name.lower(), tag_model.name.lower())
-        return sts_identifiers, labels
+    def extract_tags(self, object_type, object_ids):
+        """ Resolve the vSphere tags attached to all the given objects of one type with a
+        single association request.
+        Returns a dict of object id -> (sts_identifiers, labels)
+        """
+        tags_per_object = dict((object_id, ([], [])) for object_id in object_ids)
+        if not object_ids:
+            return tags_per_object
 
-    def _vsphere_vms(self, content, domain="Unspecified", regexes=None, include_only_marked=False):
+        dynamic_ids = [DynamicID(type=object_type, id=object_id) for object_id in object_ids]
+        for object_tags in self.client.tagging.TagAssociation.list_attached_tags_on_objects(dynamic_ids):
+            if object_tags.object_id.id not in tags_per_object:
+                continue
+            sts_identifiers, labels = tags_per_object[object_tags.object_id.id]
+            for tag_id in object_tags.tag_ids:
+                category_name, tag_name = self.tag_cache.get(self.client, tag_id)
+                if category_name == "stackstate-identifier":
+                    sts_identifiers.append(tag_name)
+                else:
+                    add_label_pair(labels, category_name, tag_name)
+        return tags_per_object
+
+    def _vsphere_vms(self, inventory, domain="Unspecified", regexes=None, include_only_marked=False):
         obj_list = []
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder,
-            [RESOURCE_TYPE_MAP["vm"]],
-            True)
+        vms = [(mor, properties) for mor, properties in inventory.get("vm")
+               if not self._is_excluded_by_properties("vm", properties, regexes, include_only_marked)]
+        tags_per_vm = self.extract_tags("VirtualMachine", [mor._moId for mor, _ in vms])
 
-        for c in container.view:
+        for mor, properties in vms:
             topology_tags = {}
-            labels = []
-            if not self._is_excluded(c, regexes, include_only_marked):
-                hostname = c.name
-
-                if isinstance(c, vim.VirtualMachine):
-                    topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.VM
-                    topology_tags["name"] = c.name
-                    topology_tags["datastore"] = c.datastore[0]._moId
-                    topology_tags["layer"] = TOPOLOGY_LAYERS.VM
-                    topology_tags["domain"] = domain
-
-                    sts_identifiers, labels = self.extract_tags("VirtualMachine", c._moId)
-                    topology_tags["identifiers"] = sts_identifiers
-
-                    add_label_pair(labels, "name", topology_tags["name"])
-                    add_label_pair(labels, "guestId", c.config.guestId)
-                    add_label_pair(labels, "guestFullName", c.config.guestFullName)
-                    add_label_pair(labels, "numCPU", c.config.hardware.numCPU)
-                    add_label_pair(labels, "memoryMB", c.config.hardware.memoryMB)
-                topology_tags["labels"] = labels
-                obj_list.append(dict(mor_type="vm", mor=c, hostname=hostname, topo_tags=topology_tags))
+            datastores = properties.get("datastore") or []
+
+            topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.VM
+            topology_tags["name"] = properties["name"]
+            topology_tags["datastore"] = datastores[0]._moId if datastores else None
+            topology_tags["layer"] = TOPOLOGY_LAYERS.VM
+            topology_tags["domain"] = domain
+
+            sts_identifiers, labels = tags_per_vm[mor._moId]
+            topology_tags["identifiers"] = sts_identifiers
+
+            add_label_pair(labels, "name", topology_tags["name"])
+            add_label_pair(labels, "guestId", properties.get("config.guestId"))
+            add_label_pair(labels, "guestFullName", properties.get("config.guestFullName"))
+            add_label_pair(labels, "numCPU", properties.get("config.hardware.numCPU"))
+            add_label_pair(labels, "memoryMB", properties.get("config.hardware.memoryMB"))
+            topology_tags["labels"] = labels
+            obj_list.append(dict(mor_type="vm", mor=mor, hostname=properties["name"], topo_tags=topology_tags))
 
         return obj_list
 
-    def _vsphere_datacenters(self, content, domain="Unspecified", regexes=None, include_only_marked=False):
+    def _vsphere_datacenters(self, inventory, domain="Unspecified", regexes=None, include_only_marked=False):
         obj_list = []
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder,
-            [RESOURCE_TYPE_MAP["datacenter"]],
-            True)
+        datacenters = inventory.get("datacenter")
+        tags_per_dc = self.extract_tags("Datacenter", [mor._moId for mor, _ in datacenters])
+
+        # compute resources directly placed in the host folder of a datacenter
+        computeresources_per_folder = {}
+        for mor, properties in inventory.get("computeresource"):
+            parent = properties.get("parent")
+            if parent is not None:
+                computeresources_per_folder.setdefault(parent._moId, []).append(mor)
 
-        for c in container.view:
+        for mor, properties in datacenters:
             topology_tags = {}
-            labels = []
-            hostname = c.name
-
-            if isinstance(c, vim.Datacenter):
-                datastores = []
-                for datastore in c.datastore:
-                    datastores.append(datastore.name)
-                topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.DATACENTER
-                topology_tags["datastores"] = datastores
-                topology_tags["name"] = c.name
-                topology_tags["id"] = c._moId
-                topology_tags["layer"] = TOPOLOGY_LAYERS.DATACENTER
-                topology_tags["domain"] = domain
-
-                sts_identifiers, labels = self.extract_tags("Datacenter", c._moId)
-                topology_tags["identifiers"] = sts_identifiers
-
-                computeresources = []
-                clustercomputeresources = []
-
-                for computeres in c.hostFolder.childEntity:
-                    if isinstance(computeres, vim.ComputeResource):
-                        computeresources.append(computeres.name)
-                    elif isinstance(computeres, vim.CloudComputeResource):
-                        clustercomputeresources.append(computeres.name)
-
-                topology_tags["computeresources"] = computeresources
-                topology_tags["clustercomputeresources"] = clustercomputeresources
-
-                add_label_pair(labels, "name", topology_tags["name"])
-                hostname = None
+
+            topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.DATACENTER
+            topology_tags["datastores"] = [inventory.name(ds, "datastore") for ds in properties.get("datastore") or []]
+            topology_tags["name"] = properties["name"]
+            topology_tags["id"] = mor._moId
+            topology_tags["layer"] = TOPOLOGY_LAYERS.DATACENTER
+            topology_tags["domain"] = domain
+
+            sts_identifiers, labels = tags_per_dc[mor._moId]
+            topology_tags["identifiers"] = sts_identifiers
+
+            computeresources = []
+            clustercomputeresources = []
+
+            host_folder = properties.get("hostFolder")
+            for computeres in computeresources_per_folder.get(host_folder._moId if host_folder else None, []):
+                computeresources.append(inventory.name(computeres, "computeresource"))
+                if isinstance(computeres, vim.ClusterComputeResource):
+                    clustercomputeresources.append(inventory.name(computeres, "computeresource"))
+
+            topology_tags["computeresources"] = computeresources
+            topology_tags["clustercomputeresources"] = clustercomputeresources
+
+            add_label_pair(labels, "name", topology_tags["name"])
             topology_tags["labels"] = labels
-            obj_list.append(dict(mor_type="datacenter", mor=c, hostname=hostname, topo_tags=topology_tags))
+            obj_list.append(dict(mor_type="datacenter", mor=mor, hostname=None, topo_tags=topology_tags))
 
         return obj_list
 
-    def _vsphere_datastores(self, content, domain="Unspecified", regexes=None, include_only_marked=False):
+    def _vsphere_datastores(self, inventory, domain="Unspecified", regexes=None, include_only_marked=False):
         obj_list = []
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder,
-            [RESOURCE_TYPE_MAP["datastore"]],
-            True)
+        datastores = inventory.get("datastore")
+        tags_per_ds = self.extract_tags("Datastore", [mor._moId for mor, _ in datastores])
 
-        for c in container.view:
+        for mor, properties in datastores:
             topology_tags = {}
-            labels = []
-            hostname = c.name
-
-            if isinstance(c, vim.Datastore):
-                topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.DATASTORE
-                topology_tags["name"] = c.name
-                topology_tags["accessible"] = c.summary.accessible
-                topology_tags["capacity"] = c.summary.capacity
-                topology_tags["type"] = c.summary.type
-                topology_tags["url"] = c.summary.url
-                topology_tags["layer"] = TOPOLOGY_LAYERS.DATASTORE
-                topology_tags["domain"] = domain
-
-                sts_identifiers, labels = self.extract_tags("Datastore", c._moId)
-                topology_tags["identifiers"] = sts_identifiers
-
-                add_label_pair(labels, "name", topology_tags["name"])
-
-                vms = []
-                for vm in c.vm:
-                    if not self._is_excluded(vm, regexes, include_only_marked):
-                        vms.append(vm.name)
-
-                topology_tags["vms"] = vms
-                hostname = None
+
+            topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.DATASTORE
+            topology_tags["name"] = properties["name"]
+            topology_tags["accessible"] = properties.get("summary.accessible")
+            topology_tags["capacity"] = properties.get("summary.capacity")
+            topology_tags["type"] = properties.get("summary.type")
+            topology_tags["url"] = properties.get("summary.url")
+            topology_tags["layer"] = TOPOLOGY_LAYERS.DATASTORE
+            topology_tags["domain"] = domain
+
+            sts_identifiers, labels = tags_per_ds[mor._moId]
+            topology_tags["identifiers"] = sts_identifiers
+
+            add_label_pair(labels, "name", topology_tags["name"])
+
+            vms = []
+            for vm in properties.get("vm") or []:
+                vm_properties = inventory.properties(vm, "vm")
+                if not self._is_excluded_by_properties("vm", vm_properties, regexes, include_only_marked):
+                    vms.append(vm_properties.get("name"))
+
+            topology_tags["vms"] = vms
             topology_tags["labels"] = labels
-            obj_list.append(dict(mor_type="datastore", mor=c, hostname=hostname, topo_tags=topology_tags))
+            obj_list.append(dict(mor_type="datastore", mor=mor, hostname=None, topo_tags=topology_tags))
 
         return obj_list
 
-    def _vsphere_hosts(self, content, domain="Unspecified", regexes=None, include_only_marked=False):
+    def _vsphere_hosts(self, inventory, domain="Unspecified", regexes=None, include_only_marked=False):
         obj_list = []
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder,
-            [RESOURCE_TYPE_MAP["host"]],
-            True)
+        hosts = [(mor, properties) for mor, properties in inventory.get("host")
+                 if not self._is_excluded_by_properties("host", properties, regexes, include_only_marked)]
+        tags_per_host = self.extract_tags("HostSystem", [mor._moId for mor, _ in hosts])
 
-        for c in container.view:
+        for mor, properties in hosts:
             topology_tags = {}
-            labels = []
-            if not self._is_excluded(c, regexes, include_only_marked):
-                hostname = c.name
 
-                if isinstance(c, vim.HostSystem):
-                    # c.vm contains list of virtual machines on a host.
-                    # c.hardware - info about hardware
-                    # c.compatibility
-                    topology_tags["name"] = c.name
-                    topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.HOST
-                    topology_tags["layer"] = TOPOLOGY_LAYERS.HOST
-                    topology_tags["domain"] = domain
+            topology_tags["name"] = properties["name"]
+            topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.HOST
+            topology_tags["layer"] = TOPOLOGY_LAYERS.HOST
+            topology_tags["domain"] = domain
 
-                    sts_identifiers, labels = self.extract_tags("HostSystem", c._moId)
-                    topology_tags["identifiers"] = sts_identifiers
+            sts_identifiers, labels = tags_per_host[mor._moId]
+            topology_tags["identifiers"] = sts_identifiers
 
-                    host_datastores = []
-                    host_vms = []
+            host_datastores = []
+            host_vms = []
 
-                    for vm in c.vm:
-                        if not self._is_excluded(vm, regexes, include_only_marked):
-                            host_vms.append(vm.name)
-                    for ds in c.datastore:
-                        host_datastores.append(ds.name)
+            for vm in properties.get("vm") or []:
+                vm_properties = inventory.properties(vm, "vm")
+                if not self._is_excluded_by_properties("vm", vm_properties, regexes, include_only_marked):
+                    host_vms.append(vm_properties.get("name"))
+            for ds in properties.get("datastore") or []:
+                host_datastores.append(inventory.name(ds, "datastore"))
 
-                    topology_tags["datastores"] = host_datastores
-                    topology_tags["vms"] = host_vms
+            topology_tags["datastores"] = host_datastores
+            topology_tags["vms"] = host_vms
 
-                    if isinstance(c.parent, vim.ComputeResource):
-                        topology_tags["computeresource"] = c.parent.name
+            parent = properties.get("parent")
+            if isinstance(parent, vim.ComputeResource):
+                topology_tags["computeresource"] = inventory.name(parent, "computeresource")
 
-                    if isinstance(c.parent, vim.ClusterComputeResource):
-                        topology_tags["clustercomputeresource"] = c.parent.name
+            if isinstance(parent, vim.ClusterComputeResource):
+                topology_tags["clustercomputeresource"] = inventory.name(parent, "computeresource")
 
-                    add_label_pair(labels, "name", topology_tags["name"])
-                topology_tags["labels"] = labels
-                obj_list.append(dict(mor_type="host", mor=c, hostname=hostname, topo_tags=topology_tags))
+            add_label_pair(labels, "name", topology_tags["name"])
+            topology_tags["labels"] = labels
+            obj_list.append(dict(mor_type="host", mor=mor, hostname=properties["name"], topo_tags=topology_tags))
 
         return obj_list
 
-    def _vsphere_clustercomputeresources(self, content, domain="Unspecified", regexes=None, include_only_marked=False):
+    def _vsphere_computeresource_items(self, inventory, resource_type, object_type, topo_type, regexes, include_only_marked, domain):
         obj_list = []
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder,
-            [RESOURCE_TYPE_MAP["clustercomputeresource"]],
-            True)
+        computeresources = inventory.get(resource_type)
+        tags_per_cr = self.extract_tags(object_type, [mor._moId for mor, _ in computeresources])
 
-        for c in container.view:
+        for mor, properties in computeresources:
             topology_tags = {}
-            labels = []
-            hostname = c.name
-
-            if isinstance(c, vim.ClusterComputeResource):
-                topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.CLUSTERCOMPUTERESOURCE
-                topology_tags["name"] = c.name
-                topology_tags["layer"] = TOPOLOGY_LAYERS.COMPUTERESOURCE
-                topology_tags["domain"] = domain
-
-                sts_identifiers, labels = self.extract_tags("ClusterComputeResource", c._moId)
-                topology_tags["identifiers"] = sts_identifiers
-
-                datastores = []
-                hosts = []
-                for ds in c.datastore:
-                    datastores.append(ds.name)
-                for host in c.host:
-                    if not self._is_excluded(host, regexes, include_only_marked):
-                        hosts.append(host.name)
-
-                topology_tags["hosts"] = hosts
-                topology_tags["datastores"] = datastores
-                add_label_pair(labels, "name", topology_tags["name"])
+
+            topology_tags["topo_type"] = topo_type
+            topology_tags["name"] = properties["name"]
+            topology_tags["layer"] = TOPOLOGY_LAYERS.COMPUTERESOURCE
+            topology_tags["domain"] = domain
+
+            sts_identifiers, labels = tags_per_cr[mor._moId]
+            topology_tags["identifiers"] = sts_identifiers
+
+            datastores = []
+            hosts = []
+            for ds in properties.get("datastore") or []:
+                datastores.append(inventory.name(ds, "datastore"))
+            for host in properties.get("host") or []:
+                host_properties = inventory.properties(host, "host")
+                if not self._is_excluded_by_properties("host", host_properties, regexes, include_only_marked):
+                    hosts.append(host_properties.get("name"))
+
+            topology_tags["hosts"] = hosts
+            topology_tags["datastores"] = datastores
+            add_label_pair(labels, "name", topology_tags["name"])
             topology_tags["labels"] = labels
-            obj_list.append(dict(mor_type="clustercomputeresource", mor=c, hostname=hostname, topo_tags=topology_tags))
+            obj_list.append(dict(mor_type=resource_type, mor=mor, hostname=properties["name"], topo_tags=topology_tags))
 
         return obj_list
 
-    def _vsphere_computeresources(self, content, domain="Unspecified", regexes=None, include_only_marked=False):
-        obj_list = []
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder,
-            [RESOURCE_TYPE_MAP["computeresource"]],
-            True)
-
-        for c in container.view:
-            topology_tags = {}
-            labels = []
-            hostname = c.name
-
-            if isinstance(c, vim.ComputeResource):
-                topology_tags["topo_type"] = VSPHERE_COMPONENT_TYPE.COMPUTERESOURCE
-                topology_tags["name"] = c.name
-                topology_tags["layer"] = TOPOLOGY_LAYERS.COMPUTERESOURCE
-                topology_tags["domain"] = domain
-
-                sts_identifiers, labels = self.extract_tags("ComputeResource", c._moId)
-                topology_tags["identifiers"] = sts_identifiers
-
-                datastores = []
-                hosts = []
-
-                for ds in c.datastore:
-                    datastores.append(ds.name)
-                for host in c.host:
-                    if not self._is_excluded(host, regexes, include_only_marked):
-                        hosts.append(host.name)
-
-                topology_tags["hosts"] = hosts
-                topology_tags["datastores"] = datastores
-                add_label_pair(labels, "name", topology_tags["name"])
-            topology_tags["labels"] = labels
-            obj_list.append(dict(mor_type="computeresource", mor=c, hostname=hostname, topo_tags=topology_tags))
+    def _vsphere_clustercomputeresources(self, inventory, domain="Unspecified", regexes=None, include_only_marked=False):
+        return self._vsphere_computeresource_items(inventory, "clustercomputeresource", "ClusterComputeResource",
+                                                   VSPHERE_COMPONENT_TYPE.CLUSTERCOMPUTERESOURCE,
+                                                   regexes, include_only_marked, domain)
 
-        return obj_list
+    def _vsphere_computeresources(self, inventory, domain="Unspecified", regexes=None, include_only_marked=False):
+        return self._vsphere_computeresource_items(inventory, "computeresource", "ComputeResource",
+                                                   VSPHERE_COMPONENT_TYPE.COMPUTERESOURCE,
+                                                   regexes, include_only_marked, domain)
 
     def vsphere_client_connect(self, instance):
         session = requests.session()
@@ -1237,6 +1507,7 @@ class VSphereCheck(AgentCheck):
         server_instance = self._get_server_instance(instance)
         self.vsphere_client_connect(instance)
         content = server_instance.RetrieveContent()
+        inventory = VSphereInventory(content, self.init_config.get('topology_page_size', TOPOLOGY_PAGE_SIZE))
         domain = instance["host"]  # candidate also name
 
         regexes = {
@@ -1244,12 +1515,12 @@ class VSphereCheck(AgentCheck):
             'vm_include': instance.get('vm_include_only_regex')
         }
 
-        vms = self._vsphere_vms(content, domain, regexes)
-        hosts = self._vsphere_hosts(content, domain, regexes)
-        datacenters = self._vsphere_datacenters(content, domain)
-        datastores = self._vsphere_datastores(content, domain, regexes)
-        clustercomputeresources = self._vsphere_clustercomputeresources(content, domain, regexes)
-        computeresource = self._vsphere_computeresources(content, domain, regexes)
+        vms = self._vsphere_vms(inventory, domain, regexes)
+        hosts = self._vsphere_hosts(inventory, domain, regexes)
+        datacenters = self._vsphere_datacenters(inventory, domain)
+        datastores = self._vsphere_datastores(inventory, domain, regexes)
+        clustercomputeresources = self._vsphere_clustercomputeresources(inventory, domain, regexes)
+        computeresource = self._vsphere_computeresources(inventory, domain, regexes)
 
         return {
             "vms": vms,
@@ -1260,7 +1531,53 @@ class VSphereCheck(AgentCheck):
             "computeresource": computeresource
         }
 
-    def collect_topology(self,instance):
+    def collect_topology(self, instance):
+        """ Collect the topology synchronously and send it as one snapshot
+        """
+        self.send_topology(instance, self.get_topologyitems_sync(instance))
+
+    def _cache_topology(self, instance):
+        """ Queue a topology collection in the pool when the topology refresh interval expired.
+        The collection of a vCenter can take minutes, so it runs detached from the metrics cycle,
+        one collection at a time because the vSphere automation client is shared.
+        """
+        i_key = self._instance_key(instance)
+        if self.topology_collecting:
+            self.log.debug("Skipping topology collection for {0}, a collection is still running".format(i_key))
+            return
+        if not self._should_cache(instance, TOPOLOGY):
+            return
+
+        self.cache_times[i_key][TOPOLOGY][LAST] = time.time()
+        self.topology_collecting.add(i_key)
+        self.pool.apply_async(self._collect_topology_atomic, args=(instance,))
+
+    @atomic_method
+    def _collect_topology_atomic(self, instance):
+        """ Collect the topology items of one vCenter and keep them as the last completed snapshot
+        """
+        ### <TEST-INSTRUMENTATION>
+        t = Timer()
+        ### </TEST-INSTRUMENTATION>
+        i_key = self._instance_key(instance)
+        try:
+            self.topology_snapshots[i_key] = self.get_topologyitems_sync(instance)
+        finally:
+            self.topology_collecting.discard(i_key)
+
+        ### <TEST-INSTRUMENTATION>
+        self.histogram('stackstate.agent.vsphere.topology_collection.time', t.total())
+        ### </TEST-INSTRUMENTATION>
+
+    def _send_topology_snapshot(self, instance):
+        """ Send the last completed topology of this instance, if it was not sent yet
+        """
+        i_key = self._instance_key(instance)
+        topology_items = self.topology_snapshots.pop(i_key, None)
+        if topology_items is not None:
+            self.send_topology(instance, topology_items)
+
+    def send_topology(self, instance, topology_items):
 
         def build_id(vsphere_url, object_type, object_name):
             return "urn:vsphere:/{0}/{1}/{2}".format(vsphere_url, object_type, object_name)
@@ -1268,7 +1585,6 @@ class VSphereCheck(AgentCheck):
         def build_type(object_type):
             return {"name": object_type}
 
-        topology_items = self.get_topologyitems_sync(instance)
         vsphere_url = instance.get("host")
         instance_key = {"type": self.INSTANCE_TYPE, "url": vsphere_url}
 
@@ -1397,7 +1713,10 @@ class VSphereCheck(AgentCheck):
         # Second part: do the job
         self.collect_metrics(instance)
         self._query_event(instance)
-        self.collect_topology(instance)
+
+        # Topology is collected in the pool at its own interval, the last completed one is sent
+        self._cache_topology(instance)
+        self._send_topology_snapshot(instance)
 
         # For our own sanity
         self._clean()
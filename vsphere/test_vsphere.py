@@ -6,8 +6,9 @@
 import os
 
 # 3p
-from mock import Mock, MagicMock
-from pyVmomi import vim  # pylint: disable=E0611
+from mock import Mock, MagicMock, patch
+from pyVmomi import vim, vmodl  # pylint: disable=E0611
+from pyVmomi.Iso8601 import ParseISO8601
 import simplejson as json
 
 
@@ -17,13 +18,19 @@ from vmware.vapi.lib.connect import get_requests_connector
 from vmware.vapi.stdlib.client.factories import StubConfigurationFactory
 
 from vmware.vapi.vsphere.client import StubFactory
-from com.vmware.cis.tagging_client import TagModel, CategoryModel
+from com.vmware.cis.tagging_client import TagAssociation, TagModel, CategoryModel
+from com.vmware.vapi.std_client import DynamicID
 
 # datadog
-from tests.checks.common import AgentCheckTest, Fixtures
+from tests.checks.common import AgentCheckTest, Fixtures, load_class
+from utils.persistable_store import PersistableStore
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'ci')
 
+VSphereInventory = load_class("vsphere", "VSphereInventory")
+RESOURCE_TYPE_MAP = load_class("vsphere", "RESOURCE_TYPE_MAP")
+INVENTORY_TYPE_MAP = load_class("vsphere", "INVENTORY_TYPE_MAP")
+
 
 def vsphere_client():
     stub_config = StubConfigurationFactory.new_std_configuration(
@@ -79,6 +86,18 @@ class MockedMOR(Mock):
             self.customValue.append(Mock(value="StackStateMonitored"))
 
 
+def object_content(mor, properties):
+    """
+    Helper, generate a mocked PropertyCollector ObjectContent for the given MOR and properties dict.
+    """
+    prop_set = []
+    for name, val in properties.iteritems():
+        prop = Mock(val=val)
+        prop.name = name
+        prop_set.append(prop)
+    return Mock(obj=mor, propSet=prop_set)
+
+
 class MockedContainer(Mock):
     TYPES = [vim.Datacenter, vim.Datastore, vim.HostSystem, vim.VirtualMachine]
 
@@ -331,6 +350,21 @@ class TestvSphereUnit(AgentCheckTest):
         # mock pyvmomi stuff
         view_mock = MockedContainer(topology=vcenter_topology)
         viewmanager_mock = MagicMock(**{'CreateContainerView.return_value': view_mock})
+        # the discovery only reads the properties retrieved in bulk
+        def retrieve_properties(inventory, resource_type):
+            objects = []
+            for mor in view_mock.container_view(vcenter_topology, INVENTORY_TYPE_MAP[resource_type]):
+                mor._moId = mor.name
+                properties = {'name': mor.name, 'parent': mor.parent, 'customValue': mor.customValue}
+                if resource_type == 'vm':
+                    properties.update({'runtime.powerState': mor.runtime.powerState, 'runtime.host': mor.parent,
+                                       'config.version': 'vmx-13'})
+                elif resource_type == 'host':
+                    properties['summary.config.product.version'] = '6.5.0'
+                objects.append((mor, properties))
+                inventory.properties_by_moid[mor._moId] = properties
+            return objects
+
         content_mock = MagicMock(viewManager=viewmanager_mock)
         server_mock = MagicMock()
         server_mock.configure_mock(**{'RetrieveContent.return_value': content_mock})
@@ -338,16 +372,23 @@ class TestvSphereUnit(AgentCheckTest):
 
 
         # Discover hosts and virtual machines
-        discover_mor(instance, tags, include_regexes, include_only_marked)
+        with patch('_vsphere.VSphereInventory._retrieve', autospec=True, side_effect=retrieve_properties) as retrieve:
+            discover_mor(instance, tags, include_regexes, include_only_marked)
 
-        # Assertions: 1 labaled+monitored VM + 2 hosts + 2 datacenters.
-        self.assertMOR(instance, count=7)
+        # One bulk retrieval per resource type
+        self.assertEqual(sorted(call[0][1] for call in retrieve.call_args_list), sorted(INVENTORY_TYPE_MAP))
+        perf_versions = set(mor['perf_key'][1] for mors in self.check.morlist_raw[instance['name']].itervalues()
+                            for mor in mors)
+        self.assertEqual(perf_versions, set([None, 'vmx-13', '6.5.0']))
+
+        # Assertions: 1 labaled+monitored VM + 2 hosts + 2 datacenters + 2 clusters, also listed as compute resources.
+        self.assertMOR(instance, count=9)
 
         # ... on hosts
         self.assertMOR(instance, spec="host", count=2)
         self.assertMOR(
             instance,
-            name="host2", spec="host",
+            name="host2", spec="host", count=1,
             tags=[
                 u"toto", u"vsphere_folder:rootFolder", u"vsphere_datacenter:datacenter1",
                 u"vsphere_compute:compute_resource1", u"vsphere_cluster:compute_resource1",
@@ -356,7 +397,7 @@ class TestvSphereUnit(AgentCheckTest):
         )
         self.assertMOR(
             instance,
-            name="host3", spec="host",
+            name="host3", spec="host", count=1,
             tags=[
                 u"toto", u"vsphere_folder:rootFolder", u"vsphere_folder:folder1",
                 u"vsphere_datacenter:datacenter2", u"vsphere_compute:compute_resource2",
@@ -365,10 +406,10 @@ class TestvSphereUnit(AgentCheckTest):
         )
 
         # ...on VMs
-        self.assertMOR(instance, spec="vm")
+        self.assertMOR(instance, spec="vm", count=1)
         self.assertMOR(
             instance,
-            name="vm4", spec="vm", subset=True,
+            name="vm4", spec="vm", subset=True, count=1,
             tags=[
                 u"toto", u"vsphere_folder:folder1", u"vsphere_datacenter:datacenter2",
                 u"vsphere_compute:compute_resource2",u"vsphere_cluster:compute_resource2",
@@ -376,49 +417,227 @@ class TestvSphereUnit(AgentCheckTest):
             ]
         )
 
+    def test_collect_metrics_batched_query_perf(self):
+        """
+        Query the metrics of several MORs with one QueryPerf call per batch and map the results back to their MOR.
+        """
+        instance = {'name': 'vsphere_mock'}
+        self.check.init_config = {'batch_query_perf_size': 2}
+        self.check.metrics_metadata = {'vsphere_mock': {2: {'name': 'cpu.usage', 'unit': 'percent', 'instance_tag': 'instance'}}}
+        metric_ids = [vim.PerformanceManager.MetricId(counterId=2, instance='')]
+        self.check.morlist = {'vsphere_mock': dict(
+            ('vm-%s' % i, dict(mor_type='vm', mor=vim.VirtualMachine('vm-%s' % i), hostname='vm%s' % i,
+                               tags=[], interval=20, metrics=metric_ids))
+            for i in range(3)
+        )}
+
+        def query_perf(querySpec):
+            # answer in reverse order, results are matched on their entity
+            return [
+                Mock(entity=query.entity, value=[Mock(id=Mock(counterId=2, instance=''), value=[int(query.entity._moId[3:]) * 1000])])
+                for query in reversed(querySpec)
+            ]
+
+        perf_manager = MagicMock(**{'QueryPerf.side_effect': query_perf})
+        server_mock = MagicMock(content=MagicMock(perfManager=perf_manager))
+        self.check._get_server_instance = MagicMock(return_value=server_mock)
+
+        self.check.collect_metrics(instance)
+        self.metrics = self.check.get_metrics()
+
+        self.assertEqual(perf_manager.QueryPerf.call_count, 2)
+        for i in range(3):
+            self.assertMetric('vsphere.cpu.usage', value=i * 10.0, hostname='vm%s' % i, count=1)
+
+    def test_collect_metrics_query_perf_stale_mor(self):
+        """
+        A MOR that is gone faults the whole QueryPerf call, the batch is split to collect the other MORs.
+        """
+        instance = {'name': 'vsphere_mock'}
+        self.check.init_config = {'batch_query_perf_size': 4}
+        self.check.metrics_metadata = {'vsphere_mock': {2: {'name': 'cpu.usage', 'unit': 'percent', 'instance_tag': 'instance'}}}
+        metric_ids = [vim.PerformanceManager.MetricId(counterId=2, instance='')]
+        self.check.morlist = {'vsphere_mock': dict(
+            ('vm-%s' % i, dict(mor_type='vm', mor=vim.VirtualMachine('vm-%s' % i), hostname='vm%s' % i,
+                               tags=[], interval=20, metrics=metric_ids))
+            for i in range(4)
+        )}
+
+        def query_perf(querySpec):
+            if any(query.entity._moId == 'vm-2' for query in querySpec):
+                raise vmodl.fault.ManagedObjectNotFound(obj=vim.VirtualMachine('vm-2'))
+            return [
+                Mock(entity=query.entity, value=[Mock(id=Mock(counterId=2, instance=''), value=[int(query.entity._moId[3:]) * 1000])])
+                for query in querySpec
+            ]
+
+        perf_manager = MagicMock(**{'QueryPerf.side_effect': query_perf})
+        server_mock = MagicMock(content=MagicMock(perfManager=perf_manager))
+        self.check._get_server_instance = MagicMock(return_value=server_mock)
+
+        self.check.collect_metrics(instance)
+        self.metrics = self.check.get_metrics()
+
+        # the batch of 4, its 2 halves, then the 2 MORs of the faulty half
+        self.assertEqual(perf_manager.QueryPerf.call_count, 5)
+        for i in [0, 1, 3]:
+            self.assertMetric('vsphere.cpu.usage', value=i * 10.0, hostname='vm%s' % i, count=1)
+        self.assertMetric('vsphere.cpu.usage', hostname='vm2', count=0)
+
+    def test_plan_query_perf_batches(self):
+        """
+        Batch MORs per resource type, historical queries are limited to `max_query_metrics` metrics.
+        """
+        self.check.init_config = {'batch_query_perf_size': 3, 'max_query_metrics': 64}
+        vms = [dict(mor_type='vm', metrics=range(40)) for _ in range(4)]
+        datastores = [dict(mor_type='datastore', metrics=range(40)) for _ in range(2)]
+
+        batches = self.check._plan_query_perf_batches(vms + datastores)
+
+        self.assertEqual(sorted(len(batch) for batch in batches if batch[0]['mor_type'] == 'vm'), [1, 3])
+        self.assertEqual([len(batch) for batch in batches if batch[0]['mor_type'] == 'datastore'], [1, 1])
+        for batch in batches:
+            self.assertEqual(len(set(mor['mor_type'] for mor in batch)), 1)
+
+    def test_available_metrics_cached_per_perf_key(self):
+        """
+        Query the available metrics once per perf key, a sampled MOR with other metrics keeps its own
+        without replacing the cached ones.
+        """
+        instance = {'name': 'vsphere_mock'}
+        perf_manager = Mock()
+        perf_manager.QueryAvailablePerfMetric.side_effect = lambda mor, intervalId: [
+            vim.PerformanceManager.MetricId(counterId=counter_id, instance=counter_instance)
+            for counter_id in ([1, 2, 3] if mor == 'vm-13' else [1, 2]) for counter_instance in ['', '0']
+        ]
+        self.check.available_metrics_sample_rate = 0
+        vms = [dict(mor='vm-%s' % i, mor_type='vm', interval=20, perf_key=('vm', 'vmx-13')) for i in range(10, 13)]
+
+        for vm in vms:
+            metrics = self.check._get_available_metrics(instance, perf_manager, vm)
+            # the queried MOR and the cached ones get the same metric ids
+            self.assertEqual([(metric.counterId, metric.instance) for metric in metrics], [(1, '*'), (2, '*')])
+
+        self.assertEqual(perf_manager.QueryAvailablePerfMetric.call_count, 1)
+
+        self.check.available_metrics_sample_rate = 1
+        self.check.log = Mock()
+        metrics = self.check._get_available_metrics(instance, perf_manager, dict(vms[0], mor='vm-13'))
+        self.assertEqual(sorted(metric.counterId for metric in metrics), [1, 2, 3])
+        self.assertEqual(self.check.log.warning.call_count, 1)
+        self.check.available_metrics_sample_rate = 0
+        metrics = self.check._get_available_metrics(instance, perf_manager, vms[0])
+        self.assertEqual(sorted(metric.counterId for metric in metrics), [1, 2])
+        self.assertEqual(perf_manager.QueryAvailablePerfMetric.call_count, 2)
+
+    def test_query_event_paged_with_resume_point(self):
+        """
+        Read events page by page from a history collector, at most `max_events_per_run` per run,
+        and resume from the last processed event on the next run.
+        """
+        def vm_message_event(key):
+            return vim.event.VmMessageEvent(
+                key=key, createdTime=ParseISO8601('2017-08-28T10:00:0%sZ' % key), fullFormattedMessage="vm%s is on" % key,
+                vm=vim.event.VmEventArgument(name='vm%s' % key, vm=vim.VirtualMachine('vm-%s' % key)))
+
+        history = [vm_message_event(key) for key in range(1, 6)]
+        queried_filters = []
+        collectors = []
+
+        def create_collector(query_filter):
+            queried_filters.append(query_filter)
+            begin = query_filter.time.beginTime
+            events = [event for event in history if event.createdTime >= begin]
+            collectors.append(Mock(
+                ReadNextEvents=lambda page_size: [events.pop(0) for _ in range(min(page_size, len(events)))]))
+            return collectors[-1]
+
+        event_manager = Mock(latestEvent=history[0])
+        event_manager.CreateCollectorForEvents.side_effect = create_collector
+        self.check._get_server_instance = Mock(return_value=Mock(content=Mock(eventManager=event_manager)))
+        self.check.init_config = {'events_page_size': 2, 'max_events_per_run': 3}
+        instance = {'name': 'vsphere_events'}
+        self.check.event_config[instance['name']] = None
+        PersistableStore(self.check.PERSISTENCE_CHECK_NAME, instance['name']).clear_status()
+
+        self.check._query_event(instance)
+        self.assertEqual([event['msg_text'] for event in self.check.get_events()],
+                         [u"@@@\nvm%s is on\n@@@" % key for key in (2, 3, 4)])
+        self.assertIn('VmMessageEvent', queried_filters[0].eventTypeId)
+
+        self.check._query_event(instance)
+        self.assertEqual([event['msg_text'] for event in self.check.get_events()], [u"@@@\nvm5 is on\n@@@"])
+        for collector in collectors:
+            self.assertEqual(collector.DestroyCollector.call_count, 1)
+
 
 class TestVsphereTopo(AgentCheckTest):
 
     CHECK_NAME = "vsphere"
 
-    def mock_content(self, vimtype):
-        # summary object for datastore
-        ds_summary = MockedMOR(accessible="true", capacity=987959765, type="VMFS",
-                               url='/vmfs/volumes/54183927-04f91918-a72a-6805ca147c55')
-        # hardware and config object needed for vms
-        vm_config_hardware = MockedMOR(numCPU=1, memoryMB=4096)
-        config = MockedMOR(guestId='ubuntu64Guest', guestFullName='Ubuntu Linux (64-bit)', hardware=vm_config_hardware)
-
-        datastore = MockedMOR(spec='Datastore', _moId="54183927-04f91918-a72a-6805ca147c55", name="WDC1TB")
-        virtualmachine = MockedMOR(spec="VirtualMachine", name="Ubuntu", datastore=[datastore], config=config, _moId="vm-12")
-        host = MockedMOR(spec="HostSystem", name="localhost.localdomain", datastore=[datastore], vm=[virtualmachine], _moId="host-1")
-        computeresource = MockedMOR(spec="ComputeResource", name="localhost", datastore=[datastore], host=[host], _moId="cr-1")
-        clustercomputeresource = MockedMOR(spec="ClusterComputeResource", name="local",
-                                           datastore=[datastore], host=[host], _moId="ccr-12")
-
-        datacenter = MockedMOR(spec="Datacenter", name="da-Datacenter", _moId="54183347-04d231918",
-                               hostFolder=MockedMOR(childEntity=[computeresource]), datastore=[datastore])
-
-        if vimtype == 'vm':
-            view_mock = MagicMock(view=[virtualmachine])
-        elif vimtype == 'dc':
-            view_mock = MagicMock(view=[datacenter])
-        elif vimtype == 'ds':
-            datastore.summary = ds_summary
-            datastore.vm = [virtualmachine]
-            view_mock = MagicMock(view=[datastore])
-        elif vimtype == 'host':
-            host.parent = computeresource
-            view_mock = MagicMock(view=[host])
-        elif vimtype == 'cluster':
-            view_mock = MagicMock(view=[clustercomputeresource])
-        else:
-            view_mock = MagicMock(view=[computeresource])
+    def mock_content(self, page_size=None):
+        """
+        Mock the PropertyCollector of the content, answering with the properties of one object per resource type,
+        split in pages of `page_size` objects when given.
+        """
+        datastore = vim.Datastore("54183927-04f91918-a72a-6805ca147c55")
+        virtualmachine = vim.VirtualMachine("vm-12")
+        host = vim.HostSystem("host-1")
+        computeresource = vim.ComputeResource("cr-1")
+        clustercomputeresource = vim.ClusterComputeResource("ccr-12")
+        datacenter = vim.Datacenter("54183347-04d231918")
+        host_folder = vim.Folder("group-h4")
+
+        properties_per_type = {
+            vim.VirtualMachine: [(virtualmachine, {
+                "name": "Ubuntu", "customValue": [], "datastore": [datastore],
+                "config.guestId": "ubuntu64Guest", "config.guestFullName": "Ubuntu Linux (64-bit)",
+                "config.hardware.numCPU": 1, "config.hardware.memoryMB": 4096
+            })],
+            vim.Datacenter: [(datacenter, {"name": "da-Datacenter", "datastore": [datastore], "hostFolder": host_folder})],
+            vim.HostSystem: [(host, {
+                "name": "localhost.localdomain", "vm": [virtualmachine], "datastore": [datastore], "parent": computeresource
+            })],
+            vim.Datastore: [(datastore, {
+                "name": "WDC1TB", "vm": [virtualmachine], "summary.accessible": "true", "summary.capacity": 987959765,
+                "summary.type": "VMFS", "summary.url": "/vmfs/volumes/54183927-04f91918-a72a-6805ca147c55"
+            })],
+            vim.ClusterComputeResource: [(clustercomputeresource, {"name": "local", "datastore": [datastore], "host": [host]})],
+            vim.ComputeResource: [(computeresource, {
+                "name": "localhost", "datastore": [datastore], "host": [host], "parent": host_folder
+            })]
+        }
 
-        viewmanager_mock = MagicMock(**{'CreateContainerView.return_value': view_mock})
-        content_mock = MagicMock(viewManager=viewmanager_mock)
+        pages = []
+
+        def result_page(objects):
+            if page_size and len(objects) > page_size:
+                pages.append(objects[page_size:])
+                token = "page-%s" % len(pages)
+            else:
+                token = None
+            object_contents = [object_content(mor, properties) for mor, properties in objects[:page_size]]
+            return MagicMock(objects=object_contents, token=token)
+
+        def retrieve_properties(filter_specs, options):
+            return result_page(properties_per_type[filter_specs[0].propSet[0].type])
+
+        def continue_retrieve_properties(token):
+            return result_page(pages[int(token.split("-")[1]) - 1])
+
+        property_collector_mock = MagicMock(**{
+            'RetrievePropertiesEx.side_effect': retrieve_properties,
+            'ContinueRetrievePropertiesEx.side_effect': continue_retrieve_properties
+        })
+        # the container view is a real managed object reference for the PropertyCollector specs
+        container_view = vim.view.ContainerView("session[52a1]container-view", MagicMock())
+        viewmanager_mock = MagicMock(**{'CreateContainerView.return_value': container_view})
+        content_mock = MagicMock(viewManager=viewmanager_mock, propertyCollector=property_collector_mock)
         return content_mock
 
+    def mock_inventory(self, page_size=None):
+        return VSphereInventory(self.mock_content(page_size))
+
     def test_vsphere_vms(self):
         """
         Test if the vsphere_vms returns the VM list and labels
@@ -430,14 +649,14 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns empty list of tags
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=[])
+        # list_attached_tags_on_objects method returns no tags for any object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[])
 
         # assign the vsphere client object to the vsphere check client object
         self.check.client = client
 
-        content_mock = self.mock_content("vm")
-        obj_list = self.check._vsphere_vms(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_vms(inventory, "ESXi")
 
         self.assertEqual(len(obj_list), 1)
         self.assertEqual(obj_list[0]['hostname'], 'Ubuntu')
@@ -473,8 +692,10 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns list of tags ids of type string
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=['123'])
+        # list_attached_tags_on_objects method returns the tag ids of type string attached per object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[
+            TagAssociation.ObjectToTags(object_id=DynamicID(type="Datacenter", id="54183347-04d231918"), tag_ids=['123'])
+        ])
         # get method of Tag returns a TagModel object which is returned
         client.tagging.Tag.get = MagicMock(return_value=tags)
         # get method of Category returns a CategoryModel object which is returned
@@ -483,8 +704,8 @@ class TestVsphereTopo(AgentCheckTest):
         # assign the vsphere client object to the check vsphere client object
         self.check.client = client
 
-        content_mock = self.mock_content("dc")
-        obj_list = self.check._vsphere_datacenters(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_datacenters(inventory, "ESXi")
 
         # expect a label coming from Tagging model of datacenter
         expected_name_label = obj_list[0]['topo_tags']["labels"][0]
@@ -508,20 +729,20 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns list of tags ids of type string
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=[])
+        # list_attached_tags_on_objects method returns no tags for any object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[])
 
         # assign the vsphere client object to the check vsphere client object
         self.check.client = client
 
-        content_mock = self.mock_content("dc")
-        obj_list = self.check._vsphere_datacenters(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_datacenters(inventory, "ESXi")
 
         # expect an empty identifier list
         self.assertEqual(len(obj_list[0]['topo_tags']['identifiers']), 0)
 
-        content_mock = self.mock_content("ds")
-        obj_list = self.check._vsphere_datastores(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_datastores(inventory, "ESXi")
 
         self.assertEqual(len(obj_list), 1)
         self.assertEqual(obj_list[0]['topo_tags']['type'], 'VMFS')
@@ -544,8 +765,10 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns list of tags ids of type string
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=['123'])
+        # list_attached_tags_on_objects method returns the tag ids of type string attached per object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[
+            TagAssociation.ObjectToTags(object_id=DynamicID(type="HostSystem", id="host-1"), tag_ids=['123'])
+        ])
         # get method of Tag returns a TagModel object which is returned
         client.tagging.Tag.get = MagicMock(return_value=tags)
         # get method of Category returns a CategoryModel object which is returned
@@ -554,8 +777,8 @@ class TestVsphereTopo(AgentCheckTest):
         # assign the vsphere client object to the check vsphere client object
         self.check.client = client
 
-        content_mock = self.mock_content("host")
-        obj_list = self.check._vsphere_hosts(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_hosts(inventory, "ESXi")
 
         # one identifier expected
         self.assertEqual(len(obj_list[0]['topo_tags']['identifiers']), 1)
@@ -570,6 +793,35 @@ class TestVsphereTopo(AgentCheckTest):
         self.assertEqual(obj_list[0]['topo_tags']['datastores'][0], 'WDC1TB')
         self.assertEqual(obj_list[0]['topo_tags']['computeresource'], 'localhost')
 
+    def test_extract_tags_bulk_and_cached(self):
+        """
+        Test if the tags of all objects are fetched in one request and tag metadata is resolved once
+        """
+        config = {}
+        self.load_check(config)
+
+        category = VsphereCategory('345', 'stackstate-identifier')
+        tags = VsphereTag('123', 'vishal-test', '345')
+
+        client = vsphere_client()
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[
+            TagAssociation.ObjectToTags(object_id=DynamicID(type="VirtualMachine", id="vm-1"), tag_ids=['123']),
+            TagAssociation.ObjectToTags(object_id=DynamicID(type="VirtualMachine", id="vm-2"), tag_ids=['123'])
+        ])
+        client.tagging.Tag.get = MagicMock(return_value=tags)
+        client.tagging.Category.get = MagicMock(return_value=category)
+        self.check.client = client
+
+        tags_per_object = self.check.extract_tags("VirtualMachine", ["vm-1", "vm-2", "vm-3"])
+        self.check.extract_tags("VirtualMachine", ["vm-1"])
+
+        self.assertEqual(tags_per_object["vm-1"], (["vishal-test"], []))
+        self.assertEqual(tags_per_object["vm-2"], (["vishal-test"], []))
+        self.assertEqual(tags_per_object["vm-3"], ([], []))
+        self.assertEqual(client.tagging.TagAssociation.list_attached_tags_on_objects.call_count, 2)
+        self.assertEqual(client.tagging.Tag.get.call_count, 1)
+        self.assertEqual(client.tagging.Category.get.call_count, 1)
+
     def test_vsphere_clustercomputeresources(self):
         """
         Test if the vsphere_clustercomputeresources returns the cluster list
@@ -581,14 +833,14 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns list of tags ids of type string
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=[])
+        # list_attached_tags_on_objects method returns no tags for any object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[])
 
         # assign the vsphere client object to the check vsphere client object
         self.check.client = client
 
-        content_mock = self.mock_content("cluster")
-        obj_list = self.check._vsphere_clustercomputeresources(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_clustercomputeresources(inventory, "ESXi")
 
         # expect an empty identifier list
         self.assertEqual(len(obj_list[0]['topo_tags']['identifiers']), 0)
@@ -612,14 +864,14 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns list of tags ids of type string
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=[])
+        # list_attached_tags_on_objects method returns no tags for any object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[])
 
         # assign the vsphere client object to the check vsphere client object
         self.check.client = client
 
-        content_mock = self.mock_content("compute")
-        obj_list = self.check._vsphere_computeresources(content_mock, "ESXi")
+        inventory = self.mock_inventory()
+        obj_list = self.check._vsphere_computeresources(inventory, "ESXi")
 
         # expect an empty identifier list
         self.assertEqual(len(obj_list[0]['topo_tags']['identifiers']), 0)
@@ -639,9 +891,9 @@ class TestVsphereTopo(AgentCheckTest):
         config = {}
         self.load_check(config)
 
-        content_mock = self.mock_content("vm")
+        inventory = self.mock_inventory()
         regex = {"vm_include": "host12"}
-        obj_list_regex = self.check._vsphere_vms(content_mock, domain="ESXi", regexes=regex)
+        obj_list_regex = self.check._vsphere_vms(inventory, domain="ESXi", regexes=regex)
 
         self.assertEqual(len(obj_list_regex), 0)
 
@@ -655,7 +907,7 @@ class TestVsphereTopo(AgentCheckTest):
         self.check._is_excluded = MagicMock(return_value=False)
 
         server_mock = MagicMock()
-        server_mock.configure_mock(**{'RetrieveContent.return_value': self.mock_content("vm")})
+        server_mock.configure_mock(**{'RetrieveContent.return_value': self.mock_content()})
         self.check._get_server_instance = MagicMock(return_value=server_mock)
 
         # mock the vpshere client connect
@@ -668,8 +920,10 @@ class TestVsphereTopo(AgentCheckTest):
         # get the client
         client = vsphere_client()
 
-        # list_attached_tags method returns list of tags ids of type string
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=['123'])
+        # list_attached_tags_on_objects method returns the tag ids of type string attached per object
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[
+            TagAssociation.ObjectToTags(object_id=DynamicID(type="VirtualMachine", id="vm-12"), tag_ids=['123'])
+        ])
         # get method of Tag returns a TagModel object which is returned
         client.tagging.Tag.get = MagicMock(return_value=tags)
         # get method of Category returns a CategoryModel object which is returned
@@ -749,11 +1003,15 @@ class TestVsphereTopo(AgentCheckTest):
         # self.check._is_excluded = MagicMock(return_value=False)
 
         server_mock = MagicMock()
-        server_mock.configure_mock(**{'RetrieveContent.return_value': self.mock_content("vm")})
+        server_mock.configure_mock(**{'RetrieveContent.return_value': self.mock_content()})
         self.check._get_server_instance = MagicMock(return_value=server_mock)
 
         # mock the vpshere client connect
         self.check.vsphere_client_connect = MagicMock()
+        # get the client
+        client = vsphere_client()
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[])
+        self.check.client = client
 
         topo_dict = self.check.get_topologyitems_sync(instance)
         self.assertEqual(len(topo_dict["vms"]), 0)
@@ -768,16 +1026,86 @@ class TestVsphereTopo(AgentCheckTest):
         # self.check._is_excluded = MagicMock(return_value=False)
 
         server_mock = MagicMock()
-        server_mock.configure_mock(**{'RetrieveContent.return_value': self.mock_content("host")})
+        server_mock.configure_mock(**{'RetrieveContent.return_value': self.mock_content()})
         self.check._get_server_instance = MagicMock(return_value=server_mock)
 
         # mock the vpshere client connect
         self.check.vsphere_client_connect = MagicMock()
         # get the client
         client = vsphere_client()
-        client.tagging.TagAssociation.list_attached_tags = MagicMock(return_value=[])
+        client.tagging.TagAssociation.list_attached_tags_on_objects = MagicMock(return_value=[])
         self.check.client = client
 
         topo_dict = self.check.get_topologyitems_sync(instance)
         self.assertEqual(len(topo_dict["hosts"]), 1)
         self.assertEqual(len(topo_dict["hosts"][0]['topo_tags']['identifiers']), 0)
+
+    def test_inventory_retrieves_properties_in_pages(self):
+        """
+        Test if the inventory retrieves all objects of a type with one PropertyCollector call, following the continuation token
+        """
+        content_mock = self.mock_content(page_size=1)
+        inventory = VSphereInventory(content_mock, page_size=1)
+
+        hosts = inventory.get("host")
+        inventory.get("host")
+        self.assertEqual(len(hosts), 1)
+        self.assertEqual(content_mock.propertyCollector.RetrievePropertiesEx.call_count, 1)
+        self.assertEqual(inventory.name(hosts[0][1]["vm"][0], "vm"), "Ubuntu")
+
+        # objects spread over two pages are all returned
+        content_mock = self.mock_content(page_size=1)
+        content_mock.propertyCollector.RetrievePropertiesEx.side_effect = None
+        content_mock.propertyCollector.RetrievePropertiesEx.return_value = MagicMock(objects=[
+            object_content(vim.Datastore("ds-1"), {"name": "ds1"})
+        ], token="page-1")
+        content_mock.propertyCollector.ContinueRetrievePropertiesEx.side_effect = None
+        content_mock.propertyCollector.ContinueRetrievePropertiesEx.return_value = MagicMock(objects=[
+            object_content(vim.Datastore("ds-2"), {"name": "ds2"})
+        ], token=None)
+        inventory = VSphereInventory(content_mock, page_size=1)
+
+        datastores = inventory.get("datastore")
+        self.assertEqual([properties["name"] for _, properties in datastores], ["ds1", "ds2"])
+        content_mock.propertyCollector.ContinueRetrievePropertiesEx.assert_called_once_with("page-1")
+
+    def test_topology_collected_in_pool_at_refresh_interval(self):
+        """
+        Test if the topology is collected by a pool job at its own interval and the completed snapshot is sent once
+        """
+        config = {'init_config': {'topology_refresh_interval': 600}, 'instances': [{'name': 'vsphere_mock', 'host': 'test-esxi'}]}
+        self.load_check(config)
+        instance = config['instances'][0]
+        # Disable threading
+        self.check.pool = Mock(apply_async=lambda func, args: func(*args))
+
+        topo_items = {'datastores': [], 'clustercomputeresource': [], 'computeresource': [], 'hosts': [], 'datacenters':
+            [], 'vms': [{'hostname': 'Ubuntu', 'topo_tags': {'topo_type': 'vsphere-VirtualMachine',
+                 'name': 'Ubuntu', 'datastore': '54183927-04f91918-a72a-6805ca147c55'}, 'mor_type': 'vm'}]}
+        self.check.get_topologyitems_sync = MagicMock(return_value=topo_items)
+
+        self.check._cache_topology(instance)
+        self.check._send_topology_snapshot(instance)
+        topo_instances = self.check.get_topology_instances()
+        self.assertEqual(len(topo_instances), 1)
+        self.assertEqual(len(topo_instances[0]['components']), 1)
+        self.assertFalse(self.check.topology_collecting)
+
+        # within the refresh interval nothing is collected nor sent again
+        self.check._cache_topology(instance)
+        self.check._send_topology_snapshot(instance)
+        self.assertEqual(len(self.check.get_topology_instances()), 0)
+        self.assertEqual(self.check.get_topologyitems_sync.call_count, 1)
+
+    def test_topology_not_queued_while_collecting(self):
+        """
+        Test if no topology collection is queued while another one is still running
+        """
+        config = {'init_config': {}, 'instances': [{'name': 'vsphere_mock', 'host': 'test-esxi'}]}
+        self.load_check(config)
+        instance = config['instances'][0]
+        self.check.pool = Mock()
+        self.check.topology_collecting.add('other_vcenter')
+
+        self.check._cache_topology(instance)
+        self.assertFalse(self.check.pool.apply_async.called)
@@ -12,6 +12,7 @@ import logging
 import time
 
 from checks import AgentCheck, CheckException
+from utils.persistable_store import PersistableStore
 
 
 class ZabbixHost:
@@ -55,17 +56,18 @@ class ZabbixTrigger:
 
 
 class ZabbixEvent:
-    def __init__(self, event_id, acknowledged, host_ids, trigger):
+    def __init__(self, event_id, acknowledged, host_ids, trigger, value=None):
         self.event_id = event_id
         self.acknowledged = acknowledged  # 0/1 (not) acknowledged
         self.host_ids = host_ids
         self.trigger = trigger  # ZabbixTrigger
+        self.value = value  # 0/1 OK/PROBLEM
 
     def __repr__(self):
         return self.__str__()
 
     def __str__(self):
-        return "ZabbixEvent(event_id:%s, acknowledged:%s, host_ids:%s, trigger:%s)" % (self.event_id, self.acknowledged, self.host_ids, self.trigger)
+        return "ZabbixEvent(event_id:%s, acknowledged:%s, host_ids:%s, trigger:%s, value:%s)" % (self.event_id, self.acknowledged, self.host_ids, self.trigger, self.value)
 
 
 class ZabbixProblem:
@@ -84,6 +86,9 @@ class ZabbixProblem:
 
 class Zabbix(AgentCheck):
     SERVICE_CHECK_NAME = SOURCE_TYPE_NAME = "Zabbix"
+    PERSISTENCE_CHECK_NAME = "zabbix"
+    DEFAULT_EVENTS_BATCH_SIZE = 1000
+    DEFAULT_FULL_RESYNC_INTERVAL = 3600  # seconds between two rebuilds of the incremental rollup from the problems
     log = logging.getLogger('Zabbix')
     begin_epoch = None  # start to listen to events from epoch timestamp
 
@@ -121,7 +126,19 @@ class Zabbix(AgentCheck):
 
             hosts[zabbix_host.host_id] = zabbix_host
 
-        # Telemetry, get all problems.
+        if instance.get('incremental_events', False):
+            batch_size = int(instance.get('events_batch_size', self.DEFAULT_EVENTS_BATCH_SIZE))
+            full_resync_interval = float(instance.get('full_resync_interval', self.DEFAULT_FULL_RESYNC_INTERVAL))
+            self.process_incremental_events(url, auth, hosts, batch_size, full_resync_interval)
+        else:
+            self.process_problems(url, auth, hosts)
+
+        self.stop_snapshot(topology_instance)
+
+    def process_problems(self, url, auth, hosts):
+        """
+        Rolls up all active problems per host and sends an event per host, either in OK/PROBLEM state
+        """
         zabbix_problems = self.retrieve_problems(url, auth)
 
         event_ids = list(problem.event_id for problem in zabbix_problems)
@@ -151,20 +168,96 @@ class Zabbix(AgentCheck):
                 triggers = [event.trigger.description for event in rolled_up_events_per_host[host_id]]
                 severity = most_severe_severity_per_host[host_id]
 
-            self.event({
-                'timestamp': int(time.time()),
-                'source_type_name': self.SOURCE_TYPE_NAME,
-                'host': self.hostname,
-                'tags': [
-                    'host_id:%s' % host_id,
-                    'host:%s' % zabbix_host.host,
-                    'host_name:%s' % zabbix_host.name,
-                    'severity:%s' % severity,
-                    'triggers:%s' % triggers
-                ]
-            })
+            self.send_host_event(host_id, zabbix_host, severity, triggers)
 
-        self.stop_snapshot(topology_instance)
+    def process_incremental_events(self, url, auth, hosts, batch_size, full_resync_interval):
+        """
+        Keeps a per host rollup of active triggers in persistent state and only queries Zabbix for events newer than
+        the last seen event. An event is sent for a host when its severity or set of triggers changed since the last run.
+        The rollup is rebuilt from the active problems every `full_resync_interval` seconds.
+        """
+        store = PersistableStore(self.PERSISTENCE_CHECK_NAME, url)
+        last_event_id = store['last_event_id']
+        triggers_per_host = store['triggers_per_host']  # host_id -> {trigger_id: [event_id, description, priority]}
+        sent_state_per_host = store['sent_state_per_host'] or {}  # host_id -> [severity, triggers]
+        last_full_resync = store['last_full_resync'] or 0
+
+        now = time.time()
+        if last_event_id is None or triggers_per_host is None or now - last_full_resync >= full_resync_interval:
+            # No resume point yet, or a periodic resync: seed the rollup from the active problems. Some problems never
+            # get an OK event (deleted or disabled triggers, events removed by the housekeeper), the resync drops them.
+            # The latest event id is taken first, so events raised during seeding are replayed on the next run.
+            last_event_id = self.retrieve_latest_event_id(url, auth)
+            last_full_resync = now
+            triggers_per_host = {}
+
+            event_ids = list(problem.event_id for problem in self.retrieve_problems(url, auth))
+            zabbix_events = [] if len(event_ids) == 0 else self.retrieve_events(url, auth, event_ids)
+            for zabbix_event in zabbix_events:
+                self.apply_event(triggers_per_host, zabbix_event)
+        else:
+            for zabbix_event in self.retrieve_events_since(url, auth, last_event_id, batch_size):
+                self.apply_event(triggers_per_host, zabbix_event)
+                last_event_id = max(last_event_id, int(zabbix_event.event_id))
+
+        self.log.debug('triggers_per_host:' + str(triggers_per_host))
+
+        # forget hosts that are no longer known in Zabbix
+        for host_id in list(triggers_per_host.keys()):
+            if host_id not in hosts:
+                del triggers_per_host[host_id]
+        for host_id in list(sent_state_per_host.keys()):
+            if host_id not in hosts:
+                del sent_state_per_host[host_id]
+
+        for host_id, zabbix_host in hosts.iteritems():
+            severity = 0
+            triggers = []
+
+            if triggers_per_host.get(host_id):
+                active_triggers = sorted(triggers_per_host[host_id].values())  # ordered by event id
+                triggers = [description for _, description, _ in active_triggers]
+                severity = max(priority for _, _, priority in active_triggers)
+
+            state = [severity, triggers]
+            if sent_state_per_host.get(host_id) != state:
+                self.send_host_event(host_id, zabbix_host, severity, triggers)
+                sent_state_per_host[host_id] = state
+
+        store['last_event_id'] = last_event_id
+        store['triggers_per_host'] = triggers_per_host
+        store['sent_state_per_host'] = sent_state_per_host
+        store['last_full_resync'] = last_full_resync
+        store.commit_status()
+
+    @staticmethod
+    def apply_event(triggers_per_host, zabbix_event):
+        """
+        Updates the per host trigger rollup with a PROBLEM (adds the trigger) or an OK event (resolves the trigger)
+        """
+        trigger = zabbix_event.trigger
+        for host_id in zabbix_event.host_ids:
+            host_triggers = triggers_per_host.setdefault(host_id, {})
+            if str(zabbix_event.value) == "0":
+                host_triggers.pop(trigger.trigger_id, None)
+                if not host_triggers:
+                    del triggers_per_host[host_id]
+            else:
+                host_triggers[trigger.trigger_id] = [int(zabbix_event.event_id), trigger.description, trigger.priority]
+
+    def send_host_event(self, host_id, zabbix_host, severity, triggers):
+        self.event({
+            'timestamp': int(time.time()),
+            'source_type_name': self.SOURCE_TYPE_NAME,
+            'host': self.hostname,
+            'tags': [
+                'host_id:%s' % host_id,
+                'host:%s' % zabbix_host.host,
+                'host_name:%s' % zabbix_host.name,
+                'severity:%s' % severity,
+                'triggers:%s' % triggers
+            ]
+        })
 
     def process_host_topology(self, topology_instance, zabbix_host, stackstate_environment):
         external_id = "urn:host:/%s" % zabbix_host.host
@@ -206,31 +299,75 @@ class Zabbix(AgentCheck):
 
         response = self.method_request(url, "event.get", auth=auth, params=params)
 
+        for event in response.get('result', []):
+            yield self.parse_event(event)
+
+    def retrieve_events_since(self, url, auth, last_event_id, batch_size):
+        """
+        Retrieves the trigger events newer than last_event_id in ascending order, paged by batch_size
+        """
+        self.log.debug("Retrieving events since event_id %s." % last_event_id)
+
+        while True:
+            params = {
+                "source": 0,  # events created by triggers
+                "object": 0,  # trigger events
+                "eventid_from": last_event_id + 1,
+                "output": ["eventid", "value", "severity", "acknowledged"],
+                "selectHosts": ["hostid"],
+                "selectRelatedObject": ["triggerid", "description", "priority"],
+                "sortfield": ["eventid"],
+                "sortorder": "ASC",
+                "limit": batch_size
+            }
+            response = self.method_request(url, "event.get", auth=auth, params=params)
+            events = response.get('result', [])
+            for event in events:
+                zabbix_event = self.parse_event(event)
+                last_event_id = max(last_event_id, int(zabbix_event.event_id))
+                yield zabbix_event
+
+            if len(events) < batch_size:
+                break
+
+    def retrieve_latest_event_id(self, url, auth):
+        params = {
+            "source": 0,  # events created by triggers
+            "object": 0,  # trigger events
+            "output": ["eventid"],
+            "sortfield": ["eventid"],
+            "sortorder": "DESC",
+            "limit": 1
+        }
+        response = self.method_request(url, "event.get", auth=auth, params=params)
         events = response.get('result', [])
-        for event in events:
-            event_id = event.get('eventid', None)
-            acknowledged = event.get('acknowledged', None)
+        return int(events[0].get('eventid')) if events else 0
+
+    def parse_event(self, event):
+        event_id = event.get('eventid', None)
+        acknowledged = event.get('acknowledged', None)
+        value = event.get('value', None)
 
-            hosts_items = event.get('hosts', [])
-            host_ids = []
-            for item in hosts_items:
-                host_id = item.get('hostid', None)
-                host_ids.append(host_id)
+        hosts_items = event.get('hosts', [])
+        host_ids = []
+        for item in hosts_items:
+            host_id = item.get('hostid', None)
+            host_ids.append(host_id)
 
-            trigger = event.get('relatedObject', {})
-            trigger_id = trigger.get('triggerid', None)
-            trigger_description = trigger.get('description', None)
-            trigger_priority = trigger.get('priority', None)
+        trigger = event.get('relatedObject', {})
+        trigger_id = trigger.get('triggerid', None)
+        trigger_description = trigger.get('description', None)
+        trigger_priority = trigger.get('priority', None)
 
-            trigger = ZabbixTrigger(trigger_id, trigger_description, trigger_priority)
-            zabbix_event = ZabbixEvent(event_id, acknowledged, host_ids, trigger)
+        trigger = ZabbixTrigger(trigger_id, trigger_description, trigger_priority)
+        zabbix_event = ZabbixEvent(event_id, acknowledged, host_ids, trigger, value)
 
-            self.log.debug("Parsed ZabbixEvent: %s." % zabbix_event)
+        self.log.debug("Parsed ZabbixEvent: %s." % zabbix_event)
 
-            if not trigger_id or not trigger_description or not trigger_priority or not event_id or len(host_ids) == 0:
-                self.log.warn("Incomplete ZabbixEvent, got: %s" % zabbix_event)
+        if not trigger_id or not trigger_description or not trigger_priority or not event_id or len(host_ids) == 0:
+            self.log.warn("Incomplete ZabbixEvent, got: %s" % zabbix_event)
 
-            yield zabbix_event
+        return zabbix_event
 
     def retrieve_hosts(self, url, auth):
         self.log.debug("Retrieving hosts.")
@@ -10,6 +10,7 @@ import os
 # project
 from tests.checks.common import AgentCheckTest
 from checks import CheckException
+from utils.persistable_store import PersistableStore
 import mock
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'ci')
@@ -462,3 +463,124 @@ class TestZabbix(AgentCheckTest):
 
     def test_zabbix_respect_default_ssl_verify(self):
         self.validate_requests_ssl_verify_setting(self._config, True)
+
+
+class TestZabbixIncrementalEvents(AgentCheckTest):
+    CHECK_NAME = 'zabbix'
+
+    _url = "http://host/zabbix/api_jsonrpc.php"
+
+    _config = {
+        'init_config': {},
+        'instances': [
+            {
+                'url': _url,
+                'user': 'Admin',
+                'password': 'zabbix',
+                'incremental_events': True
+            }
+        ]
+    }
+
+    def setUp(self):
+        PersistableStore("zabbix", self._url).clear_status()
+
+    @staticmethod
+    def _event(event_id, value, trigger_id, description, priority):
+        return {
+            "eventid": event_id,
+            "value": value,
+            "acknowledged": "0",
+            "hosts": [
+                {
+                    "hostid": "10084"
+                }
+            ],
+            "relatedObject": {
+                "triggerid": trigger_id,
+                "description": description,
+                "priority": priority
+            }
+        }
+
+    def _run_incremental_check(self, new_events, problems=None):
+        method_names = []
+
+        def _mocked_method_request(url, name, auth=None, params={}, request_id=1):
+            method_names.append(name)
+            if name == "apiinfo.version":
+                return TestZabbix._apiinfo_response()
+            elif name == "host.get":
+                return TestZabbix._zabbix_host_response()
+            elif name == "problem.get":
+                return TestZabbix._zabbix_problem() if problems is None else problems
+            elif name == "trigger.get":
+                return TestZabbix._zabbix_trigger()
+            elif name == "event.get" and "eventids" in params:
+                return TestZabbix._zabbix_event()
+            elif name == "event.get" and params.get("sortorder") == "DESC":
+                return {"jsonrpc": "2.0", "result": [{"eventid": "14"}], "id": 1}
+            elif name == "event.get":
+                self.assertEqual(params["eventid_from"], 15)
+                return {"jsonrpc": "2.0", "result": new_events, "id": 1}
+            else:
+                self.fail("TEST FAILED on making invalid request")
+
+        self.run_check(self._config, mocks={
+            'method_request': _mocked_method_request,
+            'login': lambda url, user, password: "dummyauthtoken",
+        })
+        return method_names
+
+    def test_zabbix_incremental_seeds_from_problems(self):
+        self._run_incremental_check([])
+
+        self.assertEqual(len(self.events), 1)
+        tags = self.events[0]['tags']
+        for tag in ['host_id:10084', 'severity:3', "triggers:['Zabbix agent on {HOST.NAME} is unreachable for 5 minutes']"]:
+            if tag not in tags:
+                self.fail("Event does not have tag '%s', got: %s." % (tag, tags))
+
+    def test_zabbix_incremental_only_sends_changes(self):
+        self._run_incremental_check([])
+        self.assertEqual(len(self.events), 1)
+
+        # second run without new events does not rescan problems and sends no host events
+        request_names = self._run_incremental_check([])
+        self.assertNotIn("problem.get", request_names)
+        self.assertEqual(len(self.events), 0)
+
+    def test_zabbix_incremental_applies_new_events(self):
+        self._run_incremental_check([])
+
+        self._run_incremental_check([
+            self._event("15", "1", "111", "My very own problem", "5"),
+            self._event("16", "0", "13491", "Zabbix agent on {HOST.NAME} is unreachable for 5 minutes", "3")
+        ])
+
+        self.assertEqual(len(self.events), 1)
+        tags = self.events[0]['tags']
+        for tag in ['host_id:10084', 'severity:5', "triggers:['My very own problem']"]:
+            if tag not in tags:
+                self.fail("Event does not have tag '%s', got: %s." % (tag, tags))
+
+    def test_zabbix_incremental_full_resync(self):
+        """
+        A problem that vanishes without an OK event is dropped by the next full resync
+        """
+        self._run_incremental_check([])
+        self.assertEqual(len(self.events), 1)
+
+        no_problems = {"jsonrpc": "2.0", "result": [], "id": 1}
+        request_names = self._run_incremental_check([], problems=no_problems)
+        self.assertNotIn("problem.get", request_names)
+        self.assertEqual(len(self.events), 0)
+
+        self.check.instances = [dict(self.check.instances[0], full_resync_interval=0)]
+        request_names = self._run_incremental_check([], problems=no_problems)
+        self.assertIn("problem.get", request_names)
+        self.assertEqual(len(self.events), 1)
+        tags = self.events[0]['tags']
+        for tag in ['host_id:10084', 'severity:0', "triggers:[]"]:
+            if tag not in tags:
+                self.fail("Event does not have tag '%s', got: %s." % (tag, tags))